@@ -25,6 +25,7 @@ import logging
 from shared_utils import set_config
 from shared_utils import resolve_target_chat_id, chat_cfg_set, chat_ai_autoclean_sec
 from shared_utils import log_exceptions
+from shared_utils import chat_ai_cache_enabled, chat_ai_cache_clear, chat_ai_stream_enabled
 
 
 # دستورات ادمین: /dm, /allow, /block, /users, /unknowns
@@ -150,6 +151,8 @@ async def chat_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
       /chat on       → فعال
       /chat off      → غیرفعال
       /chat status   → نمایش وضعیت فعلی
+      /chat cache on|off|clear → کش پاسخ همین گروه
+      /chat stream on|off      → پاسخ تدریجی (استریم) در همین گروه
     پیاده‌سازی با کلید bot_config: chat_feature
     """
     # ثبت/به‌روزرسانی اطلاعات کاربر در DB
@@ -211,6 +214,42 @@ async def chat_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return await safe_reply_text(update, f"⏱ autoclean این گروه روی {seconds} ثانیه تنظیم شد.")
 
 
+    # --- /chat cache <on|off|clear|status> (per-group answer cache) ---
+    if sub == "cache":
+        tgt = await resolve_target_chat_id(update, context)
+        if not tgt:
+            return await safe_reply_text(
+                update,
+                "برای مدیریت «کش پاسخ» داخل گروه این دستور رو بزن، یا در پی‌وی اول یک گروه رو با /manage وصل کن."
+            )
+        op = (args[1].strip().lower() if len(args) >= 2 else "status")
+        if op in ("clear", "flush", "reset"):
+            n = chat_ai_cache_clear(tgt)
+            audit_admin_action(update, "chat", {"sub": "cache", "op": "clear", "chat_id": tgt}, ok=True, new_value=str(n))
+            return await safe_reply_text(update, f"🧽 کش پاسخ این گروه پاک شد ({n} مورد).")
+        if op in ("on", "off"):
+            chat_cfg_set(tgt, "chat_ai_cache", op)
+            if op == "off":
+                chat_ai_cache_clear(tgt)
+            return await safe_reply_text(update, f"💾 کش پاسخ این گروه: {op.upper()}")
+        status = "ON" if chat_ai_cache_enabled(tgt) else "OFF"
+        return await safe_reply_text(update, f"💾 کش پاسخ این گروه: {status}\nاستفاده: /chat cache on | off | clear")
+
+    # --- /chat stream <on|off|status> (پاسخ تدریجی، per-chat) ---
+    if sub == "stream":
+        tgt = await resolve_target_chat_id(update, context)
+        if not tgt:
+            return await safe_reply_text(
+                update,
+                "برای تنظیم «استریم پاسخ» داخل گروه این دستور رو بزن، یا در پی‌وی اول یک گروه رو با /manage وصل کن."
+            )
+        op = (args[1].strip().lower() if len(args) >= 2 else "status")
+        if op in ("on", "off"):
+            chat_cfg_set(tgt, "chat_ai_stream", op)
+            return await safe_reply_text(update, f"📡 استریم پاسخ این گروه: {op.upper()}")
+        status = "ON" if chat_ai_stream_enabled(tgt) else "OFF"
+        return await safe_reply_text(update, f"📡 استریم پاسخ این گروه: {status}\nاستفاده: /chat stream on | off")
+
     # تابع کمکی: خواندن وضعیت جاری از bot_config (پیش‌فرض: ON)
     def _chat_feature_on_now() -> bool:
         v = get_config("chat_feature")  # ممکن است None باشد
@@ -230,7 +269,7 @@ async def chat_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
     # راهنما
-    return await safe_reply_text(update, "استفاده: /chat on | off | status | autoclean <sec|Xm|off>")
+    return await safe_reply_text(update, "استفاده: /chat on | off | status | autoclean <sec|Xm|off> | cache <on|off|clear> | stream <on|off>")
 
 async def allow_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     upsert_user_from_update(update)
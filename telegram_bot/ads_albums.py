@@ -0,0 +1,95 @@
+# ads_albums.py
+# -----------------------------------------------------------------------------
+# مرحلهٔ تجمیع آلبوم (media_group) برای AdsGuard
+# - تلگرام هر آلبوم را به‌صورت N آپدیت جدا می‌فرستد؛ این‌جا آپدیت‌های هم‌mgid بافر می‌شوند
+# - پس از یک بازهٔ سکوت (quiet) یا سقف انتظار (max_wait)، flush یک‌بار برای کل آلبوم صدا زده می‌شود
+#   با پیام «اصلی» (دارای کپشن، وگرنه اولین عضو)، کپشن ادغام‌شده و همهٔ message_idها
+# - flush در task جدا اجرا می‌شود؛ هندلر هر عضو بلافاصله برمی‌گردد (صف آپدیت‌های PTB معطل نمی‌ماند)
+# -----------------------------------------------------------------------------
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Tuple
+
+log = logging.getLogger("ads_albums")
+
+
+@dataclass
+class AlbumBatch:
+    chat_id: int
+    mgid: str
+    items: List[Tuple[Any, Any]] = field(default_factory=list)   # (update, context) به ترتیب رسیدن
+    first_ts: float = 0.0
+    last_ts: float = 0.0
+
+    @property
+    def message_ids(self) -> List[int]:
+        return sorted({u.effective_message.message_id for u, _ in self.items})
+
+    @property
+    def caption(self) -> str:
+        """کپشن‌های غیرتکراری اعضا به ترتیب message_id (معمولاً فقط یکی کپشن دارد)."""
+        seen, parts = set(), []
+        for u, _ in sorted(self.items, key=lambda it: it[0].effective_message.message_id):
+            cap = (u.effective_message.caption or "").strip()
+            if cap and cap not in seen:
+                seen.add(cap)
+                parts.append(cap)
+        return "\n".join(parts)
+
+    @property
+    def lead(self) -> Tuple[Any, Any]:
+        """عضو نماینده: اولین عضو دارای کپشن، وگرنه کوچک‌ترین message_id."""
+        ordered = sorted(self.items, key=lambda it: it[0].effective_message.message_id)
+        for it in ordered:
+            if (it[0].effective_message.caption or "").strip():
+                return it
+        return ordered[0]
+
+
+class AlbumAggregator:
+    def __init__(
+        self,
+        flush: Callable[[AlbumBatch], Awaitable[None]],
+        quiet_sec: float,
+        max_wait_sec: float,
+        max_items: int = 10,
+    ):
+        self._flush = flush
+        self._quiet = max(0.05, float(quiet_sec))
+        self._max_wait = max(self._quiet, float(max_wait_sec))
+        self._max_items = max(1, int(max_items))   # آلبوم تلگرام حداکثر ۱۰ عضو دارد
+        self._open: Dict[Tuple[int, str], AlbumBatch] = {}
+
+    def __len__(self) -> int:
+        return len(self._open)
+
+    def offer(self, chat_id: int, mgid: str, update, context) -> None:
+        """افزودن یک عضو آلبوم؛ اولین عضو، task انتظار/flush همان آلبوم را می‌سازد."""
+        key = (chat_id, str(mgid))
+        now = time.monotonic()
+        batch = self._open.get(key)
+        if batch is None:
+            batch = self._open[key] = AlbumBatch(chat_id, str(mgid), first_ts=now)
+            context.application.create_task(self._wait_and_flush(key, batch))
+        mid = update.effective_message.message_id
+        if all(u.effective_message.message_id != mid for u, _ in batch.items):
+            batch.items.append((update, context))
+        batch.last_ts = now
+
+    async def _wait_and_flush(self, key, batch: AlbumBatch) -> None:
+        while len(batch.items) < self._max_items:
+            deadline = min(batch.last_ts + self._quiet, batch.first_ts + self._max_wait)
+            delay = deadline - time.monotonic()
+            if delay <= 0:
+                break
+            await asyncio.sleep(delay)
+        if self._open.get(key) is batch:
+            self._open.pop(key, None)
+        try:
+            await self._flush(batch)
+        except Exception:
+            log.exception("[ads] album flush failed", extra={"chat_id": batch.chat_id, "mgid": batch.mgid})
@@ -353,6 +353,23 @@ def register_ads_commands(app, ads_guard):
             await _auto_cleanup_pair(update, context, m)
             return m
 
+        if sub == "select":
+            if not await _require_admin(update, context):
+                m = await safe_reply_text(update, t("errors.only_admins"), chat_id=update.effective_chat.id if update.effective_chat else None)
+                await _auto_cleanup_pair(update, context, m)
+                return m
+            if len(args) < 2 or args[1].lower() not in ("latest", "balanced", "similar"):
+                cur_mode = ads_guard.chat_examples_select_mode(chat_id)
+                m = await safe_reply_text(update, f"استفاده: /ads select latest|balanced|similar\nفعلی: {cur_mode}")
+                await _auto_cleanup_pair(update, context, m)
+                return m
+            mode = args[1].lower()
+            ads_guard.chat_set_config(chat_id, "ads_examples_select", mode)
+            note = "" if mode != "similar" or ads_guard.similar_examples_available() else "\n(NumPy نصب نیست؛ به latest برمی‌گردد)"
+            m = await safe_reply_text(update, f"ads_examples_select = {mode}{note}")
+            await _auto_cleanup_pair(update, context, m)
+            return m
+
         
         if sub == "gap":
             if not await _require_admin(update, context):
@@ -441,6 +458,7 @@ def register_ads_commands(app, ads_guard):
                         before = cur.fetchone()[0] or 0
                         cur.execute("DELETE FROM ads_examples WHERE chat_id = %s;", (chat_id,))
                         conn.commit()
+                    ads_guard.invalidate_examples(chat_id)
                     txt = tn(
                         "ads.examples.cleared.one",
                         "ads.examples.cleared.many",
@@ -463,7 +481,7 @@ def register_ads_commands(app, ads_guard):
 
         help_text = (
             "مدیریت گارد تبلیغات:\n"
-            "/ads on|off|status|action|threshold|chatflow|fewshots|balance|gap|wuser|wdomain|autoclean|...\n"
+            "/ads on|off|status|action|threshold|chatflow|fewshots|balance|select|gap|wuser|wdomain|autoclean|...\n"
             "/ads action warn|delete|none\n"
             "/ads add <متن>  (یا روی پیام نمونه ریپلای)\n"
             "/ads notad <متن>  (یا روی پیام غیرتبلیغاتی ریپلای)\n"
@@ -476,6 +494,7 @@ def register_ads_commands(app, ads_guard):
             "/ads chatflow <id>\n"
             "/ads fewshots <n>\n"
             "/ads balance on|off  (بالانس AD/NOT_AD در انتخاب few-shots)\n"
+            "/ads select latest|balanced|similar  (روش انتخاب few-shots؛ similar = شبیه‌ترین‌ها به پیام)\n"
             "/ads gap <sec>\n"
             "/ads wuser add|remove|list [user_id]\n"
             "/ads wdomain add|remove|list [domain]\n"
@@ -1225,6 +1244,7 @@ def register_ads_commands(app, ads_guard):
             with db_conn() as conn, conn.cursor() as cur:
                 cur.execute("DELETE FROM ads_examples WHERE chat_id = %s;", (chat_id,))
                 conn.commit()
+            ads_guard.invalidate_examples(chat_id)
             m = await safe_reply_text(update, t("ads.examples.clear.ok", chat_id=update.effective_chat.id if update.effective_chat else None))
             await _auto_cleanup_pair(update, context, m)
             return m
@@ -1291,6 +1311,7 @@ def register_ads_commands(app, ads_guard):
                 before = cur.fetchone()[0] or 0
                 cur.execute("DELETE FROM ads_examples WHERE chat_id = %s;", (chat_id,))
                 conn.commit()
+            ads_guard.invalidate_examples(chat_id)
             txt = tn(
                 "ads.examples.cleared.one",
                 "ads.examples.cleared.many",
@@ -1499,7 +1520,10 @@ def register_ads_commands(app, ads_guard):
                 return m
     
             if sub == "add":
-                ads_guard.wl_domain_add(chat_id, domain, update.effective_user.id if update.effective_user else None)
+                if not ads_guard.wl_domain_add(chat_id, domain, update.effective_user.id if update.effective_user else None):
+                    m = await safe_reply_text(update, t("ads.wdomain.need_domain", chat_id=update.effective_chat.id if update.effective_chat else None))
+                    await _auto_cleanup_pair(update, context, m)
+                    return m
                 m = await safe_reply_text(update, t("ads.wdomain.add.ok", chat_id=update.effective_chat.id if update.effective_chat else None, domain=domain))
                 await _auto_cleanup_pair(update, context, m)
                 return m
@@ -1544,9 +1568,9 @@ def register_ads_commands(app, ads_guard):
         examples_str = "\n\n".join([f"مثال {i+1}:\n[{e[3]}]\n{e[1]}" for i, e in enumerate(examples[:_k])])
         prompt = ads_guard._build_prompt(text, examples)
     
-        # تماس با Flowise (thread)
-        parsed, err = await asyncio.to_thread(
-            ads_guard._call_flowise_ads, prompt, text, examples_str, chat_id,
+        # تماس با Flowise (کلاینت async مشترک)
+        parsed, err = await ads_guard._call_flowise_ads(
+            prompt, text, examples_str, chat_id,
             {"is_reply": False, "has_contact": ads_guard._has_contact_like(text)}
         )
         if err and not parsed:
@@ -0,0 +1,113 @@
+# ads_domains.py
+# -----------------------------------------------------------------------------
+# whitelist دامنه‌های AdsGuard به‌صورت درون‌حافظه‌ای
+# - هر ورودی (مثل example.com یا t.me/mychannel) به شکل canonical درمی‌آید:
+#   حروف کوچک، بدون scheme/www/نقطهٔ انتهایی، دامنهٔ IDN → punycode (xn--...)
+# - DomainTrie: trie روی برچسب‌های معکوس (com → example → shop)؛
+#   example.com همهٔ زیردامنه‌ها را هم پوشش می‌دهد، t.me/foo فقط مسیرهای زیر /foo را
+# - جست‌وجو O(تعداد برچسب‌ها) و بدون I/O
+# -----------------------------------------------------------------------------
+from __future__ import annotations
+
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+
+def canonical_host(host: str) -> str:
+    """حروف کوچک، بدون نقطهٔ ابتدا/انتها و پورت؛ دامنهٔ یونیکد → punycode."""
+    h = (host or "").strip().lower().strip(".")
+    h = h.rpartition("@")[2].partition(":")[0]
+    if not h:
+        return ""
+    try:
+        h = h.encode("idna").decode("ascii")
+    except UnicodeError:
+        pass   # برچسب نامعتبر برای IDNA: همان شکل کوچک‌شده
+    return h
+
+
+def canonical_path(path: str) -> str:
+    """مسیر بدون query/fragment و اسلش انتهایی، با حروف کوچک (مثل آیدی‌های t.me)."""
+    p = (path or "").split("?", 1)[0].split("#", 1)[0].strip().lower().rstrip("/")
+    if p and not p.startswith("/"):
+        p = "/" + p
+    return p
+
+
+def canonical_entry(entry: str) -> Tuple[str, str]:
+    """
+    ورودی whitelist (با یا بدون scheme) → (host, path).
+    www. ابتدای میزبان حذف می‌شود چون خودِ دامنه زیردامنه‌ها را پوشش می‌دهد.
+    """
+    s = (entry or "").strip()
+    if "://" in s:
+        s = s.split("://", 1)[1]
+    host, sep, path = s.partition("/")
+    host = canonical_host(host)
+    if host.startswith("www."):
+        host = host[4:]
+    return host, canonical_path(sep + path)
+
+
+def entry_key(entry: str) -> str:
+    """شکل ذخیره‌شدهٔ یک ورودی در ads_whitelist_domains (host یا host/path)."""
+    host, path = canonical_entry(entry)
+    return host + path if host else ""
+
+
+class _Node:
+    __slots__ = ("children", "whole", "paths")
+
+    def __init__(self):
+        self.children: Dict[str, "_Node"] = {}
+        self.whole = False            # کل دامنه (و زیردامنه‌ها) مجاز است
+        self.paths: Set[str] = set()  # فقط این پیشوندهای مسیر مجازند
+
+
+class DomainTrie:
+    """trie پسوندی روی برچسب‌های معکوس دامنه‌ها."""
+
+    def __init__(self, entries: Iterable[str] = ()):
+        self._root = _Node()
+        self._size = 0
+        for e in entries:
+            self.add(e)
+
+    def __len__(self) -> int:
+        return self._size
+
+    def add(self, entry: str) -> None:
+        host, path = canonical_entry(entry)
+        if not host:
+            return
+        node = self._root
+        for label in reversed(host.split(".")):
+            node = node.children.setdefault(label, _Node())
+        if path:
+            node.paths.add(path)
+        else:
+            node.whole = True
+        self._size += 1
+
+    def match(self, host: str, path: str = "") -> bool:
+        """آیا host (یا یکی از دامنه‌های والدش) با مسیر داده‌شده whitelist است؟"""
+        h = canonical_host(host)
+        if not h:
+            return False
+        p: Optional[str] = None
+        node = self._root
+        for label in reversed(h.split(".")):
+            node = node.children.get(label)
+            if node is None:
+                return False
+            if node.whole:
+                return True
+            if node.paths:
+                if p is None:
+                    p = canonical_path(path)
+                for allowed in node.paths:
+                    if p == allowed or p.startswith(allowed + "/"):
+                        return True
+        return False
+
+    def match_any(self, links: Iterable[Tuple[str, str]]) -> bool:
+        return any(self.match(host, path) for host, path in links)
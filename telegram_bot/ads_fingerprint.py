@@ -0,0 +1,199 @@
+# ads_fingerprint.py
+# -----------------------------------------------------------------------------
+# ایندکس near-duplicate برای متن‌هایی که AdsGuard قبلاً «AD» تشخیص داده است
+# - SimHash ۶۴بیتی روی 4-gramهای کاراکتری متن فشرده (بدون فاصله/ایموجی/علائم)
+#   → تغییر فاصلهٔ ارقام تلفن یا افزودن ایموجی اثر ندارد
+# - LSH: تقسیم fingerprint به ۴ باند ۱۶بیتی؛ فاصلهٔ همینگ ≤ ۳ حتماً در یک باند برابر است
+# - محدود (LRU) به ازای هر گروه + ایندکس سراسری اختیاری
+# - ذخیره روی دیسک در shutdown و بارگذاری در startup (JSON، نوشتن اتمیک)
+# -----------------------------------------------------------------------------
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+log = logging.getLogger("ads_fingerprint")
+
+BANDS = 4
+BAND_BITS = 64 // BANDS
+_BAND_MASK = (1 << BAND_BITS) - 1
+SHINGLE = 4
+
+
+def _compact(norm_text: str) -> str:
+    """فقط حروف و ارقام (متن باید از قبل با normalize_text یکدست شده باشد)."""
+    return "".join(ch for ch in norm_text if ch.isalnum())
+
+
+def simhash(norm_text: str, min_len: int = 24) -> Optional[int]:
+    """SimHash ۶۴بیتی؛ برای متن‌های خیلی کوتاه None (fingerprint ناپایدار است)."""
+    t = _compact(norm_text)
+    if len(t) < max(SHINGLE, min_len):
+        return None
+    weights = [0] * 64
+    seen = set()
+    for i in range(len(t) - SHINGLE + 1):
+        sh = t[i:i + SHINGLE]
+        if sh in seen:
+            continue
+        seen.add(sh)
+        h = int.from_bytes(hashlib.blake2b(sh.encode("utf-8"), digest_size=8).digest(), "big")
+        for b in range(64):
+            weights[b] += 1 if (h >> b) & 1 else -1
+    fp = 0
+    for b in range(64):
+        if weights[b] > 0:
+            fp |= 1 << b
+    return fp
+
+
+def _bands(fp: int):
+    for i in range(BANDS):
+        yield i, (fp >> (i * BAND_BITS)) & _BAND_MASK
+
+
+class FingerprintIndex:
+    """ایندکس LSH محدود (LRU) از fingerprint → meta (label/score/reason)."""
+
+    def __init__(self, max_entries: int):
+        self._max = max(1, int(max_entries))
+        self._items: "OrderedDict[int, dict]" = OrderedDict()
+        self._buckets: list[Dict[int, set]] = [dict() for _ in range(BANDS)]
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def add(self, fp: int, meta: dict) -> None:
+        if fp in self._items:
+            self._items[fp] = meta
+            self._items.move_to_end(fp)
+            return
+        self._items[fp] = meta
+        for i, band in _bands(fp):
+            self._buckets[i].setdefault(band, set()).add(fp)
+        while len(self._items) > self._max:
+            old, _ = self._items.popitem(last=False)
+            self._unlink(old)
+
+    def _unlink(self, fp: int) -> None:
+        for i, band in _bands(fp):
+            bucket = self._buckets[i].get(band)
+            if bucket is not None:
+                bucket.discard(fp)
+                if not bucket:
+                    del self._buckets[i][band]
+
+    def find(self, fp: int, max_dist: int) -> Optional[Tuple[dict, int]]:
+        """نزدیک‌ترین fingerprint با فاصلهٔ همینگ ≤ max_dist (یا None)."""
+        best: Optional[Tuple[int, int]] = None
+        for i, band in _bands(fp):
+            for cand in self._buckets[i].get(band, ()):
+                d = (cand ^ fp).bit_count()
+                if d <= max_dist and (best is None or d < best[1]):
+                    best = (cand, d)
+        if best is None:
+            return None
+        self._items.move_to_end(best[0])
+        return self._items[best[0]], best[1]
+
+    def remove_where(self, pred) -> int:
+        """حذف ورودی‌هایی که pred(meta) برایشان True است؛ خروجی: تعداد حذف‌شده."""
+        doomed = [fp for fp, meta in self._items.items() if pred(meta)]
+        for fp in doomed:
+            del self._items[fp]
+            self._unlink(fp)
+        return len(doomed)
+
+    def clear(self) -> None:
+        self._items.clear()
+        for b in self._buckets:
+            b.clear()
+
+    def dump(self) -> list:
+        return [[fp, meta] for fp, meta in self._items.items()]
+
+    def load(self, rows: list) -> None:
+        for row in rows or []:
+            try:
+                self.add(int(row[0]), dict(row[1]))
+            except Exception:
+                continue
+
+
+class AdFingerprints:
+    """ایندکس‌های هر گروه (تعداد گروه‌ها هم محدود) + ایندکس سراسری."""
+
+    def __init__(self, per_chat_max: int, global_max: int, max_chats: int = 2000):
+        self._per_chat_max = per_chat_max
+        self._max_chats = max(1, int(max_chats))
+        self._chats: "OrderedDict[int, FingerprintIndex]" = OrderedDict()
+        self.global_index = FingerprintIndex(global_max)
+        self._lock = threading.Lock()
+
+    def _chat(self, chat_id: int, create: bool) -> Optional[FingerprintIndex]:
+        idx = self._chats.get(chat_id)
+        if idx is None and create:
+            idx = self._chats[chat_id] = FingerprintIndex(self._per_chat_max)
+            while len(self._chats) > self._max_chats:
+                self._chats.popitem(last=False)
+        if idx is not None:
+            self._chats.move_to_end(chat_id)
+        return idx
+
+    def add(self, chat_id: int, fp: int, meta: dict, *, to_global: bool) -> None:
+        with self._lock:
+            self._chat(chat_id, True).add(fp, meta)
+            if to_global:
+                self.global_index.add(fp, dict(meta, chat_id=chat_id))
+
+    def find(self, chat_id: int, fp: int, max_dist: int, *, use_global: bool) -> Optional[Tuple[dict, int, str]]:
+        """(meta, distance, scope) که scope ∈ {chat, global}."""
+        with self._lock:
+            idx = self._chat(chat_id, False)
+            hit = idx.find(fp, max_dist) if idx is not None else None
+            if hit is not None:
+                return hit[0], hit[1], "chat"
+            if use_global:
+                hit = self.global_index.find(fp, max_dist)
+                if hit is not None:
+                    return hit[0], hit[1], "global"
+        return None
+
+    def clear_chat(self, chat_id: int) -> None:
+        """فراموشی رأی‌های یک گروه (ایندکس خودش + سهمش در ایندکس سراسری)؛ مثلاً پس از تغییر نمونه‌ها."""
+        with self._lock:
+            self._chats.pop(chat_id, None)
+            self.global_index.remove_where(lambda meta: meta.get("chat_id") == chat_id)
+
+    def save(self, path: str) -> None:
+        with self._lock:
+            data = {
+                "v": 1,
+                "chats": {str(cid): idx.dump() for cid, idx in self._chats.items()},
+                "global": self.global_index.dump(),
+            }
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp = f"{path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp, path)
+        log.info("[ads] saved near-dup index: %s chats, %s global", len(data["chats"]), len(data["global"]))
+
+    def load(self, path: str) -> None:
+        if not os.path.exists(path):
+            return
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        with self._lock:
+            for cid, rows in (data.get("chats") or {}).items():
+                try:
+                    self._chat(int(cid), True).load(rows)
+                except Exception:
+                    continue
+            self.global_index.load(data.get("global") or [])
+        log.info("[ads] loaded near-dup index: %s chats, %s global", len(self._chats), len(self.global_index))
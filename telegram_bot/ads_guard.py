@@ -12,8 +12,8 @@ import os, time, json, re, logging
 import asyncio
 import psycopg2
 import psycopg2.extras
-import requests
 import itertools
+import aiohttp
 from shared_utils import TG_ANON, MET_ADS_ACTION, count_words, ensure_chat_defaults, is_addressed_to_bot
 from typing import Optional, Callable, List, Tuple, Dict
 from telegram.error import BadRequest
@@ -23,6 +23,28 @@ from telegram.ext import ContextTypes, ApplicationHandlerStop
 from html import escape as _esc
 from shared_utils import build_sender_html_from_msg
 from shared_utils import cfg_get_str, cfg_get_int, cfg_get_float
+from shared_utils import get_config, set_config, chat_cfg_get, chat_cfg_set
+from shared_utils import ChatSettings, load_chat_settings, as_bool
+from shared_utils import LruTtlCache, TtlMap, normalize_text, normalized_text, MET_ADS_VERDICT_CACHE, MET_ADS_VERDICT_CACHE_SIZE
+from shared_utils import MET_ADS_EXAMPLES_CACHE, MET_TIMER_PENDING, MET_TIMER_LAG
+from shared_utils import ADS_VERDICT_KEY, MET_ADS_QUEUE_BACKLOG, MET_ADS_QUEUE_WAIT, MET_ADS_QUEUE_DROPPED
+from shared_utils import MET_WRITE_BEHIND_BATCH, MET_WRITE_BEHIND_FAILED
+from shared_utils import single_flight
+from shared_utils import MET_ADS_BATCH_SIZE, MET_ADS_BATCH_LATENCY, MET_ADS_BATCH_SAVED, MET_ADS_LOCAL, MET_ADS_NEARDUP
+import ads_prefilter
+import ads_fingerprint
+import ads_heuristics
+import ads_domains
+import ads_retrieval
+import ads_pending
+from ads_albums import AlbumAggregator, AlbumBatch
+from ads_queue import ChatModerationQueue
+from write_behind import WriteBehindBuffer
+from concurrent.futures import ThreadPoolExecutor
+from timer_wheel import TimerWheel
+import hashlib
+import uuid
+from flowise_client import post_prediction as flowise_post_prediction
 from messages_service import t, tn
 from tokens.models import pg_conn, ensure_group_settings, grant_weekly_if_needed, spend_one_for_ad
 from datetime import datetime, timezone
@@ -43,6 +65,47 @@ def _float_env(name: str, default: float) -> float:
     except Exception:
         return default
 
+def _parse_verdict_obj(d: dict) -> Optional[dict]:
+    """{label, score, reason} از یک dict خروجی مدل (با پشتیبانی از کلیدهای بزرگ/کوچک و لایهٔ json)."""
+    if not isinstance(d, dict):
+        return None
+    label = d.get("label") or d.get("Label") or d.get("LABEL")
+    score = d.get("score") or d.get("Score") or d.get("SCORE")
+    reason = d.get("reason") or d.get("Reason") or d.get("REASON")
+    if label is None and "json" in d and isinstance(d["json"], dict):
+        jj = d["json"]
+        label = jj.get("label") or jj.get("Label") or jj.get("LABEL")
+        score = jj.get("score") if jj.get("score") is not None else score
+        reason = jj.get("reason") if jj.get("reason") is not None else reason
+        if label is not None:
+            return {"label": label, "score": score, "reason": reason}
+    if label is not None:
+        return {"label": label, "score": score, "reason": reason}
+    return None
+
+
+def _ads_vars(extra_vars: Optional[dict]) -> dict:
+    """سیگنال‌های زمینه‌ای (is_reply / has_contact / ...) برای vars: bool/int → bool، بقیه همان‌طور؛ None حذف."""
+    if not isinstance(extra_vars, dict):
+        return {}
+    return {
+        k: (bool(v) if isinstance(v, (bool, int)) else v)
+        for k, v in extra_vars.items()
+        if v is not None
+    }
+
+
+def _strip_code_fences(s: str) -> str:
+    s = s.strip()
+    if s.startswith("```json"):
+        s = s[7:]
+    elif s.startswith("```"):
+        s = s[3:]
+    if s.endswith("```"):
+        s = s[:-3]
+    return s.strip()
+
+
 try:
     from telegram.constants import ANONYMOUS_ADMIN  # PTB v20+
 except Exception:
@@ -51,6 +114,79 @@ except Exception:
     except Exception:
         ANONYMOUS_ADMIN = 1087968824  # fallback @GroupAnonymousBot
 
+class _AdsBatcher:
+    """
+    micro-batching اختیاری طبقه‌بندی تبلیغات: پیام‌هایی که chatflow، فیوشات و کلیدهای vars یکسان دارند
+    حداکثر window_ms یا max_items جمع می‌شوند و در یک prediction (آرایهٔ متن‌ها) بررسی می‌شوند.
+    هر پیام منتظر future خودش می‌ماند؛ اگر رأی یک آیتم در خروجی دسته نبود، همان آیتم تکی بررسی می‌شود.
+    """
+
+    def __init__(self, guard: "AdsGuard", window_ms: int, max_items: int):
+        self._guard = guard
+        self._window = max(0.0, window_ms / 1000.0)
+        self._max = max(1, int(max_items))
+        self._pending: Dict[tuple, list] = {}
+        self._timers: Dict[tuple, asyncio.TimerHandle] = {}
+        self._tasks: set = set()   # نگه‌داشتن ارجاع تا task وسط کار GC نشود
+
+    async def submit(self, chat_id: int, cfid: str, message_text: str, examples_str: str,
+                     extra_vars: Optional[dict]) -> Tuple[Optional[dict], str]:
+        loop = asyncio.get_running_loop()
+        vars_ = _ads_vars(extra_vars)
+        # فقط پیام‌هایی هم‌دسته می‌شوند که chatflow، فیوشات و مجموعهٔ vars یکسان دارند
+        key = (cfid, hashlib.sha1((examples_str or "").encode("utf-8")).hexdigest(), tuple(sorted(vars_)))
+        fut = loop.create_future()
+        items = self._pending.setdefault(key, [])
+        items.append({"chat_id": chat_id, "text": message_text, "vars": vars_,
+                      "examples": examples_str, "fut": fut, "t0": time.perf_counter()})
+        if len(items) >= self._max:
+            self._flush(key)
+        elif len(items) == 1:
+            self._timers[key] = loop.call_later(self._window, self._flush, key)
+        return await fut
+
+    def _flush(self, key: tuple) -> None:
+        h = self._timers.pop(key, None)
+        if h is not None:
+            h.cancel()
+        items = self._pending.pop(key, None)
+        if items:
+            task = asyncio.get_running_loop().create_task(self._run(key[0], items))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, cfid: str, items: list) -> None:
+        MET_ADS_BATCH_SIZE.observe(len(items))
+        results: Dict[int, dict] = {}
+        if len(items) > 1:
+            try:
+                results = await self._guard._call_flowise_ads_batch(cfid, items)
+                if results:
+                    MET_ADS_BATCH_SAVED.inc(len(items) - 1)
+            except Exception as e:
+                log.warning("[ads] batch of %s failed, falling back to single calls: %s", len(items), e)
+                results = {}
+
+        async def _single(it: dict):
+            return await self._guard._call_flowise_ads(
+                "", message_text=it["text"], examples_str=it["examples"],
+                chat_id=it["chat_id"], extra_vars=it["vars"],
+            )
+
+        missing = [i for i in range(len(items)) if i not in results]
+        singles = await asyncio.gather(*(_single(items[i]) for i in missing), return_exceptions=True)
+        for i, res in zip(missing, singles):
+            results[i] = res if not isinstance(res, BaseException) else (None, f"exception:{res}")
+
+        for i, it in enumerate(items):
+            res = results[i]
+            if not isinstance(res, tuple):
+                res = (res, "")
+            MET_ADS_BATCH_LATENCY.observe(time.perf_counter() - it["t0"])
+            if not it["fut"].done():
+                it["fut"].set_result(res)
+
+
 class AdsGuard:
     """
     ماژول نگهبان تبلیغات:
@@ -112,37 +248,134 @@ class AdsGuard:
         
         # جلوگیری از اسپم هشدار روی پیام‌های ادیت‌شده اما همچنان تبلیغاتی
         self._warn_edit_cooldown_sec_env = cfg_get_int("ads_warn_edit_cooldown_sec", "ADS_WARN_EDIT_COOLDOWN_SEC", 90)
-        self._ad_warn_ts: Dict[Tuple[int, int], float] = {}      # آخرین زمان هشدار برای (chat_id, msg_id)
-        self._ad_warn_msgid: Dict[Tuple[int, int], int] = {}     # پیام هشدار بات برای ویرایش/جمع کردن بعدی
-        
-        # prune memory for warn-dedup maps
-        if len(self._ad_warn_ts) > 5000:
-            cutoff = time.time() - max(60, self._warn_edit_cooldown_sec_env)
-            self._ad_warn_ts = {k: ts for k, ts in self._ad_warn_ts.items() if ts >= cutoff}
-            self._ad_warn_msgid = {k: mid for k, mid in self._ad_warn_msgid.items() if k in self._ad_warn_ts}
+        # همهٔ state درون‌حافظه‌ای با TtlMap (TTL + سقف اندازه)؛ سقف پیش‌فرض هر نگاشت: ADS_STATE_MAX
+        _state_max = _int_env("ADS_STATE_MAX", 20000)
+        _state_ttl = _int_env("ADS_STATE_TTL_SEC", 86400)   # برای نگاشت‌هایی که عمرشان به تایمر/کاربر بستگی دارد
+        self._state_max = _state_max
+        self._state_ttl = _state_ttl
 
+        # TTL این دو هنگام set برابر cooldown همان گروه است
+        self._ad_warn_ts = TtlMap("ads_warn_ts", max(60, self._warn_edit_cooldown_sec_env), _state_max)      # آخرین زمان هشدار برای (chat_id, msg_id)
+        self._ad_warn_msgid = TtlMap("ads_warn_msgid", max(60, self._warn_edit_cooldown_sec_env), _state_max)  # پیام هشدار بات برای ویرایش/جمع کردن بعدی
 
         # آخرین‌بار اخطار «کپشن کوتاه» به ازای (chat_id, msg_id)
-        self._short_warn_ts: Dict[Tuple[int, int], float] = {}
+        self._short_warn_ts = TtlMap("ads_short_warn_ts", max(60, self._short_warn_cooldown_sec_env), _state_max)
         # آخرین‌بار re-open برای (chat_id, msg_id)
-        self._reoffend_ts: Dict[Tuple[int, int], float] = {}
+        self._reoffend_ts = TtlMap("ads_reoffend_ts", max(60, self._reoffend_cooldown_sec), _state_max)
 
         # تنظیم اختیاری: رفتار پیام اخطار بعد از موفقیت (ویرایش به «✅» و حذف خودکار)
         self._warn_success_action_env = (cfg_get_str("ads_warn_success_action", "ADS_WARN_SUCCESS_ACTION", "edit") or "edit").strip().lower()
         self._warn_success_autodel_sec_env = cfg_get_int("ads_warn_success_autodel_sec", "ADS_WARN_SUCCESS_AUTODEL_SEC", 0)
 
         
+        # کش رأی مدل (label/score/reason) برای متن‌های تکراری در موج‌های اسپم؛ TTL=0 → خاموش
+        self._verdict_cache_ttl = cfg_get_int("ads_verdict_cache_ttl_sec", "ADS_VERDICT_CACHE_TTL_SEC", 1800)
+        self._verdict_cache = LruTtlCache(
+            cfg_get_int("ads_verdict_cache_max", "ADS_VERDICT_CACHE_MAX", 5000),
+            max(0, self._verdict_cache_ttl),
+            MET_ADS_VERDICT_CACHE_SIZE,
+        )
+
+        # کش نمونه‌های few-shot هر گروه (ردیف‌ها + examples_str آماده)؛ کلید شامل نسخهٔ نمونه‌های گروه است
+        # و نسخه با add_example / پاک‌کردن نمونه‌ها بالا می‌رود. TTL فقط برای همگام‌ماندن چند رپلیکا است.
+        # عمر نسخه از TTL کش بیشتر است تا صفرشدن نسخهٔ منقضی‌شده هرگز به ورودی کهنهٔ کش نرسد
+        _examples_ttl = _int_env("ADS_EXAMPLES_CACHE_TTL_SEC", 300)
+        self._examples_gen = TtlMap("ads_examples_gen", max(_state_ttl, 2 * _examples_ttl), _state_max)
+        self._examples_cache = LruTtlCache(
+            _int_env("ADS_EXAMPLES_CACHE_MAX", 2000),
+            _examples_ttl,
+        )
+
+        # micro-batching اختیاری طبقه‌بندی (per-chat: ads_batch)
+        self._batch_env = (cfg_get_str("ads_batch", "ADS_BATCH", "off") or "off").strip().lower()
+        self._batcher = _AdsBatcher(
+            self,
+            cfg_get_int("ads_batch_window_ms", "ADS_BATCH_WINDOW_MS", 300),
+            cfg_get_int("ads_batch_max", "ADS_BATCH_MAX", 8),
+        )
+
+        # پیش‌طبقه‌بند محلی (NumPy): فقط بین دو cutoff به Flowise می‌رویم (per-chat: ads_local_*)
+        self._local_model_env = (cfg_get_str("ads_local_model", "ADS_LOCAL_MODEL", "off") or "off").strip().lower()
+        self._local_low_env = cfg_get_float("ads_local_low", "ADS_LOCAL_LOW", 0.05)
+        self._local_high_env = cfg_get_float("ads_local_high", "ADS_LOCAL_HIGH", 0.95)
+        self._prefilter = ads_prefilter.AdsPrefilter(self._local_training_data) if ads_prefilter.available() else None
+
+        # ایندکس near-duplicate متن‌های AD (SimHash)؛ ذخیره در shutdown و بارگذاری در startup
+        self._neardup_env = (cfg_get_str("ads_neardup", "ADS_NEARDUP", "on") or "on").strip().lower()
+        self._neardup_global_env = (cfg_get_str("ads_neardup_global", "ADS_NEARDUP_GLOBAL", "off") or "off").strip().lower()
+        self._neardup_max_dist_env = cfg_get_int("ads_neardup_max_dist", "ADS_NEARDUP_MAX_DIST", 3)
+        self._neardup_min_len = _int_env("ADS_NEARDUP_MIN_LEN", 24)
+        self._neardup_path = os.getenv("ADS_NEARDUP_PATH", "data/ads_neardup.json")
+        self._neardup = ads_fingerprint.AdFingerprints(
+            _int_env("ADS_NEARDUP_PER_CHAT_MAX", 500),
+            _int_env("ADS_NEARDUP_GLOBAL_MAX", 5000),
+        )
+
+        # انتخاب few-shot بر اساس شباهت (ads_examples_select=similar)؛ ایندکس درون‌حافظه‌ای هر گروه
+        self._retrieval_max_examples = _int_env("ADS_RETRIEVAL_MAX_EXAMPLES", 2000)
+        self._retriever = (
+            ads_retrieval.ExampleRetriever(self._all_examples, normalize_text) if ads_retrieval.available() else None
+        )
+
         # وضعیت‌های موقت برای مدیای بدون کپشن: key=(chat_id, msg_id)
-        self._pending_nocap: Dict[tuple, dict] = {}
-        self._pending_tasks: Dict[tuple, asyncio.Task] = {}
+        self._pending_nocap = TtlMap("ads_pending_nocap", _state_ttl, _state_max)
+        # مهلت حذف هر pending در یک چرخ زمانی مشترک (یک جاروبگر به‌جای یک task خوابیده برای هر پیام)
+        self._nocap_timers = TimerWheel(
+            "ads_nocap",
+            self._on_nocap_due,
+            pending_gauge=MET_TIMER_PENDING,
+            lag_histogram=MET_TIMER_LAG,
+        )
+        # نسخهٔ پایدار همین pendingها در ads_pending_actions (write-through، بازیابی در startup، sweep بین رپلیکاها)
+        # نوشتن‌ها در یک thread اختصاصی و به ترتیب انجام می‌شوند تا drop هیچ‌وقت از put جلو نزند
+        self._pending_store = ads_pending.PendingStore(get_db_conn)
+        self._pending_io = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ads-pending")
+        self.pending_sweep_sec = max(5, _int_env("ADS_PENDING_SWEEP_SEC", 30))
+        self._pending_lease_sec = max(30, _int_env("ADS_PENDING_LEASE_SEC", 120))
+        self._pending_batch = max(1, _int_env("ADS_PENDING_BATCH", 200))
+
+        # تجمیع آلبوم: اعضای هم‌mgid تا بازهٔ سکوت بافر و پایپ‌لاین یک‌بار برای کل آلبوم اجرا می‌شود
+        # ADS_ALBUM_MAX_WAIT_MS=0 → رفتار قدیمی (هر عضو جدا)
+        _album_quiet_ms = _int_env("ADS_ALBUM_QUIET_MS", 700)
+        _album_max_wait_ms = _int_env("ADS_ALBUM_MAX_WAIT_MS", 2500)
+        self._albums = (
+            AlbumAggregator(self._flush_album, _album_quiet_ms / 1000.0, _album_max_wait_ms / 1000.0)
+            if _album_max_wait_ms > 0 else None
+        )
+
+        # صف نظارت هر گروه: پیام‌های داخل min_gap صف/دسته می‌شوند به‌جای رد شدن؛ گروه‌ها موازی تا سقف سراسری
+        # ADS_CHAT_QUEUE_MAX=0 → رفتار قدیمی (رد پیام‌های داخل min_gap)
+        _chat_queue_max = _int_env("ADS_CHAT_QUEUE_MAX", 50)
+        self._modq = (
+            ChatModerationQueue(
+                _chat_queue_max,
+                _int_env("ADS_MODERATION_CONCURRENCY", 16),
+                _int_env("ADS_CHAT_QUEUE_BATCH", 8),
+                backlog_gauge=MET_ADS_QUEUE_BACKLOG,
+                wait_histogram=MET_ADS_QUEUE_WAIT,
+                dropped_counter=MET_ADS_QUEUE_DROPPED,
+            )
+            if _chat_queue_max > 0 else None
+        )
+
+        # ثبت ads_decisions به‌صورت write-behind: دسته‌ای با execute_values (یک commit به ازای هر flush)
+        self._decisions = WriteBehindBuffer(
+            "ads_decisions",
+            self._save_decisions,
+            flush_ms=_int_env("ADS_DECISIONS_FLUSH_MS", 500),
+            batch=_int_env("ADS_DECISIONS_BATCH", 200),
+            max_pending=_int_env("ADS_DECISIONS_MAX_PENDING", 5000),
+            batch_histogram=MET_WRITE_BEHIND_BATCH,
+            failed_counter=MET_WRITE_BEHIND_FAILED,
+        )
 
         # نگاشت پیام اخطار → کلید پیامِ درانتظار (برای پشتیبانی ریپلای روی اخطار)
         # (chat_id, warn_msg_id) -> (chat_id, message_id)
-        self._pending_nocap_by_warn: Dict[Tuple[int, int], tuple] = {}
+        self._pending_nocap_by_warn = TtlMap("ads_pending_by_warn", _state_ttl, _state_max)
         
         # نگهداری موقت «هشدار اینلاین در انتظار بستن» از مسیر ادیت کپشن
         # کلید: (chat_id, message_id) → مقدار: (warn_msg_id, by_user_id|None)
-        self._deferred_warn_by_msg: Dict[Tuple[int, int], Tuple[int, int | None]] = {}
+        self._deferred_warn_by_msg = TtlMap("ads_deferred_warn", _state_ttl, _state_max)
 
         # Flowise timeouts (tuple: connect, read)
         self._flowise_connect_timeout = _int_env("FLOWISE_CONNECT_TIMEOUT", 5)
@@ -155,86 +388,218 @@ class AdsGuard:
 
 
         # Rate-limit per chat
-        self._last_run_ts_per_chat: Dict[int, float] = {}
+        self._last_run_ts_per_chat = TtlMap("ads_last_run", max(60, self._min_gap_sec), _state_max)
 
         # کش ادمین‌های گروه (۵ دقیقه)
-        self._admins_cache: Dict[int, Tuple[float, set]] = {}
         self._admins_ttl_sec: int = 300
+        self._admins_cache = TtlMap("ads_admins", self._admins_ttl_sec, _int_env("ADS_ADMINS_CACHE_MAX", 5000))
         # cache for media-group captions: key=(chat_id, media_group_id) -> (ts, caption)
-        self._mg_caption_cache: Dict[tuple, Tuple[float, str]] = {}
         self._mg_caption_ttl_sec: int = 172800  # 48 ساعت ttl
+        self._mg_caption_cache = TtlMap("ads_mg_caption", self._mg_caption_ttl_sec, _state_max)
 
         # ضدتکرار پیام/آلبوم با TTL
-        self._seen_messages: Dict[Tuple[int, int], float] = {}
-        self._seen_media_groups: Dict[Tuple[int, str], float] = {}
+        self._dedup_ttl_sec: int = 600  # 10 دقیقه
+        self._seen_messages = TtlMap("ads_seen_messages", self._dedup_ttl_sec, _state_max)
+        self._seen_media_groups = TtlMap("ads_seen_media_groups", self._dedup_ttl_sec, _state_max)
 
         # --- فقط برای «آلبومِ بدون کپشن»: یکبار هشدار به‌ازای هر media_group
-        self._seen_mg_nocap: Dict[Tuple[int, str], float] = {}  # (chat_id, mgid) -> ts
+        self._seen_mg_nocap = TtlMap("ads_seen_mg_nocap", self._dedup_ttl_sec, _state_max)  # (chat_id, mgid) -> ts
         # نگاشت آلبوم→کلید پیام درانتظار (تا اگر کاربر به هر آیتمی ریپلای داد، همان درانتظار لغو شود)
-        self._pending_nocap_by_mgid: Dict[Tuple[int, str], tuple] = {}  # (chat_id, mgid) -> (chat_id, message_id)
-
-        self._dedup_ttl_sec: int = 600  # 10 دقیقه
+        self._pending_nocap_by_mgid = TtlMap("ads_pending_by_mgid", _state_ttl, _state_max)  # (chat_id, mgid) -> (chat_id, message_id)
 
 
 
         # کش ساده whitelist
-        self._wl_users_cache: Dict[Tuple[int, int], bool] = {}
-        self._wl_domains_cache: Dict[Tuple[int, str], bool] = {}
+        self._wl_users_cache = TtlMap("ads_wl_users", _int_env("ADS_WL_USERS_TTL_SEC", 600), _state_max)
+        # whitelist دامنه‌ها: یک DomainTrie برای هر گروه (TTL فقط برای همگام‌ماندن چند رپلیکا)
+        self._wl_tries = LruTtlCache(
+            _int_env("ADS_WL_DOMAINS_CACHE_MAX", 5000),
+            _int_env("ADS_WL_DOMAINS_TTL_SEC", 300),
+        )
 
         self._mute_hours_env = cfg_get_int("ads_mute_hours", "ADS_MUTE_HOURS", 100)
 
         # لیست پیام‌های هر آلبوم در حال انتظار (برای حذف گروهی)
-        self._pending_album_msgs: Dict[Tuple[int, str], List[int]] = {}
+        self._pending_album_msgs = TtlMap("ads_pending_albums", _state_ttl, _state_max)
         
         # نگهداری موقت شناسه‌های آلبوم‌های موفق (برای دکمه سکوت ادمین)
-        self._successful_albums: Dict[Tuple[int, int], Dict] = {}
         self._successful_albums_ttl_sec: int = 1800 # 30 دقیقه
+        self._successful_albums = TtlMap("ads_successful_albums", self._successful_albums_ttl_sec, _state_max)
         
     # ---------- bot_config (DB) ----------
     
     def chat_get_config(self, chat_id: int, key: str) -> Optional[str]:
-        try:
-            with self.get_db_conn() as conn, conn.cursor() as cur:
-                cur.execute(
-                    "SELECT value FROM chat_config WHERE chat_id=%s AND key=%s",
-                    (chat_id, key),
-                )
-                row = cur.fetchone()
-                return row[0] if row else None
-        except Exception:
-            return None
+        # از کش مشترک shared_utils (read-through + NOTIFY) استفاده می‌کنیم
+        return chat_cfg_get(chat_id, key)
 
 
     def chat_set_config(self, chat_id: int, key: str, value: str):
-        try:
-            with self.get_db_conn() as conn, conn.cursor() as cur:
-                cur.execute("""
-                    INSERT INTO chat_config (chat_id, key, value)
-                    VALUES (%s, %s, %s)
-                    ON CONFLICT (chat_id, key)
-                    DO UPDATE SET value = EXCLUDED.value, updated_at = NOW()
-                """, (chat_id, key, value))
-                conn.commit()
-        except Exception:
-            pass
+        chat_cfg_set(chat_id, key, value)
     
-    def chat_autoclean_sec(self, chat_id: int) -> int:
+    def chat_settings(self, chat_id) -> ChatSettings:
+        """اسنپ‌شات تنظیمات گروه؛ getterهای chat_* هم chat_id و هم ChatSettings را می‌پذیرند."""
+        return load_chat_settings(chat_id)
+
+    def chat_autoclean_sec(self, chat_id) -> int:
         """Delay for auto-delete in seconds; 0/None means disabled. Fallback: ENV ADS_AUTOCLEAN_SEC."""
-        v = self.chat_get_config(chat_id, "ads_autoclean_sec")
-        try:
-            return int(v) if v is not None else int(getattr(self, "_autoclean_sec_env", 120))
-        except Exception:
-            return int(getattr(self, "_autoclean_sec_env", 120))
+        return self.chat_settings(chat_id).get_int("ads_autoclean_sec", int(getattr(self, "_autoclean_sec_env", 120)))
+
+
+    def chat_mute_hours(self, chat_id) -> int:
+        return self.chat_settings(chat_id).get_int("ads_mute_hours", self._mute_hours_env)
 
 
-    def chat_mute_hours(self, chat_id: int) -> int:
-        v = self.chat_get_config(chat_id, "ads_mute_hours")
+
+    async def _delete_many(self, bot, chat_id: int, message_ids: List[int]) -> None:
+        """حذف دسته‌ای (حداکثر ۱۰۰ شناسه در هر delete_messages)؛ در خطا تک‌به‌تک."""
+        ids = list(dict.fromkeys(int(m) for m in message_ids if m))
+        for i in range(0, len(ids), 100):
+            chunk = ids[i:i + 100]
+            try:
+                await bot.delete_messages(chat_id=chat_id, message_ids=chunk)
+            except Exception as e:
+                log.warning("[ads] bulk delete failed in chat %s (%s ids): %s; falling back to single delete", chat_id, len(chunk), e)
+                for _mid in chunk:
+                    try:
+                        await bot.delete_message(chat_id=chat_id, message_id=_mid)
+                    except Exception:
+                        pass
+
+    # ---------- pending no-caption: تایمر محلی + ردیف پایدار ----------
+    def _pending_write(self, fn, *args) -> None:
+        """write-through به ads_pending_actions (بدون انتظار؛ ترتیب با executor تک‌نخی حفظ می‌شود)."""
+        def _done(fut):
+            if not fut.cancelled() and fut.exception() is not None:
+                log.warning("[ads] pending-actions write failed: %s", fut.exception())
         try:
-            return int(v) if v is not None else self._mute_hours_env
-        except Exception:
-            return self._mute_hours_env
+            self._pending_io.submit(fn, *args).add_done_callback(_done)
+        except RuntimeError:
+            pass   # executor بعد از shutdown
+
+    async def _pending_call(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._pending_io, fn, *args)
+
+    def _arm_nocap(self, key: tuple, kind: str, grace: int, bot) -> None:
+        """زمان‌بندی حذف pending (kind: nocap | reopen) در TimerWheel و ثبت پایدار آن."""
+        rec = self._pending_nocap.get(key) or {}
+        self._nocap_timers.schedule(key, grace, {"bot": bot, "kind": kind})
+        self._pending_write(
+            self._pending_store.put, key[0], key[1], kind, grace, rec.get("mgid"), rec.get("warn_msg_id"), rec
+        )
+
+    def _disarm_nocap(self, key: tuple, mgid: Optional[str] = None) -> None:
+        """لغو حذف pending (کپشن اضافه شد)."""
+        self._nocap_timers.cancel(key)
+        self._pending_write(self._pending_store.drop, key[0], key[1], mgid)
 
+    def _nocap_delete_ids(self, key: tuple, kind: str, rec: dict, album_ids: Optional[List[int]] = None) -> List[int]:
+        """
+        پاک‌سازی state حافظهٔ یک pending و برگرداندن شناسه‌هایی که باید حذف شوند:
+        آلبوم → همهٔ پیام‌های آلبوم، تکی → خود پیام، به‌علاوهٔ پیام اخطار (جز در re-open).
+        """
+        chat_id, msg_id = key
+        self._pending_nocap.pop(key, None)
+        self._nocap_timers.cancel(key)
+        mgid_val = rec.get("mgid")
+        warn_mid = rec.get("warn_msg_id")
+        mem_album = self._pending_album_msgs.pop((chat_id, mgid_val), None) if mgid_val else None
+        if mgid_val:
+            self._pending_nocap_by_mgid.pop((chat_id, mgid_val), None)
+        if warn_mid:
+            self._pending_nocap_by_warn.pop((chat_id, int(warn_mid)), None)
+        if kind == "reopen":
+            return [msg_id]
+        ids: List[int] = []
+        if mgid_val:
+            ids.extend(mem_album or album_ids or [])
+        else:
+            ids.append(msg_id)
+        if warn_mid:
+            ids.append(int(warn_mid))
+        return ids
 
+    async def _on_nocap_due(self, batch) -> None:
+        """
+        مهلت‌های سررسیدهٔ مدیای بدون کپشن (از TimerWheel).
+        اول ردیف‌های پایدار همین کلیدها claim می‌شوند (اگر worker دیگری برشان داشته، این‌جا فقط state پاک می‌شود
+        و اگر DB در دسترس نبود یا ردیفی ثبت نشده بود، مثل قبل محلی اجرا می‌شود)؛
+        سپس حذف‌ها به ازای هر گروه در یک درخواست جمع می‌شوند.
+        """
+        due = [(key, payload) for key, payload in batch if key in self._pending_nocap]
+        if not due:
+            return
+        try:
+            rows, busy = await self._pending_call(
+                self._pending_store.claim_keys, [k for k, _ in due], self._pending_lease_sec
+            )
+        except Exception as e:
+            log.warning("[ads] pending-actions claim failed, acting on local state: %s", e)
+            rows, busy = [], set()
+        claimed = {(r["chat_id"], r["message_id"]): r for r in rows}
+
+        by_chat: Dict[int, Tuple[object, List[int]]] = {}
+        done = []
+        for key, payload in due:
+            rec = self._pending_nocap.get(key)
+            if not rec:
+                continue   # در این فاصله کپشن گرفته یا لغو شده
+            row = claimed.get(key)
+            ids = self._nocap_delete_ids(key, payload["kind"], rec, (row or {}).get("album_ids"))
+            if key in busy:
+                continue   # ردیف در اختیار worker دیگری است؛ همان‌جا اجرا می‌شود
+            by_chat.setdefault(key[0], (payload["bot"], []))[1].extend(ids)
+            if row is not None:
+                done.append((row["chat_id"], row["message_id"], row["kind"], row["mgid"]))
+        for chat_id, (bot, ids) in by_chat.items():
+            await self._delete_many(bot, chat_id, ids)
+        if done:
+            self._pending_write(self._pending_store.finish, done)
+
+    async def restore_pending(self, bot) -> int:
+        """
+        بازسازی pendingهای درانتظار از ads_pending_actions بعد از ری‌استارت:
+        state حافظه (برای ویرایش/ریپلای کپشن) و تایمرها؛ سررسیده‌ها بلافاصله اجرا می‌شوند.
+        """
+        rows = await self._pending_call(self._pending_store.load, self._state_max)
+        for row in rows:
+            key = (row["chat_id"], row["message_id"])
+            rec = dict(row["data"] or {})
+            rec["mgid"] = row["mgid"]
+            rec["warn_msg_id"] = row["warn_msg_id"]
+            self._pending_nocap[key] = rec
+            if row["warn_msg_id"]:
+                self._pending_nocap_by_warn[(key[0], row["warn_msg_id"])] = key
+            if row["mgid"]:
+                _mk = (key[0], row["mgid"])
+                self._pending_nocap_by_mgid[_mk] = key
+                self._seen_mg_nocap[_mk] = time.time()
+                if row["album_ids"]:
+                    self._pending_album_msgs[_mk] = list(row["album_ids"])
+            self._nocap_timers.schedule(key, max(0.0, row["remaining_sec"]), {"bot": bot, "kind": row["kind"]})
+        if rows:
+            log.info("[ads] restored %s pending no-caption action(s)", len(rows))
+        return len(rows)
+
+    async def sweep_pending(self, bot) -> int:
+        """
+        claim دسته‌ای ردیف‌های سررسیدهٔ ads_pending_actions (FOR UPDATE SKIP LOCKED) و اجرای آن‌ها:
+        برای pendingهای رپلیکای دیگر یا workerی که وسط کار از کار افتاده.
+        """
+        rows = await self._pending_call(self._pending_store.claim_due, self._pending_batch, self._pending_lease_sec)
+        by_chat: Dict[int, List[int]] = {}
+        done = []
+        for row in rows:
+            key = (row["chat_id"], row["message_id"])
+            if row["kind"] in ads_pending.ACTION_KINDS:
+                rec = self._pending_nocap.get(key) or {"mgid": row["mgid"], "warn_msg_id": row["warn_msg_id"]}
+                ids = self._nocap_delete_ids(key, row["kind"], rec, row["album_ids"])
+                by_chat.setdefault(key[0], []).extend(ids)
+            done.append((row["chat_id"], row["message_id"], row["kind"], row["mgid"]))   # album_member یتیم: فقط پاک‌سازی
+        for chat_id, ids in by_chat.items():
+            await self._delete_many(bot, chat_id, ids)
+        if done:
+            self._pending_write(self._pending_store.finish, done)
+        return len(rows)
 
     async def _delete_after(self, bot, chat_id: int, message_id: int, delay: int):
         import asyncio
@@ -306,24 +671,10 @@ class AdsGuard:
 
     
     def _get_config(self, key: str) -> Optional[str]:
-        try:
-            with self.get_db_conn() as conn, conn.cursor() as cur:
-                cur.execute("SELECT value FROM bot_config WHERE key=%s", (key,))
-                r = cur.fetchone()
-                return r[0] if r else None
-        except Exception:
-            return None
+        return get_config(key)
 
     def _set_config(self, key: str, value: str):
-        try:
-            with self.get_db_conn() as conn, conn.cursor() as cur:
-                cur.execute("""
-                    INSERT INTO bot_config (key, value) VALUES (%s, %s)
-                    ON CONFLICT (key) DO UPDATE SET value=EXCLUDED.value, updated_at=NOW()
-                """, (key, value))
-                conn.commit()
-        except Exception:
-            pass
+        set_config(key, value)
 
     # ---------- Runtime config ----------
     def feature_on(self) -> bool:
@@ -362,169 +713,101 @@ class AdsGuard:
             return self._min_gap_sec
     
     # ---------- Per-Chat runtime config ----------
-    def chat_feature_on(self, chat_id: int) -> bool:
-        v = self.chat_get_config(chat_id, "ads_feature")
-        if v is None:
-            v = self._feature_env
-        return str(v).lower() in ("1","true","on","yes")
+    # همه از یک اسنپ‌شات (ChatSettings) می‌خوانند؛ پارامتر می‌تواند chat_id یا خود اسنپ‌شات باشد.
+    def chat_feature_on(self, chat_id) -> bool:
+        return self.chat_settings(chat_id).get_bool("ads_feature", as_bool(self._feature_env))
 
-    def chat_chatflow_id(self, chat_id: int) -> str:
-        return self.chat_get_config(chat_id, "ads_chatflow_id") or self._chatflow_id_env
+    def chat_chatflow_id(self, chat_id) -> str:
+        return self.chat_settings(chat_id).get("ads_chatflow_id") or self._chatflow_id_env
 
-    def chat_threshold(self, chat_id: int) -> float:
-        v = self.chat_get_config(chat_id, "ads_threshold")
-        try:
-            return float(v) if v is not None else self._threshold_env
-        except Exception:
-            return self._threshold_env
+    def chat_threshold(self, chat_id) -> float:
+        return self.chat_settings(chat_id).get_float("ads_threshold", self._threshold_env)
 
-    def chat_max_fewshots(self, chat_id: int) -> int:
-        v = self.chat_get_config(chat_id, "ads_max_fewshots")
-        try:
-            return int(v) if v is not None else self._max_fewshots_env
-        except Exception:
-            return self._max_fewshots_env
+    def chat_max_fewshots(self, chat_id) -> int:
+        return self.chat_settings(chat_id).get_int("ads_max_fewshots", self._max_fewshots_env)
     
-    def chat_examples_hardcap(self, chat_id: int) -> int:
+    def chat_examples_hardcap(self, chat_id) -> int:
         """
         سقف تعداد نمونه‌های ذخیره‌شده برای هر گروه (DB-first → ENV → default=50)
         """
-        v = self.chat_get_config(chat_id, "ads_examples_hardcap")
-        try:
-            return int(v) if v is not None else self._examples_hardcap_env
-        except Exception:
-            return self._examples_hardcap_env
+        return self.chat_settings(chat_id).get_int("ads_examples_hardcap", self._examples_hardcap_env)
 
-    def chat_examples_select_mode(self, chat_id: int) -> str:
+    def chat_examples_select_mode(self, chat_id) -> str:
         """
         انتخاب روش برداشتن few-shots:
         latest   → فقط جدیدترین‌ها (رفتار فعلی)
         balanced → بالانس AD/NOT_AD تا حد ممکن، سپس مرتب‌سازی کلی برحسب id DESC
+        similar  → شبیه‌ترین AD/NOT_AD به همین پیام (cosine روی n-gramهای کاراکتری؛ نیازمند NumPy)
         """
-        v = self.chat_get_config(chat_id, "ads_examples_select")
-        v = (v or "").strip().lower() if v is not None else "latest"
-        return v if v in ("latest", "balanced") else "latest"
+        v = (self.chat_settings(chat_id).get("ads_examples_select") or "latest").strip().lower()
+        return v if v in ("latest", "balanced", "similar") else "latest"
 
 
-    def chat_action(self, chat_id: int) -> str:
-        v = self.chat_get_config(chat_id, "ads_action") or self._action_env
+    def chat_action(self, chat_id) -> str:
+        v = self.chat_settings(chat_id).get("ads_action") or self._action_env
         v = (v or "").strip().lower()
         return v if v in ("warn","delete","none") else "none"
 
-    def chat_min_gap_sec(self, chat_id: int) -> int:
-        v = self.chat_get_config(chat_id, "ads_min_gap_sec")
-        try:
-            return int(v) if v is not None else self._min_gap_sec
-        except Exception:
-            return self._min_gap_sec
+    def chat_min_gap_sec(self, chat_id) -> int:
+        return self.chat_settings(chat_id).get_int("ads_min_gap_sec", self._min_gap_sec)
     
     
-    def chat_reply_exempt(self, chat_id: int) -> bool:
-        v = self.chat_get_config(chat_id, "ads_reply_exempt")
-        if v is None:
-            v = self._reply_exempt_env
-        return str(v).lower() in ("1","true","on","yes")
+    def chat_reply_exempt(self, chat_id) -> bool:
+        return self.chat_settings(chat_id).get_bool("ads_reply_exempt", as_bool(self._reply_exempt_env))
 
-    def chat_reply_exempt_maxlen(self, chat_id: int) -> int:
-        v = self.chat_get_config(chat_id, "ads_reply_exempt_maxlen")
-        try:
-            return int(v) if v is not None else self._reply_exempt_maxlen_env
-        except Exception:
-            return self._reply_exempt_maxlen_env
+    def chat_reply_exempt_maxlen(self, chat_id) -> int:
+        return self.chat_settings(chat_id).get_int("ads_reply_exempt_maxlen", self._reply_exempt_maxlen_env)
 
-    def chat_reply_exempt_allow_contact(self, chat_id: int) -> bool:
-        v = self.chat_get_config(chat_id, "ads_reply_exempt_allow_contact")
-        if v is None:
-            v = self._reply_exempt_allow_contact_env
-        return str(v).lower() in ("1","true","on","yes")
+    def chat_reply_exempt_allow_contact(self, chat_id) -> bool:
+        return self.chat_settings(chat_id).get_bool("ads_reply_exempt_allow_contact", as_bool(self._reply_exempt_allow_contact_env))
 
-    def chat_reply_exempt_contact_maxlen(self, chat_id: int) -> int:
-        v = self.chat_get_config(chat_id, "ads_reply_exempt_contact_maxlen")
-        try:
-            return int(v) if v is not None else self._reply_exempt_contact_maxlen_env
-        except Exception:
-            return self._reply_exempt_contact_maxlen_env
+    def chat_reply_exempt_contact_maxlen(self, chat_id) -> int:
+        return self.chat_settings(chat_id).get_int("ads_reply_exempt_contact_maxlen", self._reply_exempt_contact_maxlen_env)
 
     
-    def chat_caption_min_len(self, chat_id: int) -> int:
-        v = self.chat_get_config(chat_id, "ads_caption_min_len")
-        try:
-            return int(v) if v is not None else self._caption_min_len_env
-        except Exception:
-            return self._caption_min_len_env
+    def chat_caption_min_len(self, chat_id) -> int:
+        return self.chat_settings(chat_id).get_int("ads_caption_min_len", self._caption_min_len_env)
     
-    def chat_nocap_grace_sec(self, chat_id: int) -> int:
-        v = self.chat_get_config(chat_id, "ads_nocap_grace_sec")
-        try:
-            return int(v) if v is not None else self._nocap_grace_sec_env
-        except Exception:
-            return self._nocap_grace_sec_env
+    def chat_nocap_grace_sec(self, chat_id) -> int:
+        return self.chat_settings(chat_id).get_int("ads_nocap_grace_sec", self._nocap_grace_sec_env)
     
-    def chat_allow_forward_entities(self, chat_id: int) -> bool:
-        v = self.chat_get_config(chat_id, "ads_allow_forward_entities")
-        if v is None:
-            v = self._allow_forward_entities_env
-        return str(v).lower() in ("1", "true", "on", "yes")
+    def chat_allow_forward_entities(self, chat_id) -> bool:
+        return self.chat_settings(chat_id).get_bool("ads_allow_forward_entities", as_bool(self._allow_forward_entities_env))
     
-    def chat_forward_caption_min_len(self, chat_id: int) -> int:
-        v = self.chat_get_config(chat_id, "ads_forward_caption_min_len")
-        try:
-            return int(v) if v is not None else self._forward_caption_min_len_env
-        except Exception:
-            return self._forward_caption_min_len_env
+    def chat_forward_caption_min_len(self, chat_id) -> int:
+        return self.chat_settings(chat_id).get_int("ads_forward_caption_min_len", self._forward_caption_min_len_env)
     
-    def chat_forward_grace_sec(self, chat_id: int) -> int:
-        v = self.chat_get_config(chat_id, "ads_forward_grace_sec")
-        try:
-            return int(v) if v is not None else self._forward_grace_sec_env
-        except Exception:
-            return self._forward_grace_sec_env
+    def chat_forward_grace_sec(self, chat_id) -> int:
+        return self.chat_settings(chat_id).get_int("ads_forward_grace_sec", self._forward_grace_sec_env)
     
-    def chat_allow_reply_as_caption(self, chat_id: int) -> bool:
-        v = self.chat_get_config(chat_id, "ads_allow_reply_as_caption")
-        if v is None:
-            v = self._allow_reply_as_caption_env
-        return str(v).lower() in ("1", "true", "on", "yes")
+    def chat_allow_reply_as_caption(self, chat_id) -> bool:
+        return self.chat_settings(chat_id).get_bool("ads_allow_reply_as_caption", as_bool(self._allow_reply_as_caption_env))
     
     
-    def chat_short_warn_cooldown_sec(self, chat_id: int) -> int:
-        v = self.chat_get_config(chat_id, "ads_short_warn_cooldown_sec")
-        try: return int(v) if v is not None else self._short_warn_cooldown_sec_env
-        except Exception: return self._short_warn_cooldown_sec_env
-
-    def chat_reoffend_grace_sec(self, chat_id: int) -> int:
-        v = self.chat_get_config(chat_id, "ads_reoffend_grace_sec")
-        try: return int(v) if v is not None else self._reoffend_grace_sec_env
-        except Exception: return self._reoffend_grace_sec_env
-
-    def chat_reoffend_cooldown_sec(self, chat_id: int) -> int:
-        v = self.chat_get_config(chat_id, "ads_reoffend_cooldown_sec")
-        try: return int(v) if v is not None else self._reoffend_cooldown_sec
-        except Exception: return self._reoffend_cooldown_sec
+    def chat_short_warn_cooldown_sec(self, chat_id) -> int:
+        return self.chat_settings(chat_id).get_int("ads_short_warn_cooldown_sec", self._short_warn_cooldown_sec_env)
+
+    def chat_reoffend_grace_sec(self, chat_id) -> int:
+        return self.chat_settings(chat_id).get_int("ads_reoffend_grace_sec", self._reoffend_grace_sec_env)
+
+    def chat_reoffend_cooldown_sec(self, chat_id) -> int:
+        return self.chat_settings(chat_id).get_int("ads_reoffend_cooldown_sec", self._reoffend_cooldown_sec)
     
     
     
-    def chat_warn_edit_cooldown_sec(self, chat_id: int) -> int:
-        v = self.chat_get_config(chat_id, "ads_warn_edit_cooldown_sec")
-        try:
-            return int(v) if v is not None else self._warn_edit_cooldown_sec_env
-        except Exception:
-            return self._warn_edit_cooldown_sec_env
+    def chat_warn_edit_cooldown_sec(self, chat_id) -> int:
+        return self.chat_settings(chat_id).get_int("ads_warn_edit_cooldown_sec", self._warn_edit_cooldown_sec_env)
 
     
     
     
-    def chat_warn_success_action(self, chat_id: int) -> str:
-        v = self.chat_get_config(chat_id, "ads_warn_success_action") or self._warn_success_action_env
+    def chat_warn_success_action(self, chat_id) -> str:
+        v = self.chat_settings(chat_id).get("ads_warn_success_action") or self._warn_success_action_env
         v = (v or "").strip().lower()
         return v if v in ("edit", "delete") else "edit"
 
-    def chat_warn_success_autodel_sec(self, chat_id: int) -> int:
-        v = self.chat_get_config(chat_id, "ads_warn_success_autodel_sec")
-        try:
-            return int(v) if v is not None else self._warn_success_autodel_sec_env
-        except Exception:
-            return self._warn_success_autodel_sec_env
+    def chat_warn_success_autodel_sec(self, chat_id) -> int:
+        return self.chat_settings(chat_id).get_int("ads_warn_success_autodel_sec", self._warn_success_autodel_sec_env)
 
     
     
@@ -541,6 +824,7 @@ class AdsGuard:
         chat = update.effective_chat
         if not (msg and chat):
             return
+        cs = self.chat_settings(chat.id)
 
         key = (chat.id, msg.message_id)
         pend = self._pending_nocap.get(key)
@@ -557,19 +841,14 @@ class AdsGuard:
 
         # آستانهٔ لازم: برای فورواردِ مجاز سخت‌تر، وگرنه عادی
         is_ent_fwd, _ = self._is_forward_from_entity(msg)
-        need_len = self.chat_forward_caption_min_len(chat.id) if is_ent_fwd else self.chat_caption_min_len(chat.id)
+        need_len = self.chat_forward_caption_min_len(cs) if is_ent_fwd else self.chat_caption_min_len(cs)
         
         # معیار جدید: «تعداد کلمه»
-        if count_words(text) >= max(1, need_len):
+        if count_words(normalized_text(text, context)) >= max(1, need_len):
             if was_pending:
                 # 1) لغو تایمر حذف
-                try:
-                    pending_task = self._pending_tasks.pop(key, None)
-                    if pending_task:
-                        pending_task.cancel()
-                except Exception:
-                    pass
                 rec = self._pending_nocap.pop(key, None)
+                self._disarm_nocap(key, (rec or {}).get("mgid"))
                 warn_mid = (rec or {}).get("warn_msg_id")
                 # 🧹 پاک‌سازی نگاشت‌های کمکی
                 try:
@@ -623,10 +902,10 @@ class AdsGuard:
 
         if was_pending:
             # کپشن هنوز کوتاه/خالی است → همـان پیام هشدار اینلاین را ادیت کن (نه پیام جدید)
-            cd = self.chat_short_warn_cooldown_sec(chat.id)
+            cd = self.chat_short_warn_cooldown_sec(cs)
             last = self._short_warn_ts.get(key, 0)
             if now - last >= cd:
-                self._short_warn_ts[key] = now
+                self._short_warn_ts.set(key, now, ttl_sec=max(60, cd))
                 try:
                     from telegram import InlineKeyboardButton, InlineKeyboardMarkup
                     warn_mid = (pend or {}).get("warn_msg_id")
@@ -665,16 +944,16 @@ class AdsGuard:
                 return
 
         # قبلاً pending نبود ولی الان کوتاه/خالی شده → re-open با cooldown
-        cd = self.chat_reoffend_cooldown_sec(chat.id)
+        cd = self.chat_reoffend_cooldown_sec(cs)
         last = self._reoffend_ts.get(key, 0)
         if now - last < cd:
             return  # جلوگیری از اسپم روی ادیت‌های پیاپی
-        self._reoffend_ts[key] = now
+        self._reoffend_ts.set(key, now, ttl_sec=max(60, cd))
 
 
 
 
-        grace = max(0, int(self.chat_reoffend_grace_sec(chat.id) or 60))
+        grace = max(0, int(self.chat_reoffend_grace_sec(cs) or 60))
         try:
             from telegram import InlineKeyboardButton, InlineKeyboardMarkup
             buttons = [[InlineKeyboardButton(t("ads.help.hint", chat_id=chat.id), callback_data=f"adsw:guide:{msg.message_id}")]]
@@ -703,34 +982,8 @@ class AdsGuard:
             except Exception:
                 pass
 
-            # تایمر حذف برای re-open (تابع محلی با دسترسی به متغیرهای بالا)
-            async def _arm_delete_reopen():
-                try:
-                    await asyncio.sleep(grace)
-                    rec2 = self._pending_nocap.get(key)
-                    if rec2:
-                        await context.bot.delete_message(chat_id=chat.id, message_id=msg.message_id)
-                        self._pending_nocap.pop(key, None)
-                        mgid_val = rec2.get("mgid")
-                        if mgid_val:
-                            self._pending_nocap_by_mgid.pop((chat.id, mgid_val), None)
-                        # 🧹 پاک‌سازی نگاشت اخطار
-                        try:
-                            warn_mid = rec2.get("warn_msg_id")
-                            if warn_mid:
-                                self._pending_nocap_by_warn.pop((chat.id, int(warn_mid)), None)
-                        except Exception:
-                            pass
-
-                except Exception:
-                    # اگر حذف نشد، فقط state را تمیز کن
-                    try:
-                        self._pending_nocap.pop(key, None)
-                    except Exception:
-                        pass
-
-            # زمان‌بندی اجرای حذف (خارج از تابع، درست بعد از تعریف)
-            self._pending_tasks[key] = context.application.create_task(_arm_delete_reopen())
+            # تایمر حذف برای re-open (مثل قبل فقط خود پیام حذف می‌شود، نه اخطار)
+            self._arm_nocap(key, "reopen", grace, context.bot)
 
         except Exception:
             # اگر هر مرحله‌ای در ساخت هشدار/ثبت state/آرمه کردن تایمر خطا داد، بات کرش نکند
@@ -867,14 +1120,7 @@ class AdsGuard:
 
         except Exception as e:
             await query.answer(f"عملیات ناموفق بود: {e}", show_alert=True)
-        
-        # Housekeeping: prune old entries by TTL
-        now_ts = time.time()
-        ttl = getattr(self, "_successful_albums_ttl_sec", 1800)
-        self._successful_albums = {
-            k: v for k, v in self._successful_albums.items()
-            if isinstance(v, dict) and (now_ts - float(v.get("ts", now_ts)) <= ttl)
-        }
+
 
     
     
@@ -969,6 +1215,23 @@ class AdsGuard:
                     PRIMARY KEY (chat_id, domain)
                 );
             """)
+            # حذف‌های درانتظار مدیای بدون کپشن (پایدار بین ری‌استارت/رپلیکاها؛ ads_pending.py)
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS ads_pending_actions (
+                    chat_id BIGINT NOT NULL,
+                    message_id BIGINT NOT NULL,
+                    kind TEXT NOT NULL,
+                    due_at TIMESTAMPTZ NOT NULL,
+                    mgid TEXT,
+                    warn_msg_id BIGINT,
+                    data JSONB NOT NULL DEFAULT '{}'::jsonb,
+                    claimed_until TIMESTAMPTZ,
+                    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                    PRIMARY KEY (chat_id, message_id, kind)
+                );
+            """)
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_ads_pending_due ON ads_pending_actions (due_at);")
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_ads_pending_mgid ON ads_pending_actions (chat_id, mgid) WHERE mgid IS NOT NULL;")
             cur.execute("CREATE INDEX IF NOT EXISTS idx_ads_examples_created ON ads_examples (created_at DESC);")
             cur.execute("CREATE INDEX IF NOT EXISTS idx_ads_decisions_chat_msg ON ads_decisions (chat_id, message_id);")
             
@@ -981,18 +1244,14 @@ class AdsGuard:
     # ---------- whitelist & admin helpers ----------
     async def is_group_admin(self, bot, chat_id: int, user_id: int) -> bool:
         """Check admin with 5-min TTL cache."""
-        now = time.time()
-        cache = self._admins_cache.get(chat_id)
-        if not cache or (now - cache[0] > self._admins_ttl_sec):
+        admin_ids = self._admins_cache.get(chat_id)
+        if admin_ids is None:
             try:
                 admins = await bot.get_chat_administrators(chat_id)
                 admin_ids = {adm.user.id for adm in admins if getattr(adm, 'user', None)}
-                self._admins_cache[chat_id] = (now, admin_ids)
             except Exception:
                 admin_ids = set()
-                self._admins_cache[chat_id] = (now, admin_ids)
-        else:
-            admin_ids = cache[1]
+            self._admins_cache[chat_id] = admin_ids
         return user_id in admin_ids
 
 
@@ -1053,8 +1312,9 @@ class AdsGuard:
 
     def wl_user_has(self, chat_id: int, user_id: int) -> bool:
         key = (chat_id, user_id)
-        if key in self._wl_users_cache:
-            return self._wl_users_cache[key]
+        cached = self._wl_users_cache.get(key)
+        if cached is not None:
+            return cached
         try:
             with self.get_db_conn() as conn, conn.cursor() as cur:
                 cur.execute("SELECT 1 FROM ads_whitelist_users WHERE chat_id=%s AND user_id=%s", (chat_id, user_id))
@@ -1065,30 +1325,31 @@ class AdsGuard:
             return False
 
     def wl_domain_add(self, chat_id: int, domain: str, added_by: Optional[int] = None) -> bool:
-        domain = (domain or '').lower().strip()
-        if domain.startswith('http://') or domain.startswith('https://'):
-            try:
-                from urllib.parse import urlparse
-                domain = urlparse(domain).hostname or domain
-            except Exception:
-                pass
+        """
+        ثبت دامنه (یا دامنه/مسیر مثل t.me/mychannel) به شکل canonical (حروف کوچک، punycode، بدون www).
+        example.com زیردامنه‌ها را هم پوشش می‌دهد.
+        """
+        key = ads_domains.entry_key(domain)
+        if not key:
+            return False
         with self.get_db_conn() as conn, conn.cursor() as cur:
             cur.execute("""
                 INSERT INTO ads_whitelist_domains (chat_id, domain, added_by)
                 VALUES (%s, %s, %s)
                 ON CONFLICT (chat_id, domain) DO NOTHING
-            """, (chat_id, domain, added_by))
+            """, (chat_id, key, added_by))
             conn.commit()
-            self._wl_domains_cache[(chat_id, domain)] = True
-            return True
+        self._wl_tries.clear(match=lambda k: k == chat_id)
+        return True
 
     def wl_domain_del(self, chat_id: int, domain: str) -> bool:
-        domain = (domain or '').lower().strip()
+        raw = (domain or '').lower().strip()
+        keys = list({raw, ads_domains.entry_key(domain)} - {""})   # ردیف‌های قدیمی ممکن است canonical نباشند
         with self.get_db_conn() as conn, conn.cursor() as cur:
-            cur.execute("DELETE FROM ads_whitelist_domains WHERE chat_id=%s AND domain=%s", (chat_id, domain))
+            cur.execute("DELETE FROM ads_whitelist_domains WHERE chat_id=%s AND domain = ANY(%s)", (chat_id, keys))
             conn.commit()
-            self._wl_domains_cache[(chat_id, domain)] = False
-            return True
+        self._wl_tries.clear(match=lambda k: k == chat_id)
+        return True
 
     def wl_domains_list(self, chat_id: int, limit: int = 50) -> List[Tuple[str, str]]:
         with self.get_db_conn() as conn, conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
@@ -1112,110 +1373,20 @@ class AdsGuard:
             rows = cur.fetchall() or []
             return [(int(r['user_id']), str(r['ts'])) for r in rows]
 
+    # هیوریستیک‌های متنی: پیاده‌سازی کامپایل‌شده در ads_heuristics (این‌ها wrapper سازگاری‌اند)
     @staticmethod
     def _extract_domains(text: str) -> List[str]:
-        if not text:
-            return []
-        from urllib.parse import urlparse
-        cand = set()
-        for m in re.findall(r"https?://[^\s\)\]\>\<]+", text, flags=re.IGNORECASE):
-            try:
-                host = urlparse(m).hostname
-            except Exception:
-                host = None
-            if host:
-                cand.add(host.lower())
-        for m in re.findall(
-            r"\b([A-Za-z0-9\u0600-\u06FF][A-Za-z0-9\.\-\u0600-\u06FF]*\.[A-Za-z\u0600-\u06FF]{2,})(?:/\S*)?\b",
-            text,
-            flags=re.IGNORECASE,
-        ):
+        return list(ads_heuristics.analyze(normalize_text(text)).domains)
 
-            cand.add(m.split('/')[0].lower())
-        return sorted(cand)
-    
-    
     @staticmethod
     def _is_request_intent(text: str) -> bool:
         """تشخیص نیتِ درخواست/یافتن/راهنمایی در متن والد (reply_to)."""
-        if not text:
-            return False
-            
-        # حذف نیم‌فاصله/علائم جهت‌دهی (ZWNJ/RLM/LRM) + یکدست‌سازی فاصله‌ها
-        norm = re.sub(r"[\u200c\u200f\u200e]", " ", (text or "").strip())
-        s = re.sub(r"\s+", " ", norm)
-
-        # الگوهای پایهٔ درخواست/راهنمایی (حالت‌های محاوره‌ای + نیم‌فاصله)
-        base_patterns = [
-            # میخوام/می‌خوام/میخواستم/می‌خواستم + املای رایجِ «میخاستم»
-            r"می\s*خوام", r"میخوام", r"می\s*خواستم", r"میخواستم", r"میخاستم",
-            r"نیاز(?:\s|‌)?دارم", r"دنبال",
-
-            # از کجا ... (می‌تونم/می‌شه/بخرم/تهیه کنم/گیر بیارم/پیدا کنم)
-            r"(?:از\s+)?کجا(?:ی)?(?:\s+\S+){0,8}\s+(?:می\s*تونم|می‌تونم|میتونم|می\s*شه|میشه|پیدا\s*کنم|بخرم|تهیه\s*کنم|گیر\s*بیارم|هست)",
-
-            # کلی: «کجا» و «پیدا می‌شه/می‌تونم»
-            r"کجا(?:ی)?",
-            r"پیدا(?:\s|‌)?(?:می[شس]ه|می\s*تونم|می‌تونم)?",
-
-            # راهنمایی/معرفی/پیشنهاد
-            r"راهنمایی(?:\s+کنید)?", r"معرفی(?:\s+کنید)?", r"پیشنهاد(?:\s|‌)?بدید",
-
-            # «چه/کدوم جنسی/مدلی ... استفاده کنیم/مناسبه/بهتره»
-            r"(?:چه|کدوم)(?:\s+\S+){0,8}\s+(?:استفاده\s*کنیم|مناسبه|بهتره)",
-
-            # «دارین ... بفرستین» یا «پی وی قیمت»
-            r"دار(?:ید|ین|ی)(?:\s+\S+){0,6}\s+بفرس(?:تین|تید)",
-            r"(?:پی\.?\s*وی|پیوی)\s*قیمت",
-
-            # قیمت/هزینه بپرسه حتی بدون «؟»
-            r"(?:قیمت|هزینه)\s*(?:بده|بدید|بدين|اعلام|لطفاً|لطفا|چنده|چقد(?:ر|ه))",
-            r"(?:دونه(?:\s*ای)?|تکی)\s*چند",
-
-            # «موجود دارید/داره؟»
-            r"(?:دوستان|همکار(?:ان|ای)|بچه(?:‌| )?ها|رفقا)(?:\s+\S+){0,6}\s+دار(?:ید|ین|ی)\s*[\?؟]",
-            r"(?:موجود|موجودی)\s+دار(?:ه|ید|ین|ن|ند)"
-        ]
-
-        # «کسی ...» با فاصلهٔ آزاد بین «کسی» و فعل/عبارت تا 10 واژه
-        someone_help_patterns = [
-            r"(?:ا(?:گه|گر)\s+)?کسی(?:\s+\S+){0,10}\s+(?:هست|نیست)",
-            r"(?:ا(?:گه|گر)\s+)?کسی(?:\s+\S+){0,10}\s+اطلاع\s+دار(?:ه|ید|ین|ن|ند)",
-            r"(?:ا(?:گه|گر)\s+)?کسی(?:\s+\S+){0,10}\s+سراغ\s+دار(?:ه|ید|ین|ن|ند)",
-            r"(?:ا(?:گه|گر)\s+)?کسی(?:\s+\S+){0,10}\s+موجود\s+دار(?:ه|ید|ین|ن|ند)",
-            r"کسی(?:\s+\S+){0,10}\s+دار(?:ه|ید|ی|ن|ند)",
-            r"کسی(?:\s+\S+){0,10}\s+(?:می\s*تونه|می‌تونه|میتونه|بتونه|بتونید|بتونی|بتونن)",
-            r"کسی(?:\s+\S+){0,10}\s+(?:انجام\s*می(?:ده|دهد)|می\s*کنه|می‌کنه|می\s*کنن|می‌کنند|میکنه|میکنن)",
-            r"کسی(?:\s+\S+){0,10}\s+انجام\s+نمی(?:ده|دهد)\s*[\?؟]+",
-            r"کسی(?:\s+\S+){0,10}\s+می\s*شنا(?:س|سی|سید|سن)(?:ه)?",
-            r"کسی(?:\s+\S+){0,10}\s+ندار(?:ه|ید|ین|ن|ند)\s*[\?؟]"
-        ]
-        
-        patterns = base_patterns + someone_help_patterns
-
-        if any(re.search(p, s, flags=re.IGNORECASE) for p in patterns):
-            return True
-        if ("?" in s or "؟" in s) and re.search(r"(بخر|خرید|تهیه)", s, flags=re.IGNORECASE):
-            return True
-        return False
+        return ads_heuristics.analyze(normalize_text(text)).request_intent
 
     @staticmethod
     def _has_contact_like(text: str) -> bool:
         """تشخیص سادهٔ شماره/لینک/آیدی/ایمیل در پیام."""
-        if not text:
-            return False
-        s = (text or "").lower()
-        if re.search(r"(\+?98|0)?9\d{9}", s):  # موبایل ایران
-            return True
-        if re.search(r"\b\+?\d[\d\s\-]{8,}\d\b", s):  # شماره عمومی
-            return True
-        if re.search(r"(https?://|www\.)\S+", s):  # لینک/دامنه
-            return True
-        if re.search(r"@\w{3,}", s) or "t.me/" in s:  # آیدی تلگرام
-            return True
-        if re.search(r"[\w\.-]+@[\w\.-]+\.[a-z]{2,}", s):  # ایمیل
-            return True
-        return False
+        return ads_heuristics.analyze(normalize_text(text)).has_contact
 
     
     
@@ -1225,14 +1396,7 @@ class AdsGuard:
             if not media_group_id:
                 return ""
             key = (chat_id, str(media_group_id))
-            val = self._mg_caption_cache.get(key)
-            if not val:
-                return ""
-            ts, cap = val
-            if time.time() - ts > self._mg_caption_ttl_sec:
-                self._mg_caption_cache.pop(key, None)
-                return ""
-            return cap or ""
+            return self._mg_caption_cache.get(key) or ""
         except Exception:
             return ""
 
@@ -1257,7 +1421,31 @@ class AdsGuard:
                 (chat_id, text, user_id, label)
             )
             conn.commit()
-            return True, ""
+        self.invalidate_examples(chat_id)
+        return True, ""
+
+    def similar_examples_available(self) -> bool:
+        return self._retriever is not None
+
+    def invalidate_examples(self, chat_id: int) -> None:
+        """
+        بعد از افزودن/حذف نمونه‌ها صدا زده شود: نسخهٔ نمونه‌های گروه بالا می‌رود،
+        کش few-shot، ایندکس شباهت و fingerprintهای near-dup همان گروه دور ریخته می‌شوند
+        (near-dup پیش از کش رأی بررسی می‌شود و به نسخهٔ نمونه‌ها وابسته نیست).
+        """
+        self._examples_gen[chat_id] = self._examples_gen.get(chat_id, 0) + 1
+        self._examples_cache.clear(match=lambda k: k[0] == chat_id)
+        if self._retriever is not None:
+            self._retriever.invalidate(chat_id)
+        self._neardup.clear_chat(chat_id)
+
+    def examples_version(self, chat_id: int) -> str:
+        """نسخهٔ نمونه‌های گروه در این پروسه (برای کلید کش و آموزش مجدد مدل محلی)."""
+        return str(self._examples_gen.get(chat_id, 0))
+
+    def _all_examples(self, chat_id: int) -> List[Tuple[int, str, str, str]]:
+        """همهٔ نمونه‌های گروه (تا ADS_RETRIEVAL_MAX_EXAMPLES) برای ساخت ایندکس شباهت."""
+        return self.list_examples_full(chat_id, limit=self._retrieval_max_examples)
 
     def list_examples_full(self, chat_id: int, limit: int = 10) -> List[Tuple[int, str, str, str]]:
         """نسخهٔ کامل نمونه‌ها برای تزریق به مدل (بدون برش ۱۸۰ کاراکتری).
@@ -1381,17 +1569,58 @@ class AdsGuard:
         # برای جلوگیری از دوگانگیِ پرامپت، اینجا چیزی ارسال نمی‌کنیم.
         return ""
 
-    def _fetch_examples(self, chat_id: int, limit: int) -> List[Tuple[int, str, str, str]]:
+    def _fetch_examples(self, chat_id: int, limit: int, message_text: Optional[str] = None) -> List[Tuple[int, str, str, str]]:
         """
         نمونه‌هایی که به «مدل» تزریق می‌شوند؛ balanced → فول‌تکست، latest → فول‌تکست
+        similar → k نمونهٔ شبیه‌تر به message_text (نرمال‌شده؛ در نبود NumPy/متن → latest)
         """
         mode = self.chat_examples_select_mode(chat_id)
+        if mode == "similar" and self._retriever is not None and message_text:
+            try:
+                picked = self._retriever.top_k(chat_id, message_text, limit)
+                if picked is not None:
+                    return picked
+            except Exception as e:
+                log.warning("[ads] similar examples failed chat=%s: %s", chat_id, e)
         if mode == "balanced":
             return self.list_examples_balanced(chat_id, limit=limit)  # فول‌تکست در همین متد
         return self.list_examples_full(chat_id, limit=limit)
 
 
-    def _call_flowise_ads(
+    @staticmethod
+    def _render_examples(examples: List[Tuple[int, str, str, str]]) -> str:
+        """متن فیوشات‌ها برای vars.examples در Chatflow."""
+        return "\n\n".join([f"مثال {i+1}:\n[{e[3]}]\n{e[1]}" for i, e in enumerate(examples)])
+
+    def _examples_payload_sync(self, chat_id: int, limit: int, message_text: Optional[str]):
+        examples = self._fetch_examples(chat_id, limit, message_text)
+        return examples, self._render_examples(examples)
+
+    async def _examples_payload(
+        self, chat_id: int, limit: int, message_text: Optional[str] = None
+    ) -> Tuple[List[Tuple[int, str, str, str]], str]:
+        """
+        (examples, examples_str) برای طبقه‌بندی؛ latest/balanced از کش نسخه‌دار (بدون I/O در حالت hit)،
+        similar از ایندکس درون‌حافظه‌ای. I/O در صورت miss داخل thread انجام می‌شود تا event loop نایستد.
+        """
+        mode = self.chat_examples_select_mode(chat_id)
+        if mode == "similar" and self._retriever is not None and message_text:
+            if self._retriever.has_index(chat_id):
+                return self._examples_payload_sync(chat_id, limit, message_text)
+            return await asyncio.to_thread(self._examples_payload_sync, chat_id, limit, message_text)
+
+        ckey = (chat_id, self.examples_version(chat_id), mode, limit)
+        hit = self._examples_cache.get(ckey)
+        if hit is not None:
+            MET_ADS_EXAMPLES_CACHE.labels(result="hit").inc()
+            return hit
+        MET_ADS_EXAMPLES_CACHE.labels(result="miss").inc()
+        payload = await asyncio.to_thread(self._examples_payload_sync, chat_id, limit, None)
+        if ckey[1] == self.examples_version(chat_id):   # اگر وسط کار نمونه‌ها عوض شدند، ذخیره نکن
+            self._examples_cache.put(ckey, payload)
+        return payload
+
+    async def _call_flowise_ads(
         self,
         prompt: str,
         message_text: Optional[str] = None,
@@ -1425,70 +1654,34 @@ class AdsGuard:
         if isinstance(extra_vars, dict) and extra_vars:
             # سیگنال‌های زمینه‌ای (مثلاً is_reply / has_contact)
             try:
-                payload["overrideConfig"]["vars"].update({
-                    k: (bool(v) if isinstance(v, (bool, int)) else v)
-                    for k, v in extra_vars.items()
-                    if v is not None
-                })
+                payload["overrideConfig"]["vars"].update(_ads_vars(extra_vars))
             except Exception:
                 pass
 
 
 
 
-        def _try_parse_obj(d: dict) -> Optional[dict]:
-            if not isinstance(d, dict):
-                return None
-            label = d.get("label") or d.get("Label") or d.get("LABEL")
-            score = d.get("score") or d.get("Score") or d.get("SCORE")
-            reason = d.get("reason") or d.get("Reason") or d.get("REASON")
-            if label is None and "json" in d and isinstance(d["json"], dict):
-                jj = d["json"]
-                label = jj.get("label") or jj.get("Label") or jj.get("LABEL")
-                score = jj.get("score") if jj.get("score") is not None else score
-                reason = jj.get("reason") if jj.get("reason") is not None else reason
-                if label is not None:
-                    return {"label": label, "score": score, "reason": reason}
-            if label is not None:
-                return {"label": label, "score": score, "reason": reason}
-            return None
-
-        def _strip_code_fences(s: str) -> str:
-            s = s.strip()
-            if s.startswith("```json"):
-                s = s[7:]
-            elif s.startswith("```"):
-                s = s[3:]
-            if s.endswith("```"):
-                s = s[:-3]
-            return s.strip()
-
-
+        _try_parse_obj = _parse_verdict_obj
 
         try:
-            r = requests.post(
-                url, headers=headers, data=json.dumps(payload),
-                timeout=(getattr(self, "_flowise_connect_timeout", 5), getattr(self, "_flowise_read_timeout", 75))
-            )
+            # کلاینت async مشترک (keep-alive) به‌جای requests در to_thread
             try:
-                r.raise_for_status()
-            except requests.exceptions.HTTPError as he:
+                status, data = await flowise_post_prediction(
+                    url, headers, payload,
+                    read_timeout_sec=getattr(self, "_flowise_read_timeout", 75),
+                    connect_timeout_sec=getattr(self, "_flowise_connect_timeout", 5),
+                )
+            except aiohttp.ClientResponseError as he:
                 # لاگ دقیق خطا برای عیب‌یابی (HTTP 4xx/5xx)
-                try:
-                    body = r.text[:800]
-                except Exception:
-                    body = "<no-body>"
-                log.warning("[ads] Flowise HTTP %s: %s | resp: %s", r.status_code, he, body)
+                log.warning("[ads] Flowise HTTP %s: %s", he.status, he.message)
                 raise
 
-            data = r.json()
-            
             if os.getenv("ADS_DEBUG", "0") == "1":
                 try:
                     keys = list(data.keys()) if isinstance(data, dict) else type(data).__name__
                 except Exception:
                     keys = "?"
-                log.info("[ads] HTTP %s, top-level=%s", r.status_code, keys)
+                log.info("[ads] HTTP %s, top-level=%s", status, keys)
 
             if isinstance(data, dict):
                 obj = _try_parse_obj(data)
@@ -1533,37 +1726,320 @@ class AdsGuard:
 
 
 
-    # ---------- watchdog ----------
-    def _check_domain_whitelisted(self, chat_id: int, domains: List[str]) -> bool:
+    @staticmethod
+    def _examples_version(examples: List[Tuple[int, str, str, str]]) -> str:
+        """مهر نسخهٔ فیوشات‌ها (id و label)؛ با افزودن/حذف نمونه عوض می‌شود."""
+        return ",".join(f"{e[0]}{e[3][:1]}" for e in examples)
+
+    def _verdict_key(self, chat_id: int, norm_text: str, examples, extra_vars: Optional[dict]) -> str:
+        cfid = self.chat_chatflow_id(chat_id) or ""
+        flags = "".join(f"{k}={int(bool(v))};" for k, v in sorted((extra_vars or {}).items()))
+        raw = "\x1f".join((cfid, self._examples_version(examples), flags, norm_text))
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+    def _local_training_data(self, chat_id: int) -> Tuple[List[str], List[int]]:
+        """
+        دادهٔ آموزش مدل محلی: همهٔ ads_examples گروه + تصمیم‌های مطمئن اخیر مدل در ads_decisions
+        (تصمیم‌های خودِ مدل محلی کنار گذاشته می‌شوند تا حلقهٔ بازخورد ساخته نشود).
+        """
+        texts: List[str] = []
+        labels: List[int] = []
+        with self.get_db_conn() as conn, conn.cursor() as cur:
+            cur.execute("""
+                (SELECT text, (label = 'AD') AS y FROM ads_examples WHERE chat_id = %s ORDER BY id DESC LIMIT 1000)
+                UNION ALL
+                (SELECT text, is_ad AS y FROM ads_decisions
+                  WHERE chat_id = %s AND text IS NOT NULL AND text <> ''
+                    AND COALESCE(reason, '') NOT LIKE 'local:%%'
+                    AND ((is_ad AND score >= 0.85) OR (NOT is_ad AND label = 'NOT_AD'))
+                  ORDER BY decided_at DESC LIMIT 2000)
+            """, (chat_id, chat_id))
+            for text, y in cur.fetchall() or []:
+                texts.append(normalize_text(text))
+                labels.append(1 if y else 0)
+        return texts, labels
+
+    def _local_verdict(self, chat_id: int, norm_text: str) -> Optional[dict]:
+        """رأی مدل محلی اگر اطمینانش بیرون از بازهٔ [low, high] باشد؛ وگرنه None (→ Flowise)."""
+        if self._prefilter is None:
+            return None
+        cs = self.chat_settings(chat_id)
+        if not cs.get_bool("ads_local_model", as_bool(self._local_model_env)):
+            return None
+        self._prefilter.maybe_retrain(chat_id, self.examples_version(chat_id))
+        p = self._prefilter.predict(chat_id, norm_text)
+        if p is None:
+            return None
+        low = cs.get_float("ads_local_low", self._local_low_env)
+        high = cs.get_float("ads_local_high", self._local_high_env)
+        if p <= low:
+            MET_ADS_LOCAL.labels(result="local_not_ad").inc()
+            return {"label": "NOT_AD", "score": round(1.0 - p, 4), "reason": f"local: p_ad={p:.3f}"}
+        if p >= high:
+            MET_ADS_LOCAL.labels(result="local_ad").inc()
+            return {"label": "AD", "score": round(p, 4), "reason": f"local: p_ad={p:.3f}"}
+        MET_ADS_LOCAL.labels(result="escalated").inc()
+        return None
+
+    def _neardup_verdict(self, chat_id: int, norm_text: str) -> Optional[dict]:
+        """اگر متن نزدیکِ یک AD قبلی است، همان رأی (بدون Flowise)؛ وگرنه None."""
+        cs = self.chat_settings(chat_id)
+        if not cs.get_bool("ads_neardup", as_bool(self._neardup_env)):
+            return None
+        fp = ads_fingerprint.simhash(norm_text, self._neardup_min_len)
+        if fp is None:
+            return None
+        hit = self._neardup.find(
+            chat_id, fp, cs.get_int("ads_neardup_max_dist", self._neardup_max_dist_env),
+            use_global=cs.get_bool("ads_neardup_global", as_bool(self._neardup_global_env)),
+        )
+        if hit is None:
+            return None
+        meta, dist, scope = hit
+        MET_ADS_NEARDUP.labels(scope=scope).inc()
+        return {"label": "AD", "score": meta.get("score"), "reason": f"near-dup ({scope}, d={dist}): {meta.get('reason') or ''}".strip()}
+
+    def _neardup_remember(self, chat_id: int, norm_text: str, parsed: Optional[dict]) -> None:
+        """رأی AD بالای threshold گروه را به ایندکس اضافه می‌کند."""
+        if not isinstance(parsed, dict) or str(parsed.get("label", "")).upper() != "AD":
+            return
         try:
-            with self.get_db_conn() as conn, conn.cursor() as cur:
-                q = "SELECT domain FROM ads_whitelist_domains WHERE chat_id=%s AND domain = ANY(%s) LIMIT 1"
-                cur.execute(q, (chat_id, domains))
-                return cur.fetchone() is not None
+            score = float(parsed["score"]) if parsed.get("score") is not None else None
         except Exception:
-            return False
+            score = None
+        if score is not None and score < self.chat_threshold(chat_id):
+            return
+        fp = ads_fingerprint.simhash(norm_text, self._neardup_min_len)
+        if fp is None:
+            return
+        cs = self.chat_settings(chat_id)
+        self._neardup.add(
+            chat_id, fp, {"score": score, "reason": str(parsed.get("reason") or "")[:200]},
+            to_global=cs.get_bool("ads_neardup_global", as_bool(self._neardup_global_env)),
+        )
+
+    def load_state(self) -> None:
+        """بارگذاری ایندکس near-dup از دیسک (در startup، داخل thread)."""
+        try:
+            self._neardup.load(self._neardup_path)
+        except Exception as e:
+            log.warning("[ads] near-dup index load failed: %s", e)
+
+    async def shutdown(self) -> None:
+        """آزادسازی منابع پس‌زمینه (ProcessPool مدل محلی، جاروبگر مهلت‌ها)، flush بافرهای DB و ذخیرهٔ ایندکس near-dup."""
+        self._nocap_timers.stop()
+        self._pending_io.shutdown(wait=True)   # نوشتن‌های write-through باقی‌مانده
+        await self._decisions.aclose()         # تصمیم‌های بافرشدهٔ ads_decisions (flush در جریان کامل می‌شود)
+        if self._prefilter is not None:
+            self._prefilter.shutdown()
+        try:
+            self._neardup.save(self._neardup_path)
+        except Exception as e:
+            log.warning("[ads] near-dup index save failed: %s", e)
 
-    def _save_decision(self, chat_id, message_id, user_id, text, label, is_ad, score, reason):
+    async def _classify(
+        self,
+        prompt: str,
+        message_text: str,
+        examples: List[Tuple[int, str, str, str]],
+        examples_str: str,
+        chat_id: int,
+        extra_vars: Optional[dict] = None,
+        norm_text: Optional[str] = None,
+    ) -> Tuple[Optional[dict], str]:
         """
-        ذخیرهٔ تصمیم مدل برای هر پیام (برای آمار/شبیه‌سازی لازم است label خام هم بماند).
+        _call_flowise_ads با کش رأی: کلید = hash(chatflow + نسخهٔ فیوشات‌ها + سیگنال‌ها + متن نرمال‌شده).
+        فقط خروجی‌های معتبر (دارای label) ذخیره می‌شوند؛ threshold/action همچنان در watchdog اعمال می‌شود.
+        فراخوانی‌های هم‌زمان با همین کلید از طریق single_flight یکی می‌شوند.
+        ترتیب: near-dup یک AD قبلی → کش رأی → مدل محلی (اگر مطمئن است) → Flowise.
+        norm_text: متن نرمال‌شدهٔ همین آپدیت (normalized_text) تا مسیرهای داخلی دوباره نرمال نکنند.
         """
+        norm = norm_text if norm_text is not None else normalize_text(message_text)
+        near = self._neardup_verdict(chat_id, norm)
+        if near is not None:
+            return near, ""
+
+        key = None
+        if self._verdict_cache_ttl > 0:
+            try:
+                key = self._verdict_key(chat_id, norm, examples, extra_vars)
+            except Exception:
+                key = None
+        if key is not None:
+            hit = self._verdict_cache.get(key)
+            if hit is not None:
+                MET_ADS_VERDICT_CACHE.labels(result="hit").inc()
+                return dict(hit), ""
+            MET_ADS_VERDICT_CACHE.labels(result="miss").inc()
+
+        local = self._local_verdict(chat_id, norm)
+        if local is not None:
+            return local, ""
+
+        async def _call():
+            if self.chat_settings(chat_id).get_bool("ads_batch", as_bool(self._batch_env)):
+                cfid = self.chat_chatflow_id(chat_id)
+                if self.flowise_base_url and cfid:
+                    return await self._batcher.submit(chat_id, cfid, message_text, examples_str, extra_vars)
+            return await self._call_flowise_ads(
+                prompt, message_text=message_text, examples_str=examples_str,
+                chat_id=chat_id, extra_vars=extra_vars,
+            )
+
+        # متن یکسان در چند گروه/ادیت هم‌زمان → یک فراخوانی مشترک
+        sf_key = ("ads", key or self._verdict_key(chat_id, norm, examples, extra_vars))
+        parsed, err = await single_flight(sf_key, _call, kind="ads")
+        if key is not None and isinstance(parsed, dict) and parsed.get("label"):
+            self._verdict_cache.put(key, {
+                "label": parsed.get("label"),
+                "score": parsed.get("score"),
+                "reason": parsed.get("reason"),
+            })
+            MET_ADS_VERDICT_CACHE.labels(result="store").inc()
         try:
-            with self.get_db_conn() as conn, conn.cursor() as cur:
-                cur.execute("""
-                    INSERT INTO ads_decisions (chat_id, message_id, user_id, text, label, is_ad, score, reason)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                """, (chat_id, message_id, user_id, text, label, bool(is_ad), score, reason))
-                conn.commit()
+            self._neardup_remember(chat_id, norm, parsed)
         except Exception:
             pass
+        return parsed, err
+
+    async def _call_flowise_ads_batch(self, cfid: str, items: list) -> Dict[int, Tuple[dict, str]]:
+        """
+        یک prediction برای چند متن با فیوشات مشترک.
+        vars.texts = JSON آرایهٔ {id, text, is_reply, has_contact}؛ vars.batch = true؛ sessionId یکتا برای هر دسته.
+        Chatflow باید آرایهٔ JSON از {id, label, score, reason} برگرداند (یا {"results": [...]}).
+        خروجی: index → (verdict, "") فقط برای آیتم‌هایی که رأی معتبر داشتند.
+        """
+        url = f"{self.flowise_base_url}/api/v1/prediction/{cfid}"
+        headers = {"Content-Type": "application/json"}
+        if self.flowise_api_key:
+            headers["Authorization"] = f"Bearer {self.flowise_api_key}"
+        texts = [{"id": i, "text": it["text"], **it["vars"]} for i, it in enumerate(items)]
+        payload = {
+            "question": "",
+            "overrideConfig": {
+                # دسته ممکن است چند گروه را شامل شود؛ session یک‌بارمصرف تا حافظهٔ گفتگو بین گروه‌ها/دسته‌ها مشترک نشود
+                "sessionId": f"ads_batch_{uuid.uuid4().hex}",
+                "returnSourceDocuments": False,
+                "vars": {
+                    "batch": True,
+                    "count": len(items),
+                    "texts": json.dumps(texts, ensure_ascii=False),
+                    "examples": items[0]["examples"] or "",
+                },
+            },
+        }
+        _st, data = await flowise_post_prediction(
+            url, headers, payload,
+            read_timeout_sec=getattr(self, "_flowise_read_timeout", 75),
+            connect_timeout_sec=getattr(self, "_flowise_connect_timeout", 5),
+        )
+
+        def _as_list(obj):
+            if isinstance(obj, list):
+                return obj
+            if isinstance(obj, dict):
+                for k in ("results", "items", "verdicts", "json"):
+                    if isinstance(obj.get(k), list):
+                        return obj[k]
+                txt = obj.get("text")
+                if txt is None and isinstance(obj.get("result"), dict):
+                    txt = obj["result"].get("text")
+                if isinstance(txt, str):
+                    try:
+                        return _as_list(json.loads(_strip_code_fences(txt)))
+                    except Exception:
+                        return None
+            return None
+
+        rows = _as_list(data) or []
+        out: Dict[int, Tuple[dict, str]] = {}
+        for pos, row in enumerate(rows):
+            verdict = _parse_verdict_obj(row) if isinstance(row, dict) else None
+            if verdict is None:
+                continue
+            try:
+                idx = int(row.get("id", pos))
+            except Exception:
+                idx = pos
+            if 0 <= idx < len(items):
+                out[idx] = (verdict, "")
+        return out
+
+    # ---------- watchdog ----------
+    def _load_wl_trie(self, chat_id: int) -> "ads_domains.DomainTrie":
+        with self.get_db_conn() as conn, conn.cursor() as cur:
+            cur.execute("SELECT domain FROM ads_whitelist_domains WHERE chat_id=%s", (chat_id,))
+            trie = ads_domains.DomainTrie(str(r[0]) for r in (cur.fetchall() or []))
+        self._wl_tries.put(chat_id, trie)
+        return trie
+
+    async def _domain_whitelisted(self, chat_id: int, links) -> bool:
+        """آیا یکی از لینک‌های (host, path) پیام whitelist است؟ I/O فقط وقتی trie گروه در حافظه نیست."""
+        trie = self._wl_tries.get(chat_id)
+        if trie is None:
+            try:
+                trie = await asyncio.to_thread(self._load_wl_trie, chat_id)
+            except Exception:
+                return False
+        return trie.match_any(links)
+
+    def _save_decisions(self, rows: List[tuple]) -> None:
+        """
+        ذخیرهٔ دسته‌ای تصمیم‌های مدل (برای آمار/شبیه‌سازی لازم است label خام هم بماند).
+        هر ردیف: (chat_id, message_id, user_id, text, label, is_ad, score, reason, decided_at)؛
+        از بافر write-behind صدا زده می‌شود و خطا را بالا می‌دهد تا همان‌جا شمرده شود.
+        """
+        with self.get_db_conn() as conn, conn.cursor() as cur:
+            psycopg2.extras.execute_values(
+                cur,
+                """
+                INSERT INTO ads_decisions (chat_id, message_id, user_id, text, label, is_ad, score, reason, decided_at)
+                VALUES %s
+                """,
+                rows,
+                page_size=max(1, len(rows)),
+            )
+            conn.commit()
 
 
     async def watchdog(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        msg = update.effective_message
+        chat = update.effective_chat
+        # عضو آلبوم: فقط بافر؛ پایپ‌لاین بعد از بازهٔ سکوت یک‌بار برای کل آلبوم اجرا می‌شود (_flush_album)
+        if (
+            self._albums is not None and msg and chat and chat.type in ("group", "supergroup")
+            and getattr(msg, "media_group_id", None)
+        ):
+            self._albums.offer(chat.id, str(msg.media_group_id), update, context)
+            return
+        await self._watchdog_one(update, context)
+
+    async def _flush_album(self, batch: AlbumBatch) -> None:
+        update, context = batch.lead
+        try:
+            await self._watchdog_one(update, context, album=batch)
+        except ApplicationHandlerStop:
+            pass   # خارج از زنجیرهٔ هندلرها اجرا می‌شود؛ توقفی لازم نیست
+
+    async def _delete_targets(self, bot, chat_id: int, message_ids: List[int]) -> None:
+        """حذف پیام هدف (یا همهٔ اعضای آلبوم در یک delete_messages)؛ خطا را بالا می‌دهد."""
+        if len(message_ids) == 1:
+            await bot.delete_message(chat_id=chat_id, message_id=message_ids[0])
+        else:
+            await bot.delete_messages(chat_id=chat_id, message_ids=message_ids)
+
+    async def _watchdog_one(self, update: Update, context: ContextTypes.DEFAULT_TYPE, album: Optional[AlbumBatch] = None):
+        """
+        پایپ‌لاین تبلیغات برای یک پیام؛ با album، برای کل آلبوم:
+        msg عضو نماینده است، کپشن ادغام‌شدهٔ آلبوم متن آن است و اقدام‌ها روی همهٔ اعضا اعمال می‌شوند.
+        """
         msg = update.effective_message
         chat = update.effective_chat
         if not chat:
             return
-        if not self.chat_feature_on(chat.id):
+        # اسنپ‌شات تنظیمات گروه: یک‌بار برای کل این آپدیت
+        cs = self.chat_settings(chat.id)
+        if not self.chat_feature_on(cs):
             return
 
         u = update.effective_user
@@ -1572,7 +2048,8 @@ class AdsGuard:
         
         # اطمینان از ساخت/تکمیل تنظیمات گروه در DB (پیش‌فرض‌ها از bot_config → یا fallback)
         try:
-            ensure_chat_defaults(chat.id)
+            if ensure_chat_defaults(chat.id):
+                cs = self.chat_settings(chat.id)  # کلید تازه درج شد → اسنپ‌شات جدید
         except Exception:
             pass
 
@@ -1601,17 +2078,6 @@ class AdsGuard:
             if self._seen_messages.get(_k, 0) > now - self._dedup_ttl_sec:
                 return
             self._seen_messages[_k] = now
-            if len(self._seen_messages) > 5000:
-                cutoff = now - self._dedup_ttl_sec
-                self._seen_messages = {k:t for k,t in self._seen_messages.items() if t >= cutoff}
-        except Exception:
-            pass
-        
-        # Housekeeping اضافی برای dedup آلبوم‌ها (ایمن و سبک)
-        try:
-            cutoff2 = time.time() - self._dedup_ttl_sec
-            if len(self._seen_mg_nocap) > 2000:
-                self._seen_mg_nocap = {k: t for k, t in self._seen_mg_nocap.items() if t >= cutoff2}
         except Exception:
             pass
 
@@ -1637,10 +2103,14 @@ class AdsGuard:
         
         target_msg = msg
         text = (msg.text or msg.caption or "").strip()
+        if album is not None:
+            text = album.caption or text
+            if text:
+                self._mg_caption_cache[(chat.id, album.mgid)] = text
 
         # --- مدیریت ریپلای به عنوان کپشن برای مدیای در حال انتظار ---
         reply = getattr(msg, "reply_to_message", None)
-        if text and reply and self.chat_allow_reply_as_caption(chat.id):
+        if text and reply and self.chat_allow_reply_as_caption(cs):
             pending_key = None
             key_from_warn = self._pending_nocap_by_warn.get((chat.id, reply.message_id))
             if key_from_warn and self._pending_nocap.get(key_from_warn):
@@ -1660,8 +2130,7 @@ class AdsGuard:
             if pending_key:
                 rec = self._pending_nocap.get(pending_key)
                 if rec:
-                    task = self._pending_tasks.pop(pending_key, None)
-                    if task: task.cancel()
+                    self._disarm_nocap(pending_key, rec.get("mgid"))
                     
                     self._pending_nocap.pop(pending_key, None)
                     mgid_val = rec.get("mgid")
@@ -1698,10 +2167,7 @@ class AdsGuard:
             mgid = getattr(target_msg, "media_group_id", None)
             if mgid and target_msg.caption:
                 key = (chat.id, str(mgid))
-                self._mg_caption_cache[key] = (time.time(), target_msg.caption)
-                if len(self._mg_caption_cache) > 5000:
-                    cutoff = time.time() - self._mg_caption_ttl_sec
-                    self._mg_caption_cache = {k: v for k, v in self._mg_caption_cache.items() if v[0] >= cutoff}
+                self._mg_caption_cache[key] = target_msg.caption
         except Exception:
             pass
         
@@ -1711,12 +2177,15 @@ class AdsGuard:
         
         if _has_media(target_msg) and getattr(target_msg, "reply_to_message", None):
             return
+
+        # شناسه‌هایی که اقدام حذف روی آن‌ها اعمال می‌شود (آلبوم: همهٔ اعضا)
+        target_ids = album.message_ids if album is not None else [target_msg.message_id]
         
         is_ent_fwd, _ = self._is_forward_from_entity(target_msg)
         
-        if is_ent_fwd and not self.chat_allow_forward_entities(chat.id):
+        if is_ent_fwd and not self.chat_allow_forward_entities(cs):
             try:
-                await context.bot.delete_message(chat_id=chat.id, message_id=target_msg.message_id)
+                await self._delete_targets(context.bot, chat.id, target_ids)
             except Exception:
                 try:
                     wm = await target_msg.reply_text(
@@ -1729,7 +2198,7 @@ class AdsGuard:
                     except Exception:
                         pass
         
-                    sec = self.chat_autoclean_sec(chat.id)
+                    sec = self.chat_autoclean_sec(cs)
                     if sec and sec > 0:
                         context.application.create_task(
                             self._delete_after(context.bot, chat.id, wm.message_id, sec)
@@ -1759,7 +2228,7 @@ class AdsGuard:
                 # شرط‌های معافیت:
                 # 1) متن خالی/خیلی کوتاه یا حالت پرسشی/درخواستی (سلام، چی شد؟ کمک کن، ...)، یا
                 # 2) کوتاه و فاقد الگوهای تماس/لینکِ خارجی (شماره/URL/آیدی غیر از خودِ بات)
-                short_ok = len(cleaned) <= self.chat_reply_exempt_maxlen(chat.id)
+                short_ok = len(cleaned) <= self.chat_reply_exempt_maxlen(cs)
                 req_like = self._is_request_intent(cleaned)  # «کمکم کن»، «می‌خوام بدونم»، علامت ؟ / ؟ و ...
                 has_contact = self._has_contact_like(cleaned)  # لینک/شماره/ایمیل/آیدی تلگرام
 
@@ -1779,7 +2248,10 @@ class AdsGuard:
             # [جدید] اگر آلبوم است، شناسه پیام را به لیست آن اضافه کن
             if mgid:
                 album_key = (chat.id, str(mgid))
-                self._pending_album_msgs.setdefault(album_key, []).append(target_msg.message_id)
+                album_msgs = self._pending_album_msgs.setdefault(album_key, [])
+                for _mid in target_ids:
+                    album_msgs.append(_mid)
+                    self._pending_write(self._pending_store.add_album_member, chat.id, _mid, str(mgid), self._state_ttl)
 
             # فقط برای اولین پیام آلبوم اخطار بفرست
             if mgid:
@@ -1788,7 +2260,7 @@ class AdsGuard:
                 if self._seen_mg_nocap.get(_mk, 0) > now - self._dedup_ttl_sec:
                     return # برای این آلبوم قبلاً اخطار داده‌ایم
             
-            grace = self.chat_forward_grace_sec(chat.id) if is_ent_fwd else self.chat_nocap_grace_sec(chat.id)
+            grace = self.chat_forward_grace_sec(cs) if is_ent_fwd else self.chat_nocap_grace_sec(cs)
             try:
                 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
                 buttons = [[InlineKeyboardButton("🧩 راهنما / مثال", callback_data=f"adsw:guide:{target_msg.message_id}")]]
@@ -1815,74 +2287,32 @@ class AdsGuard:
                 self._pending_nocap_by_mgid[_mk] = key
                 self._seen_mg_nocap[_mk] = time.time()
 
-            async def _arm_delete():
-                try:
-                    await asyncio.sleep(grace)
-                    rec = self._pending_nocap.get(key)
-                    if rec:
-                        mgid_val = rec.get("mgid")
-                        if mgid_val:
-                            # [جدید] حذف گروهی تمام پیام‌های آلبوم
-                            album_key = (chat.id, mgid_val)
-                            msg_ids_to_delete = self._pending_album_msgs.pop(album_key, [])
-                            if msg_ids_to_delete:
-                                try:
-                                    await context.bot.delete_messages(chat_id=chat.id, message_ids=msg_ids_to_delete)
-                                except Exception:
-                                    for _mid in msg_ids_to_delete:
-                                        try:
-                                            await context.bot.delete_message(chat_id=chat.id, message_id=_mid)
-                                        except Exception:
-                                            pass
-
-                        else:
-                            # حذف تکی برای مدیای غیرآلبومی
-                            await context.bot.delete_message(chat_id=chat.id, message_id=target_msg.message_id)
-
-                        warn_msg_id = rec.get("warn_msg_id")
-                        if warn_msg_id:
-                            try:
-                                await context.bot.delete_message(chat_id=chat.id, message_id=warn_msg_id)
-                            except Exception:
-                                pass
-                        
-                        # پاکسازی وضعیت
-                        self._pending_nocap.pop(key, None)
-                        if mgid_val: self._pending_nocap_by_mgid.pop((chat.id, mgid_val), None)
-                        if warn_msg_id: self._pending_nocap_by_warn.pop((chat.id, warn_msg_id), None)
-                except Exception:
-                    rec = self._pending_nocap.pop(key, None)
-                    if rec:
-                        mgid_val = rec.get("mgid")
-                        if mgid_val:
-                            self._pending_nocap_by_mgid.pop((chat.id, mgid_val), None)
-                            self._pending_album_msgs.pop((chat.id, mgid_val), None) # [جدید] پاکسازی لیست آلبوم
-                        if rec.get("warn_msg_id"):
-                            self._pending_nocap_by_warn.pop((chat.id, rec.get("warn_msg_id")), None)
-            
-            self._pending_tasks[key] = context.application.create_task(_arm_delete())
+            self._arm_nocap(key, "nocap", grace, context.bot)
             return
 
         if not final_text:
             return
 
+        # همهٔ سیگنال‌های هیوریستیک متن نهایی در یک عبور (contact/domains/...)
+        norm_text = normalized_text(final_text, context)
+        signals = ads_heuristics.analyze(norm_text)
+
         # ... بقیه کد watchdog بدون تغییر باقی می‌ماند ...
         try:
             ref_for_exempt = getattr(target_msg, "reply_to_message", None)
-            if ref_for_exempt and self.chat_reply_exempt(chat.id):
+            if ref_for_exempt and self.chat_reply_exempt(cs):
                 ref_text = (ref_for_exempt.text or ref_for_exempt.caption or "").strip()
                 if ref_text and self._is_request_intent(ref_text):
-                    short_ok = len(final_text) <= self.chat_reply_exempt_maxlen(chat.id)
-                    allow_contact = self.chat_reply_exempt_allow_contact(chat.id)
-                    contact_ok = allow_contact and self._has_contact_like(final_text) and (len(final_text) <= self.chat_reply_exempt_contact_maxlen(chat.id))
+                    short_ok = len(final_text) <= self.chat_reply_exempt_maxlen(cs)
+                    allow_contact = self.chat_reply_exempt_allow_contact(cs)
+                    contact_ok = allow_contact and signals.has_contact and (len(final_text) <= self.chat_reply_exempt_contact_maxlen(cs))
                     if short_ok or contact_ok:
                         return
         except Exception:
             pass
 
         try:
-            domains = self._extract_domains(final_text)
-            if domains and await asyncio.to_thread(self._check_domain_whitelisted, chat.id, domains):
+            if signals.links and await self._domain_whitelisted(chat.id, signals.links):
                 return
         except Exception:
             pass
@@ -1890,28 +2320,79 @@ class AdsGuard:
         if final_text.startswith("/ads"):
             return
 
-        now = time.time()
-        if now - self._last_run_ts_per_chat.get(chat.id, 0.0) < self.chat_min_gap_sec(chat.id):
+        min_gap = self.chat_min_gap_sec(cs)
+        if self._modq is None:
+            # رفتار قدیمی: پیام‌های داخل min_gap بررسی نمی‌شوند
+            now = time.time()
+            if now - self._last_run_ts_per_chat.get(chat.id, 0.0) < min_gap:
+                return
+            self._last_run_ts_per_chat.set(chat.id, now, ttl_sec=max(60, min_gap))
+            await self._moderate(context, cs, chat, u, target_msg, target_ids, final_text, norm_text, signals,
+                                 wm_to_close, wm_close_by)
             return
-        self._last_run_ts_per_chat[chat.id] = now
 
+        # صف نظارت همین گروه: داخل min_gap هم بررسی می‌شود (با تأخیر/دسته‌ای)، نه رد.
+        # هندلر منتظر نمی‌ماند؛ چت‌بات با ads_verdict_blocks(context) منتظر رأی می‌ماند.
+        # طبقه‌بندی پیام‌های یک دوره هم‌زمان است (قابل batch)؛ اقدام‌ها به ترتیب رسیدن اجرا می‌شوند.
+        async def _classify_job():
+            return await self._moderate_classify(context, cs, chat, target_msg, final_text, norm_text, signals)
+
+        async def _apply_job(verdict) -> bool:
+            try:
+                await self._moderate_apply(context, cs, chat, u, target_msg, target_ids, final_text,
+                                           wm_to_close, wm_close_by, verdict)
+            except ApplicationHandlerStop:
+                return True   # هشدار/حذف انجام شد
+            return False
+
+        context.__dict__[ADS_VERDICT_KEY] = self._modq.submit(
+            chat.id, target_msg.message_id, _classify_job, _apply_job, min_gap
+        )
+
+    async def _moderate(
+        self,
+        context: ContextTypes.DEFAULT_TYPE,
+        cs,
+        chat,
+        u,
+        target_msg,
+        target_ids: List[int],
+        final_text: str,
+        norm_text: str,
+        signals: "ads_heuristics.TextSignals",
+        wm_to_close: Optional[int],
+        wm_close_by: Optional[int],
+    ):
+        """
+        طبقه‌بندی + اقدام (هشدار/حذف/ژتون) برای یک پیام که از فیلترهای watchdog رد شده است.
+        ApplicationHandlerStop یعنی پیام به‌عنوان تبلیغ اقدام شد.
+        """
+        parsed = await self._moderate_classify(context, cs, chat, target_msg, final_text, norm_text, signals)
+        await self._moderate_apply(context, cs, chat, u, target_msg, target_ids, final_text,
+                                   wm_to_close, wm_close_by, parsed)
+
+    async def _moderate_classify(self, context, cs, chat, target_msg, final_text: str, norm_text: str,
+                                 signals: "ads_heuristics.TextSignals") -> Optional[dict]:
+        """مرحلهٔ طبقه‌بندی _moderate (بدون اقدام روی گروه)؛ خروجی: رأی parse‌شده یا None."""
         try:
             await context.bot.send_chat_action(chat_id=chat.id, action=ChatAction.TYPING)
         except Exception:
             pass
 
-        examples = self._fetch_examples(chat.id, self.chat_max_fewshots(chat.id))
-        examples_str = "\n\n".join([f"مثال {i+1}:\n[{e[3]}]\n{e[1]}" for i, e in enumerate(examples)])
+        examples, examples_str = await self._examples_payload(chat.id, self.chat_max_fewshots(cs), norm_text)
         prompt = self._build_prompt(final_text, examples)
         is_reply_flag = bool(getattr(target_msg, "reply_to_message", None))
-        has_contact_flag = self._has_contact_like(final_text)
+        has_contact_flag = signals.has_contact
         
-        parsed, err = await asyncio.to_thread(
-            self._call_flowise_ads, prompt,
-            message_text=final_text, examples_str=examples_str, chat_id=chat.id,
+        parsed, err = await self._classify(
+            prompt, final_text, examples, examples_str, chat.id, norm_text=norm_text,
             extra_vars={"is_reply": is_reply_flag, "has_contact": has_contact_flag}
         )
+        return parsed
 
+    async def _moderate_apply(self, context, cs, chat, u, target_msg, target_ids: List[int], final_text: str,
+                              wm_to_close: Optional[int], wm_close_by: Optional[int], parsed: Optional[dict]):
+        """مرحلهٔ اقدام _moderate: ثبت تصمیم و هشدار/حذف/ژتون؛ ApplicationHandlerStop یعنی اقدام شد."""
         is_ad, score, reason, label = False, None, None, "NOT_AD"
         if parsed and isinstance(parsed, dict):
             label = str(parsed.get("label", "")).upper()
@@ -1921,12 +2402,12 @@ class AdsGuard:
                 score = float(score) if score is not None else None
             except Exception:
                 score = None
-            is_ad = (label == "AD") and (score is None or score >= self.chat_threshold(chat.id))
+            is_ad = (label == "AD") and (score is None or score >= self.chat_threshold(cs))
 
-        await asyncio.to_thread(
-            self._save_decision, chat.id, target_msg.message_id, u.id if u else None, final_text,
-            label, is_ad, score, reason
-        )
+        await self._decisions.put((
+            chat.id, target_msg.message_id, u.id if u else None, final_text,
+            label, bool(is_ad), score, reason, datetime.now(timezone.utc),
+        ))
 
         if not is_ad:
             # کپشن کافی و تبلیغاتی نیست => همان هشدار اینلاین را به «✅ کپشن دریافت شد» ادیت کن
@@ -1944,12 +2425,9 @@ class AdsGuard:
                 _mk = (chat.id, str(mgid))
                 if self._seen_media_groups.get(_mk, 0) > now - self._dedup_ttl_sec: return
                 self._seen_media_groups[_mk] = now
-                if len(self._seen_media_groups) > 2000:
-                    cutoff = now - self._dedup_ttl_sec
-                    self._seen_media_groups = {k:t for k,t in self._seen_media_groups.items() if t >= cutoff}
         except Exception: pass
 
-        act = self.chat_action(chat.id)
+        act = self.chat_action(cs)
 
         # --- Tokens (MVP-0): require 1 token per AD per week when act != 'delete' ---
         try:
@@ -1965,7 +2443,7 @@ class AdsGuard:
                 if not ok:
                     # سهمیه تمام است → پیام تبلیغاتی را حذف کن و اطلاع بده
                     try:
-                        await context.bot.delete_message(chat.id, target_msg.message_id)
+                        await self._delete_targets(context.bot, chat.id, target_ids)
                     except Exception:
                         pass
                     try:
@@ -2018,7 +2496,7 @@ class AdsGuard:
                 except Exception:
                     pass
                 try:
-                    await context.bot.delete_message(chat_id=chat.id, message_id=target_msg.message_id)
+                    await self._delete_targets(context.bot, chat.id, target_ids)
                     raise ApplicationHandlerStop()  # جلوگیری از ارسال هشدار بعد از حذف موفق
                 except Exception:
                     pass  # اگر حذف نشد، هشدار می‌دهیم
@@ -2031,7 +2509,7 @@ class AdsGuard:
             # --- جلوگیری از هشدارهای تکراری روی ادیت‌های پیاپی اما همچنان AD ---
             key = (chat.id, target_msg.message_id)
             now = time.time()
-            cd = max(0, int(self.chat_warn_edit_cooldown_sec(chat.id) or 0))
+            cd = max(0, int(self.chat_warn_edit_cooldown_sec(cs) or 0))
             last = self._ad_warn_ts.get(key, 0)
             if last and (now - last) < cd:
                 # اگر پیام هشدار قبلی را داریم، همان را ادیت کن (اختیاری برای UX بهتر)
@@ -2070,11 +2548,11 @@ class AdsGuard:
             
                 # ثبت زمان و شناسه پیام هشدار برای جلوگیری از تکرار
                 key = (chat.id, target_msg.message_id)
-                self._ad_warn_ts[key] = time.time()
+                self._ad_warn_ts.set(key, time.time(), ttl_sec=max(60, cd))
                 if wm and getattr(wm, "message_id", None):
-                    self._ad_warn_msgid[key] = wm.message_id
+                    self._ad_warn_msgid.set(key, wm.message_id, ttl_sec=max(60, cd))
             
-                sec = self.chat_autoclean_sec(chat.id)
+                sec = self.chat_autoclean_sec(cs)
                 if sec and sec > 0:
                     context.application.create_task(
                         self._delete_after(context.bot, chat.id, wm.message_id, sec)
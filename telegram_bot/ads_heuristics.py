@@ -0,0 +1,164 @@
+# ads_heuristics.py
+# -----------------------------------------------------------------------------
+# هیوریستیک‌های متنی AdsGuard (نیت درخواست، شبه‌تماس، دامنه‌ها) — کامپایل‌شده و یک‌باره
+# - همهٔ الگوها در زمان import کامپایل می‌شوند؛ هر دسته یک alternation واحد است
+# - analyze(text) همهٔ سیگنال‌ها (از جمله لینک‌ها به‌صورت host/path) را در یک عبور حساب می‌کند و یک TextSignals برمی‌گرداند
+# - نتیجه برای متن‌های اخیر memoize می‌شود (watchdog برای یک پیام چند بار می‌پرسد)
+# رفتار دقیقاً همان توابع قبلی AdsGuard است (_is_request_intent/_has_contact_like/_extract_domains).
+# ورودی معمولاً متن normalize_text‌شدهٔ همان آپدیت است (shared_utils.normalized_text).
+# -----------------------------------------------------------------------------
+from __future__ import annotations
+
+import re
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Optional, Tuple
+
+# الگوهای پایهٔ درخواست/راهنمایی (حالت‌های محاوره‌ای + نیم‌فاصله)
+_REQUEST_BASE = (
+    # میخوام/می‌خوام/میخواستم/می‌خواستم + املای رایجِ «میخاستم»
+    r"می\s*خوام", r"میخوام", r"می\s*خواستم", r"میخواستم", r"میخاستم",
+    r"نیاز(?:\s|‌)?دارم", r"دنبال",
+
+    # از کجا ... (می‌تونم/می‌شه/بخرم/تهیه کنم/گیر بیارم/پیدا کنم)
+    r"(?:از\s+)?کجا(?:ی)?(?:\s+\S+){0,8}\s+(?:می\s*تونم|می‌تونم|میتونم|می\s*شه|میشه|پیدا\s*کنم|بخرم|تهیه\s*کنم|گیر\s*بیارم|هست)",
+
+    # کلی: «کجا» و «پیدا می‌شه/می‌تونم»
+    r"کجا(?:ی)?",
+    r"پیدا(?:\s|‌)?(?:می[شس]ه|می\s*تونم|می‌تونم)?",
+
+    # راهنمایی/معرفی/پیشنهاد
+    r"راهنمایی(?:\s+کنید)?", r"معرفی(?:\s+کنید)?", r"پیشنهاد(?:\s|‌)?بدید",
+
+    # «چه/کدوم جنسی/مدلی ... استفاده کنیم/مناسبه/بهتره»
+    r"(?:چه|کدوم)(?:\s+\S+){0,8}\s+(?:استفاده\s*کنیم|مناسبه|بهتره)",
+
+    # «دارین ... بفرستین» یا «پی وی قیمت»
+    r"دار(?:ید|ین|ی)(?:\s+\S+){0,6}\s+بفرس(?:تین|تید)",
+    r"(?:پی\.?\s*وی|پیوی)\s*قیمت",
+
+    # قیمت/هزینه بپرسه حتی بدون «؟»
+    r"(?:قیمت|هزینه)\s*(?:بده|بدید|بدين|اعلام|لطفاً|لطفا|چنده|چقد(?:ر|ه))",
+    r"(?:دونه(?:\s*ای)?|تکی)\s*چند",
+
+    # «موجود دارید/داره؟»
+    r"(?:دوستان|همکار(?:ان|ای)|بچه(?:‌| )?ها|رفقا)(?:\s+\S+){0,6}\s+دار(?:ید|ین|ی)\s*[\?؟]",
+    r"(?:موجود|موجودی)\s+دار(?:ه|ید|ین|ن|ند)",
+)
+
+# «کسی ...» با فاصلهٔ آزاد بین «کسی» و فعل/عبارت تا 10 واژه
+_REQUEST_SOMEONE = (
+    r"(?:ا(?:گه|گر)\s+)?کسی(?:\s+\S+){0,10}\s+(?:هست|نیست)",
+    r"(?:ا(?:گه|گر)\s+)?کسی(?:\s+\S+){0,10}\s+اطلاع\s+دار(?:ه|ید|ین|ن|ند)",
+    r"(?:ا(?:گه|گر)\s+)?کسی(?:\s+\S+){0,10}\s+سراغ\s+دار(?:ه|ید|ین|ن|ند)",
+    r"(?:ا(?:گه|گر)\s+)?کسی(?:\s+\S+){0,10}\s+موجود\s+دار(?:ه|ید|ین|ن|ند)",
+    r"کسی(?:\s+\S+){0,10}\s+دار(?:ه|ید|ی|ن|ند)",
+    r"کسی(?:\s+\S+){0,10}\s+(?:می\s*تونه|می‌تونه|میتونه|بتونه|بتونید|بتونی|بتونن)",
+    r"کسی(?:\s+\S+){0,10}\s+(?:انجام\s*می(?:ده|دهد)|می\s*کنه|می‌کنه|می\s*کنن|می‌کنند|میکنه|میکنن)",
+    r"کسی(?:\s+\S+){0,10}\s+انجام\s+نمی(?:ده|دهد)\s*[\?؟]+",
+    r"کسی(?:\s+\S+){0,10}\s+می\s*شنا(?:س|سی|سید|سن)(?:ه)?",
+    r"کسی(?:\s+\S+){0,10}\s+ندار(?:ه|ید|ین|ن|ند)\s*[\?؟]",
+)
+
+
+def _alternation(patterns, flags=0) -> "re.Pattern[str]":
+    return re.compile("|".join(f"(?:{p})" for p in patterns), flags)
+
+
+_REQUEST_RE = _alternation(_REQUEST_BASE + _REQUEST_SOMEONE, re.IGNORECASE)
+_BUY_RE = re.compile(r"بخر|خرید|تهیه", re.IGNORECASE)
+_DIR_MARKS_RE = re.compile(r"[\u200c\u200f\u200e]")
+_SPACES_RE = re.compile(r"\s+")
+
+# شبه‌تماس (روی متن lowercase): موبایل ایران، شمارهٔ عمومی، لینک، آیدی تلگرام، ایمیل
+_CONTACT_RE = _alternation((
+    r"(\+?98|0)?9\d{9}",
+    r"\b\+?\d[\d\s\-]{8,}\d\b",
+    r"(https?://|www\.)\S+",
+    r"@\w{3,}",
+    r"t\.me/",
+    r"[\w\.-]+@[\w\.-]+\.[a-z]{2,}",
+))
+
+# دامنه‌ها: URL کامل (میزبان از netloc) + الگوی «چیزی.پسوند»
+_URL_RE = re.compile(r"https?://[^\s\)\]\>\<]+", re.IGNORECASE)
+_BARE_DOMAIN_RE = re.compile(
+    r"\b([A-Za-z0-9\u0600-\u06FF][A-Za-z0-9\.\-\u0600-\u06FF]*\.[A-Za-z\u0600-\u06FF]{2,})(?:/\S*)?\b",
+    re.IGNORECASE,
+)
+
+
+@dataclass(frozen=True, slots=True)
+class TextSignals:
+    request_intent: bool
+    has_contact: bool
+    domains: Tuple[str, ...]
+    links: Tuple[Tuple[str, str], ...]   # (host, path) برای تطبیق با whitelist مسیردار (مثل t.me/foo)
+
+
+def _url_host(url: str) -> Optional[str]:
+    """hostname مثل urllib.parse.urlparse(url).hostname، بدون هزینهٔ ساخت ParseResult."""
+    rest = url.split("://", 1)[1] if "://" in url else url
+    for sep in "/?#":
+        rest = rest.split(sep, 1)[0]
+    host = rest.rpartition("@")[2]
+    if host.startswith("["):
+        if "]" not in host:
+            return None   # urlparse این حالت را ValueError می‌دهد
+        host = host[1:host.index("]")]
+    else:
+        host = host.partition(":")[0]
+    return host.lower() or None
+
+
+def is_request_intent(text: str) -> bool:
+    """نیتِ درخواست/یافتن/راهنمایی در متن (مثلاً متن والدِ reply)."""
+    if not text:
+        return False
+    s = _SPACES_RE.sub(" ", _DIR_MARKS_RE.sub(" ", text.strip()))
+    if _REQUEST_RE.search(s):
+        return True
+    return ("?" in s or "؟" in s) and _BUY_RE.search(s) is not None
+
+
+def has_contact_like(text: str) -> bool:
+    """تشخیص سادهٔ شماره/لینک/آیدی/ایمیل در پیام."""
+    if not text:
+        return False
+    return _CONTACT_RE.search(text.lower()) is not None
+
+
+def _url_path(url: str) -> str:
+    rest = url.split("://", 1)[1] if "://" in url else url
+    i = rest.find("/")
+    return rest[i:] if i >= 0 else ""
+
+
+def extract_links(text: str) -> Tuple[Tuple[str, str], ...]:
+    """(host, path) هر لینک/دامنهٔ متن؛ path ممکن است خالی باشد."""
+    if not text:
+        return ()
+    cand = set()
+    for m in _URL_RE.findall(text):
+        host = _url_host(m)
+        if host:
+            cand.add((host, _url_path(m)))
+    for m in _BARE_DOMAIN_RE.finditer(text):
+        cand.add((m.group(1).lower(), m.group(0)[len(m.group(1)):]))
+    return tuple(sorted(cand))
+
+
+def extract_domains(text: str) -> Tuple[str, ...]:
+    return tuple(sorted({host for host, _ in extract_links(text)}))
+
+
+@lru_cache(maxsize=1024)
+def analyze(text: str) -> TextSignals:
+    """همهٔ سیگنال‌های هیوریستیک یک متن (memoize شده؛ خروجی immutable است)."""
+    links = extract_links(text)
+    return TextSignals(
+        request_intent=is_request_intent(text),
+        has_contact=has_contact_like(text),
+        domains=tuple(sorted({host for host, _ in links})),
+        links=links,
+    )
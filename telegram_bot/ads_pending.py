@@ -0,0 +1,210 @@
+# ads_pending.py
+# -----------------------------------------------------------------------------
+# ذخیرهٔ پایدار حذف‌های درانتظار AdsGuard (مدیای بدون کپشن) در جدول ads_pending_actions
+# - هر ردیف یک اقدام: nocap (اخطار اولیه) یا reopen (حذف کپشن با ویرایش)؛
+#   اعضای آلبوم با kind=album_member و همان mgid کنار اقدام اصلی ثبت می‌شوند
+# - write-through از AdsGuard؛ در startup دوباره در حافظه و TimerWheel بارگذاری می‌شود
+# - claim با FOR UPDATE SKIP LOCKED و lease (claimed_until) تا چند worker/رپلیکا
+#   بدون اجرای تکراری بار را تقسیم کنند؛ اگر worker وسط کار بمیرد، بعد از lease دوباره due می‌شود
+# همهٔ متدها sync هستند (در executor اختصاصی AdsGuard اجرا می‌شوند تا ترتیب نوشتن‌ها حفظ شود).
+# -----------------------------------------------------------------------------
+from __future__ import annotations
+
+import json
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+ACTION_KINDS = ("nocap", "reopen")
+
+_RETURNING = "RETURNING p.chat_id, p.message_id, p.kind, p.mgid, p.warn_msg_id, p.data"
+
+
+class PendingStore:
+    def __init__(self, get_db_conn: Callable):
+        self._conn = get_db_conn
+
+    # ---------- write-through ----------
+    def put(self, chat_id: int, message_id: int, kind: str, delay_sec: float,
+            mgid: Optional[str], warn_msg_id: Optional[int], rec: dict) -> None:
+        """ثبت/جایگزینی اقدام درانتظار یک پیام (اقدام قبلی همان پیام حذف می‌شود)."""
+        with self._conn() as conn, conn.cursor() as cur:
+            cur.execute(
+                "DELETE FROM ads_pending_actions WHERE chat_id=%s AND message_id=%s AND kind = ANY(%s)",
+                (chat_id, message_id, list(ACTION_KINDS)),
+            )
+            cur.execute(
+                """
+                INSERT INTO ads_pending_actions (chat_id, message_id, kind, due_at, mgid, warn_msg_id, data)
+                VALUES (%s, %s, %s, NOW() + make_interval(secs => %s), %s, %s, %s::jsonb)
+                """,
+                (chat_id, message_id, kind, float(delay_sec), mgid, warn_msg_id, json.dumps(rec, default=str)),
+            )
+            conn.commit()
+
+    def add_album_member(self, chat_id: int, message_id: int, mgid: str, ttl_sec: float) -> None:
+        """عضو آلبوم درانتظار؛ due_at فقط برای پاک‌سازی ردیف‌های یتیم است."""
+        with self._conn() as conn, conn.cursor() as cur:
+            cur.execute(
+                """
+                INSERT INTO ads_pending_actions (chat_id, message_id, kind, due_at, mgid)
+                VALUES (%s, %s, 'album_member', NOW() + make_interval(secs => %s), %s)
+                ON CONFLICT (chat_id, message_id, kind) DO NOTHING
+                """,
+                (chat_id, message_id, float(ttl_sec), mgid),
+            )
+            conn.commit()
+
+    def drop(self, chat_id: int, message_id: int, mgid: Optional[str] = None) -> None:
+        """لغو اقدام (کپشن اضافه شد) به‌همراه اعضای آلبومش."""
+        with self._conn() as conn, conn.cursor() as cur:
+            cur.execute(
+                """
+                DELETE FROM ads_pending_actions
+                 WHERE chat_id = %s
+                   AND ((message_id = %s AND kind = ANY(%s))
+                        OR (%s::text IS NOT NULL AND kind = 'album_member' AND mgid = %s))
+                """,
+                (chat_id, message_id, list(ACTION_KINDS), mgid, mgid),
+            )
+            conn.commit()
+
+    # ---------- claim / finish ----------
+    def claim_keys(self, keys: Iterable[Tuple[int, int]], lease_sec: float) -> Tuple[List[dict], Set[Tuple[int, int]]]:
+        """
+        claim اقدام‌های همین کلیدها (تایمر محلی سررسید شده).
+        خروجی: (ردیف‌های claim‌شده، کلیدهایی که ردیفشان هست ولی در اختیار worker دیگری است).
+        کلیدی که در هیچ‌کدام نیست ردیف پایدار ندارد (مثلاً write-through نرسیده) و باید محلی اجرا شود.
+        """
+        keys = list(keys)
+        if not keys:
+            return [], set()
+        chat_ids, msg_ids = [k[0] for k in keys], [k[1] for k in keys]
+        with self._conn() as conn, conn.cursor() as cur:
+            cur.execute(
+                f"""
+                UPDATE ads_pending_actions p
+                   SET claimed_until = NOW() + make_interval(secs => %s)
+                  FROM (SELECT a.chat_id, a.message_id, a.kind
+                          FROM ads_pending_actions a
+                          JOIN unnest(%s::bigint[], %s::bigint[]) AS k(chat_id, message_id)
+                            ON a.chat_id = k.chat_id AND a.message_id = k.message_id
+                         WHERE a.kind = ANY(%s)
+                           AND (a.claimed_until IS NULL OR a.claimed_until < NOW())
+                         FOR UPDATE OF a SKIP LOCKED) d
+                 WHERE p.chat_id = d.chat_id AND p.message_id = d.message_id AND p.kind = d.kind
+                {_RETURNING}
+                """,
+                (float(lease_sec), chat_ids, msg_ids, list(ACTION_KINDS)),
+            )
+            rows = self._rows(cur, cur.fetchall())
+            cur.execute(
+                """
+                SELECT a.chat_id, a.message_id
+                  FROM ads_pending_actions a
+                  JOIN unnest(%s::bigint[], %s::bigint[]) AS k(chat_id, message_id)
+                    ON a.chat_id = k.chat_id AND a.message_id = k.message_id
+                 WHERE a.kind = ANY(%s)
+                """,
+                (chat_ids, msg_ids, list(ACTION_KINDS)),
+            )
+            mine = {(r["chat_id"], r["message_id"]) for r in rows}
+            busy = {(int(c), int(m)) for c, m in cur.fetchall()} - mine
+            conn.commit()
+        return rows, busy
+
+    def claim_due(self, limit: int, lease_sec: float) -> List[dict]:
+        """claim دسته‌ای ردیف‌های سررسیده (از اجرای قبلی یا worker ازکارافتاده) به ترتیب due_at."""
+        with self._conn() as conn, conn.cursor() as cur:
+            cur.execute(
+                f"""
+                UPDATE ads_pending_actions p
+                   SET claimed_until = NOW() + make_interval(secs => %s)
+                  FROM (SELECT chat_id, message_id, kind
+                          FROM ads_pending_actions
+                         WHERE due_at <= NOW()
+                           AND (claimed_until IS NULL OR claimed_until < NOW())
+                         ORDER BY due_at
+                         LIMIT %s
+                         FOR UPDATE SKIP LOCKED) d
+                 WHERE p.chat_id = d.chat_id AND p.message_id = d.message_id AND p.kind = d.kind
+                {_RETURNING}
+                """,
+                (float(lease_sec), int(limit)),
+            )
+            rows = self._rows(cur, cur.fetchall())
+            conn.commit()
+        return rows
+
+    def finish(self, done: Iterable[Tuple[int, int, str, Optional[str]]]) -> None:
+        """حذف ردیف‌های انجام‌شده: (chat_id, message_id, kind, mgid) + اعضای آلبوم همان mgid."""
+        done = list(done)
+        if not done:
+            return
+        with self._conn() as conn, conn.cursor() as cur:
+            for chat_id, message_id, kind, mgid in done:
+                cur.execute(
+                    """
+                    DELETE FROM ads_pending_actions
+                     WHERE chat_id = %s
+                       AND ((message_id = %s AND kind = %s)
+                            OR (%s::text IS NOT NULL AND %s <> 'album_member'
+                                AND kind = 'album_member' AND mgid = %s))
+                    """,
+                    (chat_id, message_id, kind, mgid, kind, mgid),
+                )
+            conn.commit()
+
+    # ---------- startup ----------
+    def load(self, limit: int) -> List[dict]:
+        """اقدام‌های claim‌نشده برای بازسازی state حافظه؛ remaining_sec می‌تواند منفی (سررسیده) باشد."""
+        with self._conn() as conn, conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT chat_id, message_id, kind, mgid, warn_msg_id, data,
+                       EXTRACT(EPOCH FROM (due_at - NOW()))
+                  FROM ads_pending_actions
+                 WHERE kind = ANY(%s)
+                   AND (claimed_until IS NULL OR claimed_until < NOW())
+                 ORDER BY due_at
+                 LIMIT %s
+                """,
+                (list(ACTION_KINDS), int(limit)),
+            )
+            raw = cur.fetchall()
+            rows = self._rows(cur, [r[:6] for r in raw])
+            for row, r in zip(rows, raw):
+                row["remaining_sec"] = float(r[6] or 0.0)
+        return rows
+
+    # ---------- داخلی ----------
+    @staticmethod
+    def _rows(cur, fetched) -> List[dict]:
+        """تبدیل ردیف‌ها به dict و افزودن شناسهٔ اعضای آلبوم (album_ids) برای اقدام‌های آلبومی."""
+        rows = []
+        groups: Dict[Tuple[int, str], List[dict]] = {}
+        for chat_id, message_id, kind, mgid, warn_msg_id, data in fetched:
+            if isinstance(data, str):
+                data = json.loads(data or "{}")
+            row = {
+                "chat_id": int(chat_id), "message_id": int(message_id), "kind": kind,
+                "mgid": mgid, "warn_msg_id": int(warn_msg_id) if warn_msg_id else None,
+                "data": data or {}, "album_ids": [],
+            }
+            rows.append(row)
+            if mgid and kind in ACTION_KINDS:
+                groups.setdefault((row["chat_id"], mgid), []).append(row)
+        if groups:
+            cur.execute(
+                """
+                SELECT a.chat_id, a.mgid, a.message_id
+                  FROM ads_pending_actions a
+                  JOIN unnest(%s::bigint[], %s::text[]) AS g(chat_id, mgid)
+                    ON a.chat_id = g.chat_id AND a.mgid = g.mgid
+                 WHERE a.kind = 'album_member'
+                 ORDER BY a.message_id
+                """,
+                ([g[0] for g in groups], [g[1] for g in groups]),
+            )
+            for chat_id, mgid, message_id in cur.fetchall():
+                for row in groups.get((int(chat_id), mgid), ()):
+                    row["album_ids"].append(int(message_id))
+        return rows
@@ -0,0 +1,156 @@
+# ads_prefilter.py
+# -----------------------------------------------------------------------------
+# پیش‌طبقه‌بند محلی تبلیغات (قبل از Flowise)
+# - ویژگی: char n-gram (۲ تا ۴) روی متن نرمال‌شده، hash شده با crc32 در DIM سطل
+# - مدل: Multinomial Naive Bayes با NumPy (یک مدل برای هر گروه)
+# - آموزش: در ProcessPool جدا (spawn) تا event loop و GIL درگیر نشوند
+# - پیش‌بینی: در حافظه و بدون I/O؛ اگر NumPy نصب نباشد کل لایه غیرفعال است
+# این ماژول در سطح import به shared_utils وابسته نیست تا worker (spawn) سبک بماند.
+# -----------------------------------------------------------------------------
+from __future__ import annotations
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple
+
+try:
+    import numpy as np
+except Exception:  # NumPy اختیاری است
+    np = None
+
+log = logging.getLogger("ads_prefilter")
+
+DIM = int(os.getenv("ADS_LOCAL_DIM", str(1 << 15)))
+NGRAMS = (2, 3, 4)
+ALPHA = float(os.getenv("ADS_LOCAL_ALPHA", "0.5"))                 # Laplace/Lidstone smoothing
+MIN_PER_CLASS = int(os.getenv("ADS_LOCAL_MIN_PER_CLASS", "8"))      # کمتر از این → مدلی نمی‌سازیم
+RETRAIN_MIN_SEC = float(os.getenv("ADS_LOCAL_RETRAIN_MIN_SEC", "60"))   # debounce بین دو آموزش یک گروه
+RETRAIN_MAX_AGE_SEC = float(os.getenv("ADS_LOCAL_RETRAIN_MAX_AGE_SEC", "3600"))  # تازه‌سازی دوره‌ای (تصمیم‌های جدید)
+
+
+def available() -> bool:
+    return np is not None
+
+
+def char_ngram_features(text: str, dim: int = DIM) -> List[int]:
+    """اندیس سطل‌های hash برای n-gramهای کاراکتری (متن باید از قبل نرمال شده باشد)."""
+    t = f" {text} "
+    out: List[int] = []
+    for n in NGRAMS:
+        for i in range(len(t) - n + 1):
+            out.append(zlib.crc32(t[i:i + n].encode("utf-8")) % dim)
+    return out
+
+
+def _train(texts: List[str], labels: List[int], dim: int = DIM, alpha: float = ALPHA):
+    """
+    آموزش NB در پروسهٔ worker. labels: 1=AD، 0=NOT_AD.
+    خروجی: (log_prior[2], log_lik[2, dim]) به‌صورت float32.
+    """
+    counts = np.zeros((2, dim), dtype=np.float64)
+    docs = np.zeros(2, dtype=np.float64)
+    for text, y in zip(texts, labels):
+        idx = char_ngram_features(text, dim)
+        if idx:
+            np.add.at(counts[y], np.asarray(idx, dtype=np.int64), 1.0)
+        docs[y] += 1.0
+    log_prior = np.log(docs / docs.sum())
+    smoothed = counts + alpha
+    log_lik = np.log(smoothed) - np.log(smoothed.sum(axis=1, keepdims=True))
+    return log_prior.astype(np.float32), log_lik.astype(np.float32)
+
+
+class _ChatModel:
+    __slots__ = ("log_prior", "log_lik", "version", "n_samples", "trained_at")
+
+    def __init__(self, log_prior, log_lik, version: str, n_samples: int):
+        self.log_prior = log_prior
+        self.log_lik = log_lik
+        self.version = version
+        self.n_samples = n_samples
+        self.trained_at = time.monotonic()
+
+    def p_ad(self, norm_text: str) -> float:
+        idx = char_ngram_features(norm_text, self.log_lik.shape[1])
+        if not idx:
+            return float(np.exp(self.log_prior[1]))
+        s = self.log_prior + self.log_lik[:, np.asarray(idx, dtype=np.int64)].sum(axis=1)
+        d = float(s[0] - s[1])
+        if d > 50:
+            return 0.0
+        return 1.0 / (1.0 + float(np.exp(d)))
+
+
+class AdsPrefilter:
+    """
+    نگهدارندهٔ مدل‌های محلی هر گروه.
+    fetch_training(chat_id) → (texts, labels) به‌صورت sync (داخل to_thread اجرا می‌شود).
+    """
+
+    def __init__(self, fetch_training: Callable[[int], Tuple[List[str], List[int]]]):
+        self._fetch = fetch_training
+        self._models: Dict[int, _ChatModel] = {}
+        self._wanted: Dict[int, Tuple[str, float]] = {}   # chat_id → (نسخهٔ آموزش‌دیده یا در حال آموزش, زمان شروع)
+        self._tasks: set = set()
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+    def predict(self, chat_id: int, norm_text: str) -> Optional[float]:
+        """احتمال AD یا None اگر برای این گروه مدلی نداریم."""
+        m = self._models.get(chat_id)
+        if m is None or not norm_text:
+            return None
+        try:
+            return m.p_ad(norm_text)
+        except Exception:
+            return None
+
+    def maybe_retrain(self, chat_id: int, version: str) -> None:
+        """اگر نمونه‌ها عوض شده‌اند (یا مدل کهنه است) آموزش پس‌زمینه را زمان‌بندی می‌کند."""
+        if np is None:
+            return
+        now = time.monotonic()
+        wanted = self._wanted.get(chat_id)
+        if wanted is not None:
+            v, started = wanted
+            if now - started < RETRAIN_MIN_SEC:
+                return
+            if v == version and now - started < RETRAIN_MAX_AGE_SEC:
+                return
+        self._wanted[chat_id] = (version, now)
+        task = asyncio.get_running_loop().create_task(self._retrain(chat_id, version))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def invalidate(self, chat_id: int) -> None:
+        """حذف مدل یک گروه (مثلاً بعد از پاک‌کردن نمونه‌ها)."""
+        self._models.pop(chat_id, None)
+        self._wanted.pop(chat_id, None)
+
+    async def _retrain(self, chat_id: int, version: str) -> None:
+        try:
+            texts, labels = await asyncio.to_thread(self._fetch, chat_id)
+            pos = sum(1 for y in labels if y == 1)
+            if pos < MIN_PER_CLASS or (len(labels) - pos) < MIN_PER_CLASS:
+                self._models.pop(chat_id, None)
+                return
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"))
+            log_prior, log_lik = await asyncio.get_running_loop().run_in_executor(
+                self._pool, _train, texts, labels, DIM, ALPHA
+            )
+            self._models[chat_id] = _ChatModel(log_prior, log_lik, version, len(labels))
+            log.info("[ads] local model trained chat=%s samples=%s (ad=%s)", chat_id, len(labels), pos)
+        except Exception as e:
+            log.warning("[ads] local model training failed chat=%s: %s", chat_id, e)
+
+    def shutdown(self) -> None:
+        for t in list(self._tasks):
+            t.cancel()
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
@@ -0,0 +1,163 @@
+# ads_queue.py
+# -----------------------------------------------------------------------------
+# صف نظارت به ازای هر گروه (actor) برای AdsGuard
+# - به‌جای رد کردن پیام‌های داخل min_gap، هر پیام در صف محدود همان گروه می‌نشیند
+# - هر گروه یک worker دارد: شروع دوره‌ها حداقل min_gap از هم فاصله دارند؛ worker پس از خالی شدن
+#   صف تا پایان min_gap زنده می‌ماند تا پیام بعدی هم همین فاصله را رعایت کند
+# - هر پیام دو مرحله دارد: classify (طبقه‌بندی) و apply (اقدام). در هر دوره تا batch_max پیام
+#   هم‌زمان طبقه‌بندی می‌شوند (تا _AdsBatcher آن‌ها را در یک prediction جمع کند) و اقدام‌ها
+#   به ترتیب رسیدن، یکی‌یکی اجرا می‌شوند (اقدام‌های یک گروه هرگز هم‌زمان نیستند)
+# - گروه‌های مختلف موازی‌اند، با سقف سراسری global_concurrency روی طبقه‌بندی‌ها
+# - سرریز: قدیمی‌ترین پیام صف کنار می‌رود؛ پیام تکراری (همان key) به future موجود وصل می‌شود
+# - متریک‌ها (اختیاری): backlog کل صف‌ها (بدون برچسب گروه)، زمان انتظار در صف، پیام‌های کنار رفته
+# -----------------------------------------------------------------------------
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Hashable, Optional
+
+log = logging.getLogger("ads_queue")
+
+Classify = Callable[[], Awaitable[Any]]
+Apply = Callable[[Any], Awaitable[Any]]
+
+
+class _Item:
+    __slots__ = ("key", "classify", "apply", "fut", "t0")
+
+    def __init__(self, key: Hashable, classify: Classify, apply: Apply, fut: asyncio.Future):
+        self.key = key
+        self.classify = classify
+        self.apply = apply
+        self.fut = fut
+        self.t0 = time.monotonic()
+
+
+class _Lane:
+    __slots__ = ("items", "keys", "min_gap", "last_start", "worker")
+
+    def __init__(self):
+        self.items: Deque[_Item] = deque()
+        self.keys: Dict[Hashable, _Item] = {}
+        self.min_gap = 0.0
+        self.last_start = 0.0
+        self.worker: Optional[asyncio.Task] = None
+
+
+class ChatModerationQueue:
+    def __init__(
+        self,
+        max_per_chat: int,
+        global_concurrency: int,
+        batch_max: int = 8,
+        *,
+        backlog_gauge=None,
+        wait_histogram=None,
+        dropped_counter=None,
+    ):
+        self._max = max(1, int(max_per_chat))
+        self._sem = asyncio.Semaphore(max(1, int(global_concurrency)))
+        self._batch_max = max(1, int(batch_max))
+        self._lanes: Dict[int, _Lane] = {}
+        self._queued = 0
+        self._backlog = backlog_gauge
+        self._wait = wait_histogram
+        self._dropped = dropped_counter
+
+    def backlog(self, chat_id: int) -> int:
+        lane = self._lanes.get(chat_id)
+        return len(lane.items) if lane else 0
+
+    def submit(self, chat_id: int, key: Hashable, classify: Classify, apply: Apply, min_gap: float) -> asyncio.Future:
+        """
+        پیام را در صف گروه می‌گذارد و future نتیجه‌اش را برمی‌گرداند: apply(await classify()).
+        future پیامی که به‌خاطر سرریز کنار برود (یا classify/apply آن خطا دهد) با None کامل می‌شود.
+        """
+        lane = self._lanes.get(chat_id)
+        if lane is None:
+            lane = self._lanes[chat_id] = _Lane()
+        lane.min_gap = max(0.0, float(min_gap))
+        dup = lane.keys.get(key)
+        if dup is not None:
+            self._drop_metric("coalesced")
+            return dup.fut
+        if len(lane.items) >= self._max:
+            old = self._pop(lane)
+            if not old.fut.done():
+                old.fut.set_result(None)
+            self._drop_metric("overflow")
+        item = _Item(key, classify, apply, asyncio.get_running_loop().create_future())
+        lane.items.append(item)
+        lane.keys[key] = item
+        self._queued += 1
+        self._publish()
+        if lane.worker is None or lane.worker.done():
+            lane.worker = asyncio.get_running_loop().create_task(self._run_lane(chat_id, lane))
+        return item.fut
+
+    # ---------- داخلی ----------
+    def _drop_metric(self, reason: str) -> None:
+        if self._dropped is not None:
+            self._dropped.labels(reason=reason).inc()
+
+    def _pop(self, lane: _Lane) -> _Item:
+        it = lane.items.popleft()
+        lane.keys.pop(it.key, None)
+        self._queued -= 1
+        self._publish()
+        return it
+
+    def _publish(self) -> None:
+        # یک سری سراسری؛ برچسب chat_id کاردینالیتی نامحدود می‌ساخت
+        if self._backlog is not None:
+            self._backlog.set(self._queued)
+
+    async def _classify(self, it: _Item) -> Any:
+        async with self._sem:
+            return await it.classify()
+
+    async def _run_lane(self, chat_id: int, lane: _Lane) -> None:
+        batch: list = []
+        try:
+            while True:
+                while lane.items:
+                    delay = lane.last_start + lane.min_gap - time.monotonic()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                    lane.last_start = time.monotonic()
+                    # یک دوره: طبقه‌بندی هم‌زمانِ تا batch_max پیام، سپس اقدام‌ها به ترتیب
+                    batch = [self._pop(lane) for _ in range(min(self._batch_max, len(lane.items)))]
+                    if self._wait is not None:
+                        for it in batch:
+                            self._wait.observe(lane.last_start - it.t0)
+                    verdicts = await asyncio.gather(
+                        *(self._classify(it) for it in batch), return_exceptions=True
+                    )
+                    for it, verdict in zip(batch, verdicts):
+                        res = None
+                        if isinstance(verdict, Exception):
+                            log.warning("[ads] classification failed in chat %s: %s", chat_id, verdict)
+                        elif isinstance(verdict, BaseException):
+                            raise verdict
+                        else:
+                            try:
+                                res = await it.apply(verdict)
+                            except Exception as e:
+                                log.warning("[ads] moderation action failed in chat %s: %s", chat_id, e)
+                        if not it.fut.done():
+                            it.fut.set_result(res)
+                    batch = []
+                # تا پایان min_gap زنده بمان؛ پیامی که در این فاصله برسد همان فاصله را رعایت می‌کند
+                idle = lane.last_start + lane.min_gap - time.monotonic()
+                if idle <= 0:
+                    break
+                await asyncio.sleep(idle)
+        finally:
+            for it in batch:   # worker وسط دوره cancel شد
+                if not it.fut.done():
+                    it.fut.set_result(None)
+            if not lane.items and self._lanes.get(chat_id) is lane:
+                self._lanes.pop(chat_id, None)
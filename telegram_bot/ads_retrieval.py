@@ -0,0 +1,141 @@
+# ads_retrieval.py
+# -----------------------------------------------------------------------------
+# انتخاب few-shot بر اساس شباهت (حالت ads_examples_select = similar)
+# - ایندکس درون‌حافظه‌ای هر گروه روی ads_examples: TF-IDF روی n-gramهای کاراکتری hash‌شده
+# - ذخیرهٔ sparse (CSR دستی با NumPy) تا کتابخانهٔ بزرگ نمونه‌ها هم حافظهٔ کمی بگیرد
+# - پرس‌وجو: cosine با np.add.reduceat و top-k جدا برای AD و NOT_AD
+# - ساخت مجدد: با invalidate (افزودن/حذف نمونه) یا بعد از TTL (برای چند رپلیکا)
+# -----------------------------------------------------------------------------
+from __future__ import annotations
+
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, List, Optional, Tuple
+
+from ads_prefilter import DIM, char_ngram_features, np
+
+log = logging.getLogger("ads_retrieval")
+
+Example = Tuple[int, str, str, str]   # (id, text, ts, label)
+
+INDEX_TTL_SEC = float(os.getenv("ADS_RETRIEVAL_TTL_SEC", "600"))
+MAX_CHATS = int(os.getenv("ADS_RETRIEVAL_MAX_CHATS", "500"))
+
+
+def available() -> bool:
+    return np is not None
+
+
+class _ChatIndex:
+    __slots__ = ("rows", "is_ad", "indptr", "indices", "data", "idf", "built_at")
+
+    def __init__(self, rows: List[Example], norm_texts: List[str]):
+        self.built_at = time.monotonic()
+        keep_rows, idx_parts, tf_parts, lengths = [], [], [], []
+        for row, text in zip(rows, norm_texts):
+            feats = char_ngram_features(text, DIM)
+            if not feats:
+                continue
+            uniq, cnt = np.unique(np.asarray(feats, dtype=np.int64), return_counts=True)
+            keep_rows.append(row)
+            idx_parts.append(uniq)
+            tf_parts.append(1.0 + np.log(cnt.astype(np.float32)))   # sublinear tf
+            lengths.append(len(uniq))
+        self.rows = keep_rows
+        self.is_ad = np.asarray([str(r[3]).upper() == "AD" for r in keep_rows], dtype=bool)
+        if not keep_rows:
+            self.indptr = self.indices = self.data = self.idf = None
+            return
+        self.indptr = np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)
+        self.indices = np.concatenate(idx_parts)
+        df = np.bincount(self.indices, minlength=DIM).astype(np.float32)
+        self.idf = (np.log((1.0 + len(keep_rows)) / (1.0 + df)) + 1.0).astype(np.float32)
+        data = np.concatenate(tf_parts) * self.idf[self.indices]
+        norms = np.sqrt(np.add.reduceat(data * data, self.indptr[:-1]))
+        data /= np.repeat(np.maximum(norms, 1e-9), lengths)
+        self.data = data.astype(np.float32)
+
+    def scores(self, norm_text: str):
+        feats = char_ngram_features(norm_text, DIM)
+        if not feats or self.indices is None:
+            return None
+        uniq, cnt = np.unique(np.asarray(feats, dtype=np.int64), return_counts=True)
+        w = (1.0 + np.log(cnt.astype(np.float32))) * self.idf[uniq]
+        n = float(np.sqrt((w * w).sum()))
+        if n <= 0:
+            return None
+        q = np.zeros(DIM, dtype=np.float32)
+        q[uniq] = w / n
+        return np.add.reduceat(q[self.indices] * self.data, self.indptr[:-1])
+
+
+class ExampleRetriever:
+    """
+    ایندکس‌های شباهت نمونه‌ها به ازای هر گروه (تعداد گروه‌ها LRU محدود).
+    load_examples(chat_id) → [(id, text, ts, label), ...] به‌صورت sync.
+    normalize: همان نرمال‌ساز مشترک پروژه (برای یکسان بودن با بقیهٔ مسیرها).
+    """
+
+    def __init__(self, load_examples: Callable[[int], List[Example]], normalize: Callable[[str], str]):
+        self._load = load_examples
+        self._norm = normalize
+        self._chats: "OrderedDict[int, _ChatIndex]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def invalidate(self, chat_id: Optional[int] = None) -> None:
+        with self._lock:
+            if chat_id is None:
+                self._chats.clear()
+            else:
+                self._chats.pop(chat_id, None)
+
+    def has_index(self, chat_id: int) -> bool:
+        """آیا ایندکس تازهٔ این گروه در حافظه هست (یعنی top_k بدون I/O جواب می‌دهد)؟"""
+        with self._lock:
+            idx = self._chats.get(chat_id)
+            return idx is not None and time.monotonic() - idx.built_at <= INDEX_TTL_SEC
+
+    def _index(self, chat_id: int) -> _ChatIndex:
+        with self._lock:
+            idx = self._chats.get(chat_id)
+            if idx is not None and time.monotonic() - idx.built_at <= INDEX_TTL_SEC:
+                self._chats.move_to_end(chat_id)
+                return idx
+        rows = self._load(chat_id)
+        idx = _ChatIndex(rows, [self._norm(r[1]) for r in rows])
+        with self._lock:
+            self._chats[chat_id] = idx
+            self._chats.move_to_end(chat_id)
+            while len(self._chats) > MAX_CHATS:
+                self._chats.popitem(last=False)
+        return idx
+
+    def top_k(self, chat_id: int, norm_text: str, k: int) -> Optional[List[Example]]:
+        """
+        norm_text: متن پیام که از قبل با همان normalize نرمال شده است.
+        k نمونهٔ شبیه‌تر (نیمی AD، نیمی NOT_AD؛ اگر یک برچسب کم بود از دیگری پر می‌شود).
+        None یعنی ایندکس/متن قابل استفاده نیست و باید به روش قبلی برگشت.
+        """
+        if np is None or k <= 0:
+            return None
+        idx = self._index(chat_id)
+        if not idx.rows:
+            return []
+        sc = idx.scores(norm_text)
+        if sc is None:
+            return None
+        order = np.argsort(-sc, kind="stable")
+        want_ad = k // 2
+        want_not = k - want_ad
+        ads = [int(i) for i in order if idx.is_ad[i]]
+        nots = [int(i) for i in order if not idx.is_ad[i]]
+        pick = ads[:want_ad] + nots[:want_not]
+        if len(pick) < k:
+            taken = set(pick)
+            rest = [i for i in order.tolist() if i not in taken]
+            pick += rest[:k - len(pick)]
+        pick.sort(key=lambda i: -float(sc[i]))
+        return [idx.rows[i] for i in pick]
@@ -1,6 +1,6 @@
 import asyncio
 import os, logging
-from flowise_client import ping_flowise
+from flowise_client import ping_flowise_async, close_session as close_flowise_session
 from datetime import timedelta
 os.makedirs("/app/logs", exist_ok=True)
 
@@ -14,7 +14,8 @@ from shared_utils import (
     BOT_TOKEN, FLOWISE_BASE_URL, FLOWISE_API_KEY,
     is_admin, db_conn, wait_for_db_ready, ensure_tables,
     get_config, set_config,  # ← اضافه شد: خواندن/نوشتن تنظیمات سراسری در DB
-    MET_FLOWISE_UP, MET_BOT_ERRORS
+    start_config_listener, stop_config_listener,
+    MET_BOT_ERRORS
 )  # noqa: E402
 
 from admin_commands import loglevel_cmd, lognoise_cmd, audit_cmd
@@ -48,7 +49,7 @@ async def _flowise_warmup_job(context):
     پینگ ادواری به Flowise برای گرم نگه‌داشتن chatflow
     - وقتی ID خالی باشد با لاگ واضح «skipped» رد می‌شود
     - در خطای 412 پیام راهنما می‌دهد
-    - متریک flowise_up را ۱/۰ می‌کند
+    - متریک flowise_up را فقط breaker در flowise_client می‌نویسد، نه این job
     """
     try:
         from shared_utils import get_config  # DB-first
@@ -66,7 +67,6 @@ async def _flowise_warmup_job(context):
 
 
         if not base or not cfid:
-            MET_FLOWISE_UP.set(0)  # بدون پیکربندی معتبر، فعلاً down بدان
             logger.debug(
                 "Flowise warmup skipped: base or chatflow id is empty [base=%r, cfid=%r]",
                 base, cfid
@@ -74,19 +74,16 @@ async def _flowise_warmup_job(context):
 
             return
 
-        ok, ms, err = await asyncio.to_thread(ping_flowise, base, cfid, api_key, 8)
+        ok, ms, err = await ping_flowise_async(base, cfid, api_key, 8)
         if ok:
-            MET_FLOWISE_UP.set(1)
             logger.debug("Flowise warmed in %sms [base=%s chatflow=%s]", ms, base, cfid)
         else:
-            MET_FLOWISE_UP.set(0)
             hint = ""
             if "id not provided" in str(err).lower():
                 hint = " (راهنما: یکی از WARMUP_CHATFLOW_ID یا MULTITENANT_CHATFLOW_ID یا CHATFLOW_ID را ست کنید)"
             logger.warning("Flowise warmup failed: %s (in %sms) [base=%s chatflow=%s]%s",
                            err, ms, base, cfid, hint)
     except Exception:
-        MET_FLOWISE_UP.set(0)
         logger.exception("Warmup job error")
 
 
@@ -173,6 +170,19 @@ def _seed_env_defaults_to_db():
 
 
 
+async def _ads_pending_sweep_job(context):
+    """اجرای حذف‌های سررسیدهٔ ads_pending_actions که تایمر محلی‌شان در این پروسه نیست."""
+    ads = context.application.bot_data.get("ads_guard")
+    if not ads:
+        return
+    try:
+        n = await ads.sweep_pending(context.bot)
+        if n:
+            log.info(f"ads pending sweep: handled {n} due action(s)")
+    except Exception as e:
+        log.warning(f"ads pending sweep failed: {e}")
+
+
 # تابع غیرفعال‌سازی Webhook و راه‌اندازی اولیه (Startup)
 async def _on_startup(app):
     try:
@@ -184,6 +194,7 @@ async def _on_startup(app):
     await wait_for_db_ready(max_wait_sec=90)
     ensure_tables()
     _seed_env_defaults_to_db()   # ← پیش‌فرض‌های ENV فقط اگر در DB نبودند، seed می‌شوند
+    start_config_listener()      # ← invalidation کش تنظیمات با LISTEN/NOTIFY (بین همهٔ رپلیکاها)
     await _set_menu_commands(app.bot)
 
     # ساخت جداول اختصاصی AdsGuard (در صورت استفاده)
@@ -192,9 +203,25 @@ async def _on_startup(app):
             await asyncio.get_running_loop().run_in_executor(
                 None, app.bot_data["ads_guard"].ensure_tables
             )
+            # ایندکس near-dup تبلیغات از اجرای قبلی
+            await asyncio.to_thread(app.bot_data["ads_guard"].load_state)
     except Exception:
         pass
 
+    # حذف‌های درانتظار مدیای بدون کپشن از قبل از ری‌استارت + sweep دوره‌ای ردیف‌های سررسیده (بین رپلیکاها)
+    ads = app.bot_data.get("ads_guard")
+    if ads:
+        try:
+            await ads.restore_pending(app.bot)
+        except Exception as e:
+            log.warning(f"ads pending restore failed (ignored): {e}")
+        app.job_queue.run_repeating(
+            _ads_pending_sweep_job,
+            interval=timedelta(seconds=ads.pending_sweep_sec),
+            first=timedelta(seconds=ads.pending_sweep_sec),
+            name="ads-pending-sweep",
+        )
+
     # کش کردن اطلاعات بات برای استفاده در سایر بخش‌ها (افزایش کارایی)
     me = await app.bot.get_me()
     app.bot_data["me"] = me
@@ -215,6 +242,24 @@ async def _on_startup(app):
     )
 
 
+async def _on_shutdown(app):
+    """پاک‌سازی منابع پس‌زمینه هنگام خاموشی."""
+    try:
+        stop_config_listener()
+    except Exception:
+        pass
+    try:
+        await close_flowise_session()
+    except Exception:
+        pass
+    try:
+        ads = app.bot_data.get("ads_guard")
+        if ads:
+            await ads.shutdown()
+    except Exception:
+        pass
+
+
 # تنظیم منوی دستورات برای حالت خصوصی و گروه
 from telegram import BotCommand
 from telegram import (
@@ -445,6 +490,7 @@ def run():
     app.add_error_handler(on_error)
     # تنظیمات اولیه پس از بوت
     app.post_init = _on_startup
+    app.post_shutdown = _on_shutdown
 
     log.info("Bot is starting to poll...")
     
@@ -1,7 +1,16 @@
 # flowise_client.py
-# -- Flowise REST client (blocking with retries) --
-import json, time, requests
+# -- Flowise REST client: نسخهٔ async (کلاینت مشترک aiohttp با keep-alive) + نسخهٔ blocking قدیمی --
+import json, time
 import os
+import asyncio
+import logging
+import random
+from collections import deque
+from contextlib import aclosing
+
+import aiohttp
+
+log = logging.getLogger(__name__)
 
 
 
@@ -27,33 +36,479 @@ def _t(key: str) -> str:
 
 
 
-# --- replace whole function: call_flowise(...) ---
-def call_flowise(
+def _extract_prediction(data) -> tuple[str | None, int | None]:
+    """متن پاسخ (text | result.text | result[0].text) و تعداد sourceDocuments."""
+    text = None
+    if isinstance(data, dict):
+        if data.get("text"):
+            text = data["text"]
+        else:
+            res = data.get("result")
+            if isinstance(res, dict) and res.get("text"):
+                text = res["text"]
+            elif isinstance(res, list) and res and isinstance(res[0], dict) and res[0].get("text"):
+                text = res[0]["text"]
+    src = data.get("sourceDocuments") if isinstance(data, dict) else None
+    return text, (len(src) if isinstance(src, list) else None)
+
+
+def _headers(api_key: str | None) -> dict:
+    H = {"Content-Type": "application/json"}
+    if api_key:
+        H["Authorization"] = f"Bearer {api_key}"
+    return H
+
+
+# ------------------------------------------------------------------------------
+# کلاینت async مشترک
+# یک ClientSession با استخر محدود و keep-alive برای همهٔ تماس‌ها (Chat AI، AdsGuard،
+# warmup و /health)؛ بدون اتصال TCP/TLS تازه برای هر درخواست و بدون اشغال executor.
+# ------------------------------------------------------------------------------
+FLOWISE_POOL_LIMIT = int(os.getenv("FLOWISE_POOL_LIMIT", "64"))
+FLOWISE_POOL_LIMIT_PER_HOST = int(os.getenv("FLOWISE_POOL_LIMIT_PER_HOST", "32"))
+FLOWISE_KEEPALIVE_SEC = float(os.getenv("FLOWISE_KEEPALIVE_SEC", "60"))
+FLOWISE_CONNECT_TIMEOUT = float(os.getenv("FLOWISE_CONNECT_TIMEOUT", "4"))
+
+_session: aiohttp.ClientSession | None = None
+
+
+async def get_session() -> aiohttp.ClientSession:
+    """ClientSession مشترک (lazy، روی event loop جاری ساخته می‌شود)."""
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=FLOWISE_POOL_LIMIT,
+            limit_per_host=FLOWISE_POOL_LIMIT_PER_HOST,
+            keepalive_timeout=FLOWISE_KEEPALIVE_SEC,
+            ttl_dns_cache=300,
+        )
+        _session = aiohttp.ClientSession(connector=connector)
+    return _session
+
+
+async def close_session() -> None:
+    """بستن کلاینت مشترک هنگام خاموشی (post_shutdown)."""
+    global _session
+    s, _session = _session, None
+    if s is not None and not s.closed:
+        try:
+            await s.close()
+        except Exception:
+            pass
+
+
+# ------------------------------------------------------------------------------
+# Circuit breaker + محدودکنندهٔ همزمانی AIMD (به ازای هر chatflow)
+# وقتی Flowise کند/خراب است، به‌جای انباشتن درخواست‌ها و retry، سریع شکست می‌خوریم
+# (همان متن errors.ai.unreachable) و همزمانی را نصف می‌کنیم؛ با موفقیت‌ها کم‌کم بالا می‌رود.
+# ------------------------------------------------------------------------------
+FLOWISE_CB_FAILURES = int(os.getenv("FLOWISE_CB_FAILURES", "5"))           # خطای پیاپی تا باز شدن
+FLOWISE_CB_COOLDOWN_SEC = float(os.getenv("FLOWISE_CB_COOLDOWN_SEC", "30"))  # مدت باز ماندن قبل از probe
+FLOWISE_CB_SLOW_MS = float(os.getenv("FLOWISE_CB_SLOW_MS", "20000"))       # کندتر از این = سیگنال خطا
+FLOWISE_AIMD_INITIAL = float(os.getenv("FLOWISE_AIMD_INITIAL", "8"))
+FLOWISE_AIMD_MIN = float(os.getenv("FLOWISE_AIMD_MIN", "1"))
+FLOWISE_AIMD_MAX = float(os.getenv("FLOWISE_AIMD_MAX", "32"))
+FLOWISE_AIMD_BACKOFF = float(os.getenv("FLOWISE_AIMD_BACKOFF", "0.5"))
+FLOWISE_QUEUE_TIMEOUT_SEC = float(os.getenv("FLOWISE_QUEUE_TIMEOUT_SEC", "10"))
+
+# بودجهٔ زمانی end-to-end، retry فقط روی خطاهای گذرا، و hedging اختیاری (روی p95)
+FLOWISE_DEADLINE_SEC = float(os.getenv("FLOWISE_DEADLINE_SEC", "90"))
+FLOWISE_MIN_ATTEMPT_SEC = float(os.getenv("FLOWISE_MIN_ATTEMPT_SEC", "5"))     # کمتر از این باقی بماند → retry نکن
+FLOWISE_LATENCY_WINDOW = int(os.getenv("FLOWISE_LATENCY_WINDOW", "200"))
+FLOWISE_HEDGE_MIN_SAMPLES = int(os.getenv("FLOWISE_HEDGE_MIN_SAMPLES", "20"))
+FLOWISE_HEDGE_MIN_DELAY_SEC = float(os.getenv("FLOWISE_HEDGE_MIN_DELAY_SEC", "1"))
+_RETRYABLE_STATUS = frozenset({408, 425, 429, 500, 502, 503, 504})
+
+
+class FlowiseUnavailable(Exception):
+    """breaker باز است یا صف همزمانی پر شد؛ درخواست اصلاً ارسال نشده است."""
+
+
+def _metric(name: str):
+    # Lazy (مثل _t): این ماژول در import-time به shared_utils وابسته نیست
+    try:
+        import shared_utils as _su
+        return getattr(_su, name, None)
+    except Exception:
+        return None
+
+
+class _ChatflowGuard:
+    CLOSED, HALF_OPEN, OPEN = 0, 1, 2
+
+    __slots__ = ("cfid", "state", "failures", "opened_at", "probe_inflight", "limit", "inflight", "_cond", "latencies")
+
+    def __init__(self, cfid: str):
+        self.cfid = cfid
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_inflight = False
+        self.limit = max(FLOWISE_AIMD_MIN, FLOWISE_AIMD_INITIAL)
+        self.inflight = 0
+        self._cond: asyncio.Condition | None = None
+        self.latencies: deque = deque(maxlen=FLOWISE_LATENCY_WINDOW)  # ms، فقط پاسخ‌های موفق
+
+    # --- breaker ---
+    def _set_state(self, state: int) -> None:
+        if state == self.state:
+            return
+        self.state = state
+        if state == self.OPEN:
+            self.opened_at = time.monotonic()
+            log.warning("Flowise breaker OPEN for chatflow=%s (failures=%s)", self.cfid, self.failures)
+        elif state == self.CLOSED:
+            log.info("Flowise breaker CLOSED for chatflow=%s", self.cfid)
+        g = _metric("MET_FLOWISE_BREAKER_STATE")
+        if g is not None:
+            g.labels(chatflow=self.cfid).set(state)
+        _publish_up()
+
+    def p95_sec(self) -> float | None:
+        """صدک ۹۵ تأخیر پاسخ‌های موفق اخیر (ثانیه)؛ با نمونهٔ کم None."""
+        if len(self.latencies) < FLOWISE_HEDGE_MIN_SAMPLES:
+            return None
+        xs = sorted(self.latencies)
+        return xs[min(len(xs) - 1, int(len(xs) * 0.95))] / 1000.0
+
+    def _publish(self) -> None:
+        g = _metric("MET_FLOWISE_INFLIGHT")
+        if g is not None:
+            g.labels(chatflow=self.cfid).set(self.inflight)
+        g = _metric("MET_FLOWISE_CONCURRENCY_LIMIT")
+        if g is not None:
+            g.labels(chatflow=self.cfid).set(self.limit)
+
+    def _reject(self, reason: str) -> None:
+        c = _metric("MET_FLOWISE_REJECTED")
+        if c is not None:
+            c.labels(reason=reason).inc()
+        raise FlowiseUnavailable(f"{reason} (chatflow={self.cfid})")
+
+    async def acquire(self) -> bool:
+        """اجازهٔ ارسال؛ خروجی True یعنی این درخواست probe حالت half-open است."""
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < FLOWISE_CB_COOLDOWN_SEC:
+                self._reject("breaker_open")
+            self._set_state(self.HALF_OPEN)
+        is_probe = False
+        if self.state == self.HALF_OPEN:
+            if self.probe_inflight:
+                self._reject("breaker_open")
+            self.probe_inflight = is_probe = True
+
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        deadline = time.monotonic() + FLOWISE_QUEUE_TIMEOUT_SEC
+        try:
+            async with self._cond:
+                while self.inflight >= max(1, int(self.limit)):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._reject("concurrency_limit")
+                    try:
+                        await asyncio.wait_for(self._cond.wait(), remaining)
+                    except asyncio.TimeoutError:
+                        pass
+                self.inflight += 1
+        except BaseException:
+            # رد شدن یا cancel شدن در صف: probe آزاد شود تا breaker در half-open گیر نکند
+            if is_probe:
+                self.probe_inflight = False
+            raise
+        self._publish()
+        return is_probe
+
+    async def release(self, *, is_probe: bool, ok: bool, failed: bool, elapsed_ms: float) -> None:
+        slow = elapsed_ms > FLOWISE_CB_SLOW_MS
+        if ok and elapsed_ms > 0:
+            self.latencies.append(elapsed_ms)
+        if ok and not slow:
+            # Additive increase: حدوداً +1 به ازای هر «پنجرهٔ» کامل موفق
+            self.limit = min(FLOWISE_AIMD_MAX, self.limit + 1.0 / max(1.0, self.limit))
+            self.failures = 0
+            self._set_state(self.CLOSED)
+        elif failed or slow:
+            # Multiplicative decrease
+            self.limit = max(FLOWISE_AIMD_MIN, self.limit * FLOWISE_AIMD_BACKOFF)
+            self.failures += 1
+            if is_probe or self.failures >= FLOWISE_CB_FAILURES:
+                self._set_state(self.OPEN)
+        if is_probe:
+            self.probe_inflight = False
+        if self._cond is not None:
+            async with self._cond:
+                self.inflight = max(0, self.inflight - 1)
+                self._cond.notify()
+        self._publish()
+
+
+_guards: dict[str, _ChatflowGuard] = {}
+
+
+def _guard_for(url: str) -> _ChatflowGuard:
+    cfid = url.rstrip("/").rsplit("/", 1)[-1]
+    g = _guards.get(cfid)
+    if g is None:
+        g = _guards[cfid] = _ChatflowGuard(cfid)
+        _publish_up()
+    return g
+
+
+def _publish_up() -> None:
+    """flowise_up فقط از breaker می‌آید: ۰ اگر breaker هر chatflowی باز باشد، وگرنه ۱."""
+    up = _metric("MET_FLOWISE_UP")
+    if up is not None:
+        up.set(0 if any(x.state == _ChatflowGuard.OPEN for x in _guards.values()) else 1)
+
+
+def breaker_states() -> dict[str, dict]:
+    """وضعیت فعلی breaker/limiter هر chatflow (برای /health و عیب‌یابی)."""
+    names = {0: "closed", 1: "half_open", 2: "open"}
+    return {
+        k: {"state": names.get(g.state, "?"), "inflight": g.inflight, "limit": round(g.limit, 2), "failures": g.failures}
+        for k, g in _guards.items()
+    }
+
+
+def _timeout(read_sec, connect_sec=None) -> aiohttp.ClientTimeout:
+    # معادل timeout=(connect, read) در requests: محدودیت روی اتصال و هر خواندن سوکت
+    return aiohttp.ClientTimeout(
+        total=None,
+        sock_connect=float(connect_sec or FLOWISE_CONNECT_TIMEOUT),
+        sock_read=float(read_sec),
+    )
+
+
+async def post_prediction(url: str, headers: dict, payload: dict, *, read_timeout_sec, connect_timeout_sec=None, guard: bool = True):
+    """
+    POST به prediction endpoint با کلاینت مشترک.
+    خروجی: (status, data) — data همان JSON پاسخ (یا None اگر JSON نبود).
+    روی 4xx/5xx استثنای aiohttp.ClientResponseError بالا می‌رود (مثل raise_for_status).
+    guard=True: از breaker/limiter همان chatflow عبور می‌کند (در صورت رد شدن FlowiseUnavailable).
+    """
+    g = _guard_for(url) if guard else None
+    is_probe = await g.acquire() if g is not None else False
+    t0 = time.perf_counter()
+    ok = failed = False
+    try:
+        session = await get_session()
+        async with session.post(
+            url, json=payload, headers=headers,
+            timeout=_timeout(read_timeout_sec, connect_timeout_sec),
+        ) as r:
+            if r.status >= 400:
+                # فقط 5xx و 429 سیگنال اضافه‌بار هستند؛ بقیهٔ 4xx خطای پیکربندی‌اند
+                failed = r.status >= 500 or r.status == 429
+                try:
+                    body = (await r.text())[:800]
+                except Exception:
+                    body = "<no-body>"
+                raise aiohttp.ClientResponseError(
+                    r.request_info, r.history, status=r.status, message=body, headers=r.headers
+                )
+            try:
+                data = await r.json(content_type=None)
+            except Exception:
+                data = None
+            ok = True
+            return r.status, data
+    except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError):
+        failed = True
+        raise
+    finally:
+        if g is not None:
+            await g.release(is_probe=is_probe, ok=ok, failed=failed,
+                            elapsed_ms=(time.perf_counter() - t0) * 1000.0)
+
+
+def _is_retryable(e: BaseException) -> bool:
+    if isinstance(e, FlowiseUnavailable):
+        return False
+    if isinstance(e, aiohttp.ClientResponseError):
+        return e.status in _RETRYABLE_STATUS
+    return isinstance(e, (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError))
+
+
+def _retry_after_sec(e: BaseException) -> float:
+    """Retry-After سرور (ثانیه) برای 429/503؛ در غیر این صورت ۰."""
+    try:
+        if isinstance(e, aiohttp.ClientResponseError) and e.headers:
+            return max(0.0, float(e.headers.get("Retry-After") or 0))
+    except Exception:
+        pass
+    return 0.0
+
+
+def _count_attempt(kind: str) -> None:
+    c = _metric("MET_FLOWISE_ATTEMPTS")
+    if c is not None:
+        c.labels(kind=kind).inc()
+
+
+async def _hedged_post(url: str, headers: dict, payload: dict, read_sec: float, hedge_after: float | None):
+    """
+    یک تلاش؛ اگر hedge_after داده شده و تا آن لحظه پاسخی نیامده، درخواست دوم هم فرستاده می‌شود
+    و اولین پاسخ موفق برنده است (دیگری لغو می‌شود).
+    """
+    if hedge_after is None or hedge_after >= read_sec:
+        return await post_prediction(url, headers, payload, read_timeout_sec=read_sec)
+
+    first = asyncio.ensure_future(post_prediction(url, headers, payload, read_timeout_sec=read_sec))
+    pending = {first}
+    try:
+        done, pending = await asyncio.wait(pending, timeout=hedge_after)
+        if done:
+            return first.result()
+        _count_attempt("hedge")
+        pending.add(asyncio.ensure_future(
+            post_prediction(url, headers, payload, read_timeout_sec=max(1.0, read_sec - hedge_after))
+        ))
+        err: BaseException | None = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for t in done:
+                if t.exception() is None:
+                    return t.result()
+                err = t.exception()
+        raise err
+    finally:
+        for t in pending:
+            t.cancel()
+
+
+async def _post_with_budget(
+    url: str,
+    headers: dict,
+    payload: dict,
+    *,
+    timeout_sec: float,
+    retries: int,
+    backoff_base_ms: int,
+    deadline_sec: float | None = None,
+    hedge: bool = False,
+):
+    """
+    POST با بودجهٔ زمانی کل (deadline_sec): timeout هر تلاش به بودجهٔ باقی‌مانده محدود می‌شود،
+    retry فقط برای خطاهای گذرا (5xx/429/408/اتصال/timeout) و فقط اگر بودجه کافی باشد،
+    backoff به‌صورت full-jitter با asyncio.sleep (و احترام به Retry-After).
+    hedge=True: بعد از p95 همان chatflow یک درخواست موازی (فقط وقتی نمونهٔ کافی داریم).
+    در پایان، آخرین استثنا بالا می‌رود.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + float(deadline_sec or FLOWISE_DEADLINE_SEC)
+    hedge_after = None
+    if hedge:
+        p95 = _guard_for(url).p95_sec()
+        if p95 is not None:
+            hedge_after = max(FLOWISE_HEDGE_MIN_DELAY_SEC, p95)
+
+    attempt = 0
+    while True:
+        attempt += 1
+        remaining = deadline - loop.time()
+        read_sec = max(1.0, min(float(timeout_sec or 60), remaining))
+        try:
+            return await _hedged_post(url, headers, payload, read_sec, hedge_after)
+        except Exception as e:
+            if attempt >= max(1, retries) or not _is_retryable(e):
+                raise
+            delay = max(random.uniform(0, backoff_base_ms * (2 ** (attempt - 1)) / 1000.0), _retry_after_sec(e))
+            if loop.time() + delay + FLOWISE_MIN_ATTEMPT_SEC > deadline:
+                _count_attempt("budget_exhausted")
+                raise
+            log.debug("flowise retry %s/%s in %.2fs: %s", attempt, retries, delay, e)
+            _count_attempt("retry")
+            await asyncio.sleep(delay)
+
+
+async def stream_prediction(url: str, headers: dict, payload: dict, *, read_timeout_sec, connect_timeout_sec=None, guard: bool = True):
+    """
+    POST استریم (payload["streaming"]=True) و خواندن SSE خط‌به‌خط.
+    خروجی: async generator از (event, data) — event ∈ {token, sourceDocuments, end, error, ...}.
+    اگر سرور استریم نکرد (JSON معمولی)، یک رویداد ("json", data) تولید می‌شود.
+    read_timeout_sec فاصلهٔ مجاز بین دو تکه است، نه کل پاسخ.
+    """
+    g = _guard_for(url) if guard else None
+    is_probe = await g.acquire() if g is not None else False
+    ok = failed = False
+    try:
+        session = await get_session()
+        body = dict(payload, streaming=True)
+        async with session.post(
+            url, json=body, headers=dict(headers, Accept="text/event-stream"),
+            timeout=_timeout(read_timeout_sec, connect_timeout_sec),
+        ) as r:
+            if r.status >= 400:
+                failed = r.status >= 500 or r.status == 429
+                try:
+                    text = (await r.text())[:800]
+                except Exception:
+                    text = "<no-body>"
+                raise aiohttp.ClientResponseError(
+                    r.request_info, r.history, status=r.status, message=text, headers=r.headers
+                )
+            if "text/event-stream" not in (r.headers.get("Content-Type") or "").lower():
+                try:
+                    data = await r.json(content_type=None)
+                except Exception:
+                    data = None
+                ok = True
+                yield ("json", data)
+                return
+            async for raw in r.content:
+                line = raw.decode("utf-8", "replace").strip()
+                if not line.startswith("data:"):
+                    continue  # خطوط «message:»/«event:» و خط خالی بین رویدادها
+                chunk = line[5:].strip()
+                try:
+                    obj = json.loads(chunk)
+                except Exception:
+                    yield ("token", chunk)
+                    continue
+                if isinstance(obj, dict) and "event" in obj:
+                    event = str(obj.get("event"))
+                    if event == "end":
+                        # مصرف‌کننده معمولاً با end از حلقه بیرون می‌رود (GeneratorExit در همین yield)؛
+                        # پس موفقیت باید پیش از yield ثبت شود تا breaker/AIMD آن را ببیند
+                        ok = True
+                    yield (event, obj.get("data"))
+                else:
+                    yield ("token", chunk)
+            ok = True
+    except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError):
+        failed = True
+        raise
+    finally:
+        if g is not None:
+            # طول کل استریم به طول پاسخ بستگی دارد، پس «کندی» را سیگنال breaker حساب نمی‌کنیم
+            await g.release(is_probe=is_probe, ok=ok, failed=failed, elapsed_ms=0.0)
+
+
+async def call_flowise_stream_async(
     base_url: str | None = None,
     api_key: str | None = None,
     chatflow_id: str | None = None,
     question: str = "",
     session_id: str = "",
     timeout_sec: int = 60,
-    retries: int = 3,
-    backoff_base_ms: int = 400,
-    namespace: str | None = None,          # <-- NEW: optional RAG namespace
+    namespace: str | None = None,
+    on_text=None,
+    on_first_byte=None,
 ) -> tuple[str, int | None]:
     """
-    تماس ساده با Flowise (سازگار با قبل) + پشتیبانی اختیاری از vars.namespace برای ایزوله‌سازی RAG.
+    مثل call_flowise_async ولی با استریم؛ on_text(متن تجمعی) برای هر تکه await می‌شود
+    و on_first_byte(ثانیه) یک‌بار با رسیدن اولین توکن صدا زده می‌شود.
+    اگر پیش از اولین توکن خطا شود، یک‌بار به مسیر غیراستریم برمی‌گردد؛
+    خطا وسط استریم → متن errors.ai.unreachable (نه متن ناقص).
     """
-    import json, time, requests, os
     B = (base_url or os.getenv("FLOWISE_BASE_URL","")).rstrip("/")
     if not B:
         return (_t("errors.ai.missing_base_url"), None)
     CF = chatflow_id or os.getenv("CHATFLOW_ID")
     if not CF:
         return (_t("errors.ai.missing_chatflow"), None)
-    K = api_key or os.getenv("FLOWISE_API_KEY")
-    H = {"Content-Type":"application/json"}
-    if K:
-        H["Authorization"] = f"Bearer {K}"
-
+    H = _headers(api_key or os.getenv("FLOWISE_API_KEY"))
     payload = {
         "question": question,
         "overrideConfig": {
@@ -61,169 +516,129 @@ def call_flowise(
             "returnSourceDocuments": True
         }
     }
-    # NEW: pass vars.namespace if provided (for strict multi-tenant RAG isolation)
     if namespace:
         payload["overrideConfig"]["vars"] = {"namespace": namespace}
 
     url = f"{B}/api/v1/prediction/{CF}"
-
-    for attempt in range(1, retries + 1):
-        try:
-            r = requests.post(
-                url, headers=H, data=json.dumps(payload),
-                timeout=(4, max(10, int(timeout_sec or 60)))
+    t0 = time.perf_counter()
+    parts: list[str] = []
+    src_count = None
+    try:
+        # aclosing: با break/return/خطا، generator همان‌جا بسته شود (پاسخ HTTP و اسلات guard آزاد شوند)
+        async with aclosing(stream_prediction(url, H, payload, read_timeout_sec=max(10, int(timeout_sec or 60)))) as events:
+            async for event, data in events:
+                if event == "json":
+                    text, src_count = _extract_prediction(data)
+                    return (text or _t("errors.ai.invalid_response"), src_count)
+                if event == "token" and data:
+                    if not parts and on_first_byte is not None:
+                        on_first_byte(time.perf_counter() - t0)
+                    parts.append(str(data))
+                    if on_text is not None:
+                        await on_text("".join(parts))
+                elif event == "sourceDocuments":
+                    src_count = len(data) if isinstance(data, list) else src_count
+                elif event == "error":
+                    raise RuntimeError(str(data)[:300])
+                elif event == "end":
+                    break
+    except FlowiseUnavailable as e:
+        log.info("flowise stream fail-fast: %s", e)
+        return (_t("errors.ai.unreachable"), None)
+    except Exception as e:
+        log.debug("flowise stream failed after %s chunks: %s", len(parts), e)
+        if not parts:
+            return await call_flowise_async(
+                base_url=B, api_key=api_key, chatflow_id=CF, question=question,
+                session_id=session_id, timeout_sec=timeout_sec, retries=1, namespace=namespace,
             )
-            r.raise_for_status()
-            data = r.json()
-
-            text = None
-            if isinstance(data, dict):
-                if data.get("text"):
-                    text = data["text"]
-                else:
-                    res = data.get("result")
-                    if isinstance(res, dict) and res.get("text"):
-                        text = res["text"]
-                    elif isinstance(res, list) and res and isinstance(res[0], dict) and res[0].get("text"):
-                        text = res[0]["text"]
-
-            src = data.get("sourceDocuments") if isinstance(data, dict) else None
-            src_count = len(src) if isinstance(src, list) else None
+        # پاسخ نیمه‌کاره به‌عنوان پاسخ کامل برنگردد: همان متن خطای مسیر غیراستریم
+        # (StreamingReply.finish متن ناقص را با آن جایگزین می‌کند و src_count=None کش نمی‌شود)
+        return (_t("errors.ai.unreachable"), None)
+    text = "".join(parts)
+    return (text or _t("errors.ai.invalid_response"), src_count)
 
-            return (text or _t("errors.ai.invalid_response"), src_count)
-        except Exception as e:
-            if attempt < retries:
-                backoff_ms = backoff_base_ms * (2 ** (attempt - 1))
-                time.sleep(backoff_ms / 1000.0)
-            else:
-                break
-    return (_t("errors.ai.unreachable"), None)
 
-
-def chat_infer(
-    *,
+async def call_flowise_async(
     base_url: str | None = None,
     api_key: str | None = None,
-    chat_id: int,
-    user_id: int,
-    text: str,
-    namespace: str | None = None,
-    session_id: str | None = None,
     chatflow_id: str | None = None,
+    question: str = "",
+    session_id: str = "",
     timeout_sec: int = 60,
     retries: int = 3,
     backoff_base_ms: int = 400,
-    extra_vars: dict | None = None,
+    namespace: str | None = None,
+    deadline_sec: float | None = None,
+    hedge: bool = False,
 ) -> tuple[str, int | None]:
     """
-    تماس عمومی برای چت چندسازمانی:
-      - sessionId: g:<chat_id>:u:<user_id>  (در PV روی گروه فعال هم همین الگو)
-      - overrideConfig.vars: شامل namespace و سایر vars مفید
-      - chatflow_id: از ورودی یا ENV (MULTITENANT_CHATFLOW_ID → CHATFLOW_ID)
+    یک prediction روی کلاینت مشترک؛ خروجی (متن، تعداد sourceDocuments).
+    بودجهٔ زمانی کل (deadline_sec)، retry فقط روی خطاهای گذرا با backoff تصادفی، و hedge اختیاری.
     """
-    import json, time, requests
     B = (base_url or os.getenv("FLOWISE_BASE_URL","")).rstrip("/")
     if not B:
         return (_t("errors.ai.missing_base_url"), None)
-    CF = chatflow_id or os.getenv("MULTITENANT_CHATFLOW_ID") or os.getenv("CHATFLOW_ID")
+    CF = chatflow_id or os.getenv("CHATFLOW_ID")
     if not CF:
         return (_t("errors.ai.missing_chatflow"), None)
-    K = api_key or os.getenv("FLOWISE_API_KEY")
-    H = {"Content-Type":"application/json"}
-    if K:
-        H["Authorization"] = f"Bearer {K}"
-    sid = session_id or f"g:{chat_id}:u:{user_id}"
-    ns  = namespace or f"grp:{chat_id}"
+    H = _headers(api_key or os.getenv("FLOWISE_API_KEY"))
+
     payload = {
-        "question": text,
+        "question": question,
         "overrideConfig": {
-            "sessionId": sid,
-            "returnSourceDocuments": True,
-            "vars": {"namespace": ns}
+            "sessionId": session_id,
+            "returnSourceDocuments": True
         }
     }
-    if extra_vars:
-        try:
-            payload["overrideConfig"]["vars"].update(dict(extra_vars))
-        except Exception:
-            pass
-    url = f"{B}/api/v1/prediction/{CF}"
-    for attempt in range(1, retries+1):
-        try:
-            r = requests.post(
-                url, headers=H, data=json.dumps(payload),
-                timeout=(4, max(10, int(timeout_sec or 60)))
-            )
-            r.raise_for_status()
-            data = r.json()
-            txt = None
-            if isinstance(data, dict):
-                if data.get("text"):
-                    txt = data["text"]
-                else:
-                    res = data.get("result")
-                    if isinstance(res, dict) and res.get("text"):
-                        txt = res["text"]
-                    elif isinstance(res, list) and res and isinstance(res[0], dict) and res[0].get("text"):
-                        txt = res[0]["text"]
-            src = data.get("sourceDocuments") if isinstance(data, dict) else None
-            cnt = len(src) if isinstance(src, list) else None
-            return (txt or _t("errors.ai.invalid_response_short"), cnt)
-        except Exception as e:
-            if attempt < retries:
-                time.sleep((backoff_base_ms * (2 ** (attempt - 1))) / 1000.0)
-            else:
-                break
-    return (_t("errors.ai.unreachable"), None)   
+    if namespace:
+        payload["overrideConfig"]["vars"] = {"namespace": namespace}
 
+    url = f"{B}/api/v1/prediction/{CF}"
+    try:
+        _st, data = await _post_with_budget(
+            url, H, payload, timeout_sec=max(10, int(timeout_sec or 60)), retries=retries,
+            backoff_base_ms=backoff_base_ms, deadline_sec=deadline_sec, hedge=hedge,
+        )
+        text, src_count = _extract_prediction(data)
+        return (text or _t("errors.ai.invalid_response"), src_count)
+    except FlowiseUnavailable as e:
+        # breaker باز/صف پر: retry فقط فشار را بیشتر می‌کند
+        log.info("flowise fail-fast: %s", e)
+    except Exception as e:
+        log.debug("flowise call failed: %s", e)
+    return (_t("errors.ai.unreachable"), None)
 
 
-# --- ADD: health ping for Flowise (compatible, no keyword-only params) ---
-def ping_flowise(base_url, chatflow_id, api_key=None, timeout_sec=8, extra_vars=None):
+async def ping_flowise_async(base_url, chatflow_id, api_key=None, timeout_sec=8, extra_vars=None):
     """
-    Lightweight health-call to Flowise prediction endpoint.
+    ping سبک endpoint پیش‌بینی روی همان کلاینت مشترک (اتصال گرم برای Chat AI هم می‌ماند).
     Returns: (ok: bool, elapsed_ms: int, err: str)
     """
-    import time, json, requests
     t0 = time.perf_counter()
-
-    # ایمنی: اگر ID نداریم، برگرد
     if not chatflow_id:
         return False, 0, "missing_chatflow_id"
 
     url = f"{str(base_url).rstrip('/')}/api/v1/prediction/{chatflow_id}"
-    headers = {"Content-Type": "application/json"}
-    if api_key:
-        headers["Authorization"] = f"Bearer {api_key}"
-
-    # بسیاری از chatflowها حداقل یک var می‌خواهند؛ یک مقدار پیش‌فرض امن بفرستیم
     vars_obj = {"namespace": "health"}
     if isinstance(extra_vars, dict):
         try:
             vars_obj.update({k: v for (k, v) in extra_vars.items() if v is not None})
         except Exception:
             pass
-
     payload = {
         "question": "ping",
         "overrideConfig": {"sessionId": "health:check", "vars": vars_obj}
     }
-
     try:
-        r = requests.post(
-            url, headers=headers, data=json.dumps(payload),
-            timeout=(4, max(10, int(timeout_sec or 60)))
-        )
+        # ping از breaker عبور نمی‌کند تا /health و warmup وضعیت واقعی سرور را ببینند
+        st, _data = await post_prediction(url, _headers(api_key), payload, read_timeout_sec=max(10, int(timeout_sec or 60)), guard=False)
         ms = int((time.perf_counter() - t0) * 1000)
-        if r.status_code == 200:
-            return True, ms, ""
-        body = r.text
-        if isinstance(body, str) and len(body) > 160:
+        return (True, ms, "") if st == 200 else (False, ms, f"HTTP {st}")
+    except aiohttp.ClientResponseError as e:
+        body = str(e.message or "")
+        if len(body) > 160:
             body = body[:160] + "..."
-        return False, ms, f"HTTP {r.status_code} — {body}"
+        return False, int((time.perf_counter() - t0) * 1000), f"HTTP {e.status} — {body}"
     except Exception as e:
-        ms = int((time.perf_counter() - t0) * 1000)
-        return False, ms, f"{type(e).__name__}: {e}"
-
-# --- END ADD ---
-
+        return False, int((time.perf_counter() - t0) * 1000), f"{type(e).__name__}: {e}"
@@ -5,14 +5,106 @@ from pathlib import Path
 from typing import Optional, Dict
 import json
 import gettext
+import string
 import os
 
 
 # از هلسپرهای فعلی پروژه استفاده می‌کنیم (DB-first واقعی)
 from shared_utils import get_config, chat_cfg_get  # این‌ها همین الان در پروژه موجودند
 
-# کش سادهٔ پیام‌ها در حافظه
-_MESSAGES: Dict[str, Dict[str, str]] = {}
+_MESSAGES_DIR = Path(__file__).resolve().parent / "messages"
+_FALLBACK_LANG = "fa"
+
+
+class _Tpl:
+    """
+    قالب از پیش parse‌شده: متن خام + تکه‌های (literal, field).
+    - fields=None یعنی قالب placeholder ندارد → بدون format برگردانده می‌شود.
+    - simple=False یعنی قالب spec/conversion/attr دارد یا معتبر نیست → مسیر format عادی.
+    """
+    __slots__ = ("text", "parts", "fields", "simple")
+
+    def __init__(self, text: str):
+        self.text = text
+        self.parts: tuple = ()
+        self.fields: Optional[frozenset] = None
+        self.simple = False
+        try:
+            parts = []
+            fields = set()
+            simple = True
+            for literal, field, spec, conv in string.Formatter().parse(text):
+                if field is None:
+                    parts.append((literal, None))
+                    continue
+                if spec or conv or not field.isidentifier():
+                    simple = False
+                fields.add(field)
+                parts.append((literal, field))
+            self.parts = tuple(parts)
+            self.fields = frozenset(fields) if fields else None
+            self.simple = simple
+        except ValueError:
+            # قالب نامعتبر (مثلاً «{» تنها): همیشه متن خام برمی‌گردد، مثل رفتار قبلی
+            self.fields = None
+
+    def render(self, vars: dict) -> str:
+        if not vars or self.fields is None:
+            # بدون متغیر یا بدون placeholder: دقیقاً همان متن پایه
+            return self.text if not vars else self._format(vars)
+        if not self.simple:
+            return self._format(vars)
+        if not self.fields.issubset(vars):
+            # متغیر کم بود → کرش نکن، همان متن پایه
+            return self.text
+        return "".join(lit + (str(vars[f]) if f is not None else "") for lit, f in self.parts)
+
+    def _format(self, vars: dict) -> str:
+        try:
+            return self.text.format(**vars)
+        except Exception:
+            return self.text
+
+
+def _flatten(d: dict, prefix: str = "") -> Dict[str, str]:
+    """کاتالوگ تودرتو را به کلیدهای نقطه‌دار تبدیل می‌کند ({"a": {"b": ".."}} → "a.b")."""
+    out: Dict[str, str] = {}
+    for k, v in (d or {}).items():
+        key = f"{prefix}{k}"
+        if isinstance(v, dict):
+            out.update(_flatten(v, key + "."))
+        elif isinstance(v, str):
+            out[key] = v
+    return out
+
+
+def _read_catalog(lang: str) -> Dict[str, str]:
+    p = _MESSAGES_DIR / f"{lang}.json"
+    try:
+        return _flatten(json.loads(p.read_text(encoding="utf-8"))) if p.exists() else {}
+    except Exception:
+        return {}
+
+
+def _compile_catalogs() -> Dict[str, Dict[str, _Tpl]]:
+    """
+    همهٔ messages/*.json یک‌بار در import خوانده، flatten و با فارسی ادغام می‌شوند
+    (کلید خالی/غایب → متن فارسی) تا lookup فقط یک dict.get باشد.
+    """
+    raw: Dict[str, Dict[str, str]] = {}
+    try:
+        for p in sorted(_MESSAGES_DIR.glob("*.json")):
+            raw[_norm_lang(p.stem)] = _read_catalog(p.stem)
+    except Exception:
+        pass
+    base = raw.get(_FALLBACK_LANG, {})
+    out: Dict[str, Dict[str, _Tpl]] = {}
+    for lang in set(raw) | {_FALLBACK_LANG}:
+        merged = dict(base)
+        merged.update({k: v for k, v in raw.get(lang, {}).items() if v})
+        out[lang] = {k: _Tpl(v) for k, v in merged.items()}
+    return out
+
 
 def _norm_lang(lang: Optional[str]) -> str:
     """
@@ -24,37 +116,45 @@ def _norm_lang(lang: Optional[str]) -> str:
     lang = lang.strip().lower().replace("_", "-")
     return lang.split("-")[0]  # base language (fa, en, ...)
 
-def _load_lang(lang: str) -> Dict[str, str]:
+
+# کاتالوگ‌های کامپایل‌شده (lang → key → _Tpl)
+_MESSAGES: Dict[str, Dict[str, _Tpl]] = _compile_catalogs()
+
+def _load_lang(lang: str) -> Dict[str, _Tpl]:
     lang = _norm_lang(lang)
-    if lang in _MESSAGES:
-        return _MESSAGES[lang]
-    p = Path(__file__).resolve().parent / "messages" / f"{lang}.json"
+    data = _MESSAGES.get(lang)
+    if data is None:
+        # زبان ناشناخته: همان کاتالوگ فارسی (به‌جای خواندن فایل در مسیر داغ)
+        data = _MESSAGES.get(_FALLBACK_LANG, {})
+    return data
+
+
+def _chat_lang(chat_id: int) -> Optional[str]:
+    # از اسنپ‌شات کش‌شدهٔ تنظیمات گروه (shared_utils)؛ memo جداگانه لازم نیست
     try:
-        data = json.loads(p.read_text(encoding="utf-8")) if p.exists() else {}
+        return chat_cfg_get(chat_id, "lang")
     except Exception:
-        data = {}
-    _MESSAGES[lang] = data
-    return data
+        return None
+
+
+def _default_lang() -> Optional[str]:
+    try:
+        return get_config("default_lang")
+    except Exception:
+        return None
+
 
 def pick_lang(chat_id: Optional[int] = None, user_hint: Optional[str] = None) -> str:
     """
-    سیاست انتخاب زبان (DB-first):
+    سیاست انتخاب زبان (DB-first، از کش تنظیمات shared_utils):
       1) chat_config.lang (اگر chat_id داریم)
       2) bot_config.default_lang
       3) hint کاربر (اختیاری)
       4) fa
     """
-    lang = None
-    try:
-        if chat_id:
-            lang = chat_cfg_get(chat_id, "lang")
-    except Exception:
-        lang = None
+    lang = _chat_lang(chat_id) if chat_id else None
     if not lang:
-        try:
-            lang = get_config("default_lang")
-        except Exception:
-            lang = None
+        lang = _default_lang()
     if not lang and user_hint:
         lang = user_hint
     return _norm_lang(lang or "fa")
@@ -62,20 +162,12 @@ def pick_lang(chat_id: Optional[int] = None, user_hint: Optional[str] = None) ->
 def t(key: str, *, chat_id: Optional[int] = None, user_lang_hint: Optional[str] = None, **vars) -> str:
     """
     گرفتن متن بر اساس کلید. فالبک: lang → fa → خودِ کلید.
-    Placeholderها با format(**vars) جایگذاری می‌شوند.
+    Placeholderها با قالب از پیش parse‌شده جایگذاری می‌شوند (متغیر کم/غلط → متن پایه).
     """
-    lang = pick_lang(chat_id, user_hint=user_lang_hint)
-    data = _load_lang(lang)
-    txt = data.get(key)
-    if not txt:
-        txt = _load_lang("fa").get(key, key)  # فالبک به فارسی، در نهایت خود کلید
-    try:
-        if vars:
-            txt = txt.format(**vars)
-    except Exception:
-        # اگر متغیر کم/زیاد بود، کرش نکن—همان متن پایه را برگردان
-        pass
-    return txt
+    tpl = _load_lang(pick_lang(chat_id, user_hint=user_lang_hint)).get(key)
+    if tpl is None:
+        return key  # فالبک فارسی قبلاً در کاتالوگ ادغام شده؛ در نهایت خود کلید
+    return tpl.render(vars)
     
 
 # --- جمع/مفرد: لایهٔ اختیاری gettext با فالبک به JSON ---
@@ -30,7 +30,8 @@ from shared_utils import (
 from typing import Tuple, Dict, Optional
 from messages_service import t
 from telegram import InlineKeyboardMarkup, InlineKeyboardButton
-from shared_utils import chat_cfg_get, chat_cfg_set, list_admin_groups, get_active_admin_group, cfg_get_str, cfg_get_int, cfg_get_float
+from shared_utils import load_chat_settings
+from shared_utils import chat_cfg_set, list_admin_groups, get_active_admin_group, cfg_get_str, cfg_get_int, cfg_get_float
 from shared_utils import (
     CHAT_AI_DEFAULT_ENABLED, CHAT_AI_DEFAULT_MODE, CHAT_AI_DEFAULT_MIN_GAP_SEC, CHAT_AI_DEFAULT_AUTOCLEAN_SEC,
     ADS_DEFAULT_FEATURE, ADS_DEFAULT_ACTION, ADS_DEFAULT_THRESHOLD,
@@ -97,8 +98,9 @@ DEFAULTS = dict(
 
 
 # ----------------------------- توابع کمکی UI ------------------------------
-def _val(chat_id: int, key: str) -> str:
-    v = chat_cfg_get(chat_id, key)
+def _val(chat_id, key: str) -> str:
+    # chat_id یا ChatSettings؛ کل پنل از یک اسنپ‌شات (یک SELECT) خوانده می‌شود
+    v = load_chat_settings(chat_id).get(key)
     if v is None:
         v = DEFAULTS.get(key, "")
     return str(v)
@@ -4,6 +4,7 @@ import time
 import re
 import json
 import asyncio
+import threading
 import psycopg2
 import psycopg2.extras
 from datetime import datetime, timezone
@@ -11,9 +12,10 @@ from typing import Optional, List, Set, Tuple
 from functools import wraps
 from telegram import Update
 from telegram import ReplyKeyboardRemove
-from flowise_client import call_flowise as _flowise_call
+from flowise_client import call_flowise_async as _flowise_call_async
+from flowise_client import call_flowise_stream_async as _flowise_stream_async
 from inspect import iscoroutinefunction
-from telegram.error import BadRequest
+from telegram.error import BadRequest, RetryAfter
 
 from contextlib import contextmanager
 from psycopg2.pool import ThreadedConnectionPool
@@ -47,10 +49,10 @@ try:
             "Number of unknown/empty-source answers",
         )
 
-        # سلامت warmup Flowise (۱=Up, ۰=Down)
+        # سلامت Flowise از دید circuit breaker (۱=Up, ۰=breaker یکی از chatflowها باز است)
         MET_FLOWISE_UP = Gauge(
             "flowise_up",
-            "Flowise warmup heartbeat (1=up, 0=down)"
+            "Flowise availability from the circuit breaker (1=up, 0=a chatflow breaker is open)"
         )
 
         # --- AdsGuard actions: warn/delete/none
@@ -65,13 +67,175 @@ try:
             "bot_errors_total",
             "Number of errors in bot handlers"
         )
+
+        # --- Flowise circuit breaker / AIMD limiter (per chatflow)
+        MET_FLOWISE_BREAKER_STATE = Gauge(
+            "flowise_breaker_state",
+            "Circuit breaker state per chatflow (0=closed, 1=half_open, 2=open)",
+            ["chatflow"],
+        )
+        MET_FLOWISE_INFLIGHT = Gauge(
+            "flowise_inflight_requests",
+            "In-flight Flowise requests per chatflow",
+            ["chatflow"],
+        )
+        MET_FLOWISE_CONCURRENCY_LIMIT = Gauge(
+            "flowise_concurrency_limit",
+            "Current AIMD concurrency limit per chatflow",
+            ["chatflow"],
+        )
+        MET_FLOWISE_REJECTED = Counter(
+            "flowise_rejected_total",
+            "Flowise calls failed fast without reaching the server",
+            ["reason"],   # reason ∈ {breaker_open, concurrency_limit}
+        )
+
+        # --- Chat AI answer cache (LRU+TTL)
+        MET_CHAT_CACHE = Counter(
+            "chat_ai_cache_total",
+            "Chat AI answer cache lookups/stores",
+            ["result"],   # result ∈ {hit, miss, store}
+        )
+        MET_CHAT_CACHE_SIZE = Gauge(
+            "chat_ai_cache_entries",
+            "Number of entries in the Chat AI answer cache",
+        )
+
+        # --- AdsGuard verdict cache
+        MET_ADS_VERDICT_CACHE = Counter(
+            "ads_verdict_cache_total",
+            "AdsGuard verdict cache lookups/stores",
+            ["result"],   # result ∈ {hit, miss, store}
+        )
+        MET_ADS_VERDICT_CACHE_SIZE = Gauge(
+            "ads_verdict_cache_entries",
+            "Number of entries in the AdsGuard verdict cache",
+        )
+
+        # --- کش نمونه‌های few-shot (ردیف‌ها + examples_str آماده) به ازای نسخهٔ نمونه‌های هر گروه
+        MET_ADS_EXAMPLES_CACHE = Counter(
+            "ads_examples_cache_total",
+            "AdsGuard few-shot examples cache lookups",
+            ["result"],   # result ∈ {hit, miss}
+        )
+
+        # --- TtlMap: اندازه و حذف‌ها (expired/capacity) به ازای نام هر نگاشت
+        MET_TTLMAP_SIZE = Gauge(
+            "ttlmap_entries",
+            "Number of live entries in a bounded TTL map",
+            ["name"],
+        )
+        MET_TTLMAP_EVICTIONS = Counter(
+            "ttlmap_evictions_total",
+            "Entries removed from a bounded TTL map by expiry or capacity",
+            ["name", "reason"],   # reason ∈ {expired, capacity}
+        )
+
+        # --- TimerWheel: مهلت‌های در صف و تأخیر اجرا نسبت به مهلت (lag جاروبگر)
+        MET_TIMER_PENDING = Gauge(
+            "timer_wheel_pending",
+            "Deadlines waiting in a timer wheel",
+            ["name"],
+        )
+        MET_TIMER_LAG = Histogram(
+            "timer_wheel_lag_seconds",
+            "Delay between a deadline and the sweep that fired it",
+            ["name"],
+            buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 15.0),
+        )
+
+        # --- صف نظارت هر گروه در AdsGuard (ads_queue): عقب‌ماندگی، انتظار در صف، کنار رفته‌ها
+        MET_ADS_QUEUE_BACKLOG = Gauge(
+            "ads_moderation_backlog",
+            "Messages waiting in AdsGuard moderation queues (all chats)",
+        )
+        MET_ADS_QUEUE_WAIT = Histogram(
+            "ads_moderation_queue_wait_seconds",
+            "Time a message waited in its chat's moderation queue",
+            buckets=(0.1, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0),
+        )
+        MET_ADS_QUEUE_DROPPED = Counter(
+            "ads_moderation_dropped_total",
+            "Messages dropped or merged in a chat's moderation queue",
+            ["reason"],   # reason ∈ {overflow, coalesced}
+        )
+
+        # --- بافرهای write-behind (write_behind.py): اندازهٔ هر flush و ردیف‌های ازدست‌رفته
+        MET_WRITE_BEHIND_BATCH = Histogram(
+            "write_behind_batch_rows",
+            "Rows written per write-behind flush",
+            ["name"],
+            buckets=(1, 5, 10, 25, 50, 100, 200, 500),
+        )
+        MET_WRITE_BEHIND_FAILED = Counter(
+            "write_behind_failed_rows_total",
+            "Rows dropped by a write-behind buffer (failed flush or put after close)",
+            ["name"],
+        )
+
+        # --- Time-to-first-byte پاسخ‌های استریم
+        MET_FLOWISE_TTFB = Histogram(
+            "flowise_ttfb_seconds",
+            "Time to first streamed token from Flowise in seconds",
+            ["dst"],
+            buckets=(0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 20.0),
+        )
+
+        # --- تلاش‌های اضافه روی Flowise (retry/hedge) و retryهای ردشده به‌خاطر بودجهٔ زمانی
+        MET_FLOWISE_ATTEMPTS = Counter(
+            "flowise_extra_attempts_total",
+            "Extra Flowise attempts and budget-exhausted retries",
+            ["kind"],   # kind ∈ {retry, hedge, budget_exhausted}
+        )
+
+        # --- AdsGuard micro-batching
+        MET_ADS_BATCH_SIZE = Histogram(
+            "ads_batch_size",
+            "Number of messages classified in one AdsGuard batch call",
+            buckets=(1, 2, 4, 8, 16, 32),
+        )
+        MET_ADS_BATCH_LATENCY = Histogram(
+            "ads_batch_latency_seconds",
+            "Time from enqueue to verdict for batched AdsGuard classifications",
+            buckets=(0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0),
+        )
+        MET_ADS_BATCH_SAVED = Counter(
+            "ads_batch_calls_saved_total",
+            "Flowise calls avoided by AdsGuard batching",
+        )
+
+        # --- پیش‌طبقه‌بند محلی AdsGuard: سهم تصمیم‌های محلی در برابر ارجاع به Flowise
+        MET_ADS_LOCAL = Counter(
+            "ads_local_decisions_total",
+            "AdsGuard classifications by local pre-classifier outcome",
+            ["result"],   # result ∈ {local_ad, local_not_ad, escalated}
+        )
+
+        # --- near-duplicate تبلیغات (SimHash)
+        MET_ADS_NEARDUP = Counter(
+            "ads_neardup_hits_total",
+            "AdsGuard messages actioned via near-duplicate fingerprint match",
+            ["scope"],   # scope ∈ {chat, global}
+        )
+
+        # --- Single-flight: درخواست‌های هم‌زمانِ یکسان که به یک فراخوانی ملحق شدند
+        MET_FLOWISE_COALESCED = Counter(
+            "flowise_coalesced_total",
+            "Flowise calls coalesced onto an identical in-flight request",
+            ["kind"],   # kind ∈ {chat, ads}
+        )
     else:
         class _Noop:
             def labels(self, *a, **k): return self
             def inc(self, *a, **k): return None
             def observe(self, *a, **k): return None
             def set(self, *a, **k): return None
+            def remove(self, *a, **k): return None
         MET_FLOWISE_LATENCY = MET_BOT_REPLIES = MET_UNKNOWN_QUESTIONS = MET_FLOWISE_UP = MET_ADS_ACTION = MET_BOT_ERRORS = _Noop()
+        MET_FLOWISE_BREAKER_STATE = MET_FLOWISE_INFLIGHT = MET_FLOWISE_CONCURRENCY_LIMIT = MET_FLOWISE_REJECTED = _Noop()
+        MET_CHAT_CACHE = MET_CHAT_CACHE_SIZE = MET_ADS_VERDICT_CACHE = MET_ADS_VERDICT_CACHE_SIZE = MET_FLOWISE_COALESCED = MET_FLOWISE_TTFB = MET_FLOWISE_ATTEMPTS = _Noop()
+        MET_ADS_BATCH_SIZE = MET_ADS_BATCH_LATENCY = MET_ADS_BATCH_SAVED = MET_ADS_LOCAL = MET_ADS_NEARDUP = MET_ADS_EXAMPLES_CACHE = MET_TTLMAP_SIZE = MET_TTLMAP_EVICTIONS = MET_TIMER_PENDING = MET_TIMER_LAG = _Noop()
+        MET_ADS_QUEUE_BACKLOG = MET_ADS_QUEUE_WAIT = MET_ADS_QUEUE_DROPPED = MET_WRITE_BEHIND_BATCH = MET_WRITE_BEHIND_FAILED = _Noop()
 
 except Exception:
     import logging as _lg
@@ -81,10 +245,185 @@ except Exception:
         def inc(self, *a, **k): return None
         def observe(self, *a, **k): return None
         def set(self, *a, **k): return None
+        def remove(self, *a, **k): return None
     MET_FLOWISE_LATENCY = MET_BOT_REPLIES = MET_UNKNOWN_QUESTIONS = MET_FLOWISE_UP = MET_ADS_ACTION = MET_BOT_ERRORS = _Noop()
+    MET_FLOWISE_BREAKER_STATE = MET_FLOWISE_INFLIGHT = MET_FLOWISE_CONCURRENCY_LIMIT = MET_FLOWISE_REJECTED = _Noop()
+    MET_CHAT_CACHE = MET_CHAT_CACHE_SIZE = MET_ADS_VERDICT_CACHE = MET_ADS_VERDICT_CACHE_SIZE = MET_FLOWISE_COALESCED = MET_FLOWISE_TTFB = MET_FLOWISE_ATTEMPTS = _Noop()
+    MET_ADS_BATCH_SIZE = MET_ADS_BATCH_LATENCY = MET_ADS_BATCH_SAVED = MET_ADS_LOCAL = MET_ADS_NEARDUP = MET_ADS_EXAMPLES_CACHE = MET_TTLMAP_SIZE = MET_TTLMAP_EVICTIONS = MET_TIMER_PENDING = MET_TIMER_LAG = _Noop()
+    MET_ADS_QUEUE_BACKLOG = MET_ADS_QUEUE_WAIT = MET_ADS_QUEUE_DROPPED = MET_WRITE_BEHIND_BATCH = MET_WRITE_BEHIND_FAILED = _Noop()
 # ------------------------------------------------------------------------------
 
 
+# --- نگاشت محدود با TTL + LRU (چرخ زمانی برای انقضای O(1)) ---
+class _TtlEntry:
+    __slots__ = ("value", "expires", "tick")
+
+    def __init__(self, value, expires: float, tick: int):
+        self.value = value
+        self.expires = expires
+        self.tick = tick
+
+
+class TtlMap:
+    """
+    dict محدود با TTL و سقف اندازه (LRU) برای state درون‌حافظه‌ای.
+    - انقضا با چرخ زمانی: هر ورودی در خانهٔ tickِ انقضایش است و با جلو رفتن زمان فقط
+      خانه‌های گذشته بررسی می‌شوند (بدون بازسازی کل dict)؛ get هم خودش انقضا را چک می‌کند.
+    - با پر شدن max_entries قدیمی‌ترین (کم‌استفاده‌ترین) ورودی حذف می‌شود.
+    - متریک‌ها: ttlmap_entries{name} و ttlmap_evictions_total{name,reason}.
+    API شبیه dict است (get/[]/in/pop/setdefault/len) تا جایگزینی dictهای قبلی ساده باشد.
+    touch=True یعنی get ترتیب LRU را تازه می‌کند (TTL را تمدید نمی‌کند).
+    """
+
+    def __init__(self, name: str, ttl_sec: float, max_entries: int, *, touch: bool = True, wheel_slots: int = 256):
+        from collections import OrderedDict
+        self.name = name
+        self.ttl_sec = float(ttl_sec)
+        self._max = max(1, int(max_entries))
+        self._touch = touch
+        self._data: "OrderedDict[object, _TtlEntry]" = OrderedDict()
+        self._slots = max(8, int(wheel_slots))
+        self._tick_sec = max(0.05, self.ttl_sec / self._slots) if self.ttl_sec > 0 else 1.0
+        self._wheel: list = [set() for _ in range(self._slots)]
+        self._cursor = int(time.monotonic() / self._tick_sec)
+        self._lock = threading.RLock()
+
+    # --- داخلی
+    def _publish(self) -> None:
+        MET_TTLMAP_SIZE.labels(name=self.name).set(len(self._data))
+
+    def _unlink(self, key, entry: _TtlEntry) -> None:
+        self._wheel[entry.tick % self._slots].discard(key)
+
+    def _advance(self, now: float) -> None:
+        """خانه‌های چرخ تا tick فعلی را پردازش می‌کند؛ ورودی‌های دورِ بعدی در جای خود می‌مانند."""
+        now_tick = int(now / self._tick_sec)
+        if now_tick <= self._cursor:
+            return
+        steps = min(now_tick - self._cursor, self._slots)
+        expired = 0
+        for i in range(1, steps + 1):
+            bucket = self._wheel[(self._cursor + i) % self._slots]
+            if not bucket:
+                continue
+            for key in list(bucket):
+                entry = self._data.get(key)
+                if entry is None:
+                    bucket.discard(key)
+                elif entry.expires <= now:
+                    bucket.discard(key)
+                    del self._data[key]
+                    expired += 1
+        self._cursor = now_tick
+        if expired:
+            MET_TTLMAP_EVICTIONS.labels(name=self.name, reason="expired").inc(expired)
+            self._publish()
+
+    # --- API
+    def set(self, key, value, ttl_sec: Optional[float] = None) -> None:
+        ttl = self.ttl_sec if ttl_sec is None else float(ttl_sec)
+        with self._lock:
+            now = time.monotonic()
+            self._advance(now)
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._unlink(key, old)
+            if ttl <= 0:
+                self._publish()
+                return
+            expires = now + ttl
+            tick = int(expires / self._tick_sec) + 1
+            self._data[key] = _TtlEntry(value, expires, tick)
+            self._wheel[tick % self._slots].add(key)
+            evicted = 0
+            while len(self._data) > self._max:
+                k, e = self._data.popitem(last=False)
+                self._unlink(k, e)
+                evicted += 1
+            if evicted:
+                MET_TTLMAP_EVICTIONS.labels(name=self.name, reason="capacity").inc(evicted)
+            self._publish()
+
+    __setitem__ = set
+
+    def _live(self, key) -> Optional[_TtlEntry]:
+        now = time.monotonic()
+        self._advance(now)
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        if entry.expires <= now:
+            del self._data[key]
+            self._unlink(key, entry)
+            MET_TTLMAP_EVICTIONS.labels(name=self.name, reason="expired").inc()
+            self._publish()
+            return None
+        if self._touch:
+            self._data.move_to_end(key)
+        return entry
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._live(key)
+            return default if entry is None else entry.value
+
+    def __getitem__(self, key):
+        with self._lock:
+            entry = self._live(key)
+            if entry is None:
+                raise KeyError(key)
+            return entry.value
+
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            return self._live(key) is not None
+
+    def __delitem__(self, key) -> None:
+        if self.pop(key, _MISSING) is _MISSING:
+            raise KeyError(key)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._live(key)
+            if entry is None:
+                return default
+            del self._data[key]
+            self._unlink(key, entry)
+            self._publish()
+            return entry.value
+
+    def setdefault(self, key, default=None):
+        with self._lock:
+            entry = self._live(key)
+            if entry is not None:
+                return entry.value
+            self.set(key, default)
+            return default
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._advance(time.monotonic())
+            return len(self._data)
+
+    def clear(self, match=None) -> int:
+        """پاک‌کردن همه یا فقط کلیدهایی که match(key) درست است؛ خروجی: تعداد حذف‌شده‌ها."""
+        with self._lock:
+            if match is None:
+                n = len(self._data)
+                self._data.clear()
+                for bucket in self._wheel:
+                    bucket.clear()
+            else:
+                keys = [k for k in self._data if match(k)]
+                for k in keys:
+                    self._unlink(k, self._data.pop(k))
+                n = len(keys)
+            self._publish()
+            return n
+
+
+_MISSING = object()
+
 
 def _t_runtime(key: str, chat_id=None, **vars):
     """
@@ -187,7 +526,7 @@ def is_forwarded_message(msg) -> bool:
 
 
 # درجا و سبک: محدود کردن فراخوانی دستورات مدیریتی توسط یک کاربر در بازهٔ کوتاه
-_ADMIN_LAST_CALL: dict[tuple[int, str], float] = {}
+_ADMIN_LAST_CALL = TtlMap("admin_throttle", 300, 10000)
 
 def admin_throttle(window_sec: int = 2):
     """
@@ -220,7 +559,7 @@ def admin_throttle(window_sec: int = 2):
                     except Exception:
                         pass
                     return
-                _ADMIN_LAST_CALL[key] = now
+                _ADMIN_LAST_CALL.set(key, now, ttl_sec=max(60, window_sec))
                 return await func(update, context, *args, **kwargs)
             return _wrapped
         else:
@@ -234,7 +573,7 @@ def admin_throttle(window_sec: int = 2):
                 if now - last < window_sec:
                     # توابع sync هم در این پروژه کم‌اند، ولی برای کامل‌بودن نگه داشتیم
                     return None
-                _ADMIN_LAST_CALL[key] = now
+                _ADMIN_LAST_CALL.set(key, now, ttl_sec=max(60, window_sec))
                 return func(update, context, *args, **kwargs)
             return _wrapped
     return _decorator
@@ -288,6 +627,8 @@ SESSION_TIMEOUT = _int_env("SESSION_TIMEOUT", 1800)
 FLOWISE_TIMEOUT = _int_env("FLOWISE_TIMEOUT", 60)
 FLOWISE_RETRIES = _int_env("FLOWISE_RETRIES", 3)
 FLOWISE_BACKOFF_BASE_MS = _int_env("FLOWISE_BACKOFF_BASE_MS", 400)
+FLOWISE_DEADLINE_SEC = _int_env("FLOWISE_DEADLINE_SEC", 90)   # بودجهٔ کل یک پرسش (همهٔ تلاش‌ها)
+FLOWISE_HEDGE = os.getenv("FLOWISE_HEDGE", "off")
 
 # === Shared defaults: single source of truth ===
 CHAT_AI_DEFAULT_ENABLED = os.getenv("CHAT_AI_DEFAULT_ENABLED", "off").strip().lower()
@@ -328,14 +669,10 @@ def chat_ai_autoclean_sec(chat_id: int) -> int:
         return int(CHAT_AI_DEFAULT_AUTOCLEAN_SEC)
 
 
-# --- replace whole function: call_flowise(...) in shared_utils.py ---
-def call_flowise(question: str, session_id: str, chat_id: Optional[int] = None) -> tuple[str, int | None]:
+def _flowise_target(chat_id: Optional[int]) -> tuple[Optional[str], Optional[str], Optional[str]]:
     """
-    اگر chat_id داده شود:
-      - PV: از bot_config.pv_chatflow_id → ENV PV_CHATFLOW_ID
-      - Group: از chat_config.chat_ai_chatflow_id → chat_config.chatflow_id (قدیمی)
-    در نهایت فالبک: bot_config.chat_ai_default_chatflow_id → ENV CHATFLOW_ID
-    + بهبود: در Group نام‌فضای RAG را به فرم grp:<chat_id> پاس می‌دهیم.
+    (off_notice, cfid, namespace) برای یک چت.
+    اگر chat_feature خاموش باشد off_notice پر است و نباید Flowise صدا زده شود.
     """
     def _chat_feature_on() -> bool:
         try:
@@ -351,7 +688,7 @@ def call_flowise(question: str, session_id: str, chat_id: Optional[int] = None)
                 return _tx(key, chat_id=chat_id)
             except Exception:
                 return "🔕 این قسمت فعلاً خاموشه. ادمین می‌تونه با دستور /chat on روشنش کنه."
-        return (_t("chat.off.notice_admin_hint"), None)
+        return (_t("chat.off.notice_admin_hint"), None, None)
 
     cfid = None
     try:
@@ -374,17 +711,304 @@ def call_flowise(question: str, session_id: str, chat_id: Optional[int] = None)
 
     # تعیین namespace فقط برای Group
     ns = f"grp:{chat_id}" if (chat_id is not None and chat_id < 0) else None
+    return (None, cfid, ns)
 
-    # فراخوانی Flowise با namespace اختیاری
-    return _flowise_call(
-        question=question,
-        session_id=session_id,
-        chatflow_id=cfid,
-        namespace=ns,           # NEW: فقط در Group پر می‌شود
-        timeout_sec=FLOWISE_TIMEOUT,
-        retries=FLOWISE_RETRIES,
-        backoff_base_ms=FLOWISE_BACKOFF_BASE_MS,
-    )
+
+# --- نرمال‌سازی متن فارسی/عربی (برای کلید کش و مقایسه) ---
+_FA_FOLD = str.maketrans({
+    "ي": "ی", "ى": "ی", "ئ": "ی", "ك": "ک", "ة": "ه", "ۀ": "ه", "ؤ": "و",
+    "أ": "ا", "إ": "ا", "ٱ": "ا",
+    **{chr(0x06F0 + i): str(i) for i in range(10)},   # ارقام فارسی
+    **{chr(0x0660 + i): str(i) for i in range(10)},   # ارقام عربی
+    "\u200c": " ",                                    # ZWNJ → فاصله
+    **{c: None for c in "\u200e\u200f\u200d\u202a\u202b\u202c\u202d\u202e\u2066\u2067\u2068\u2069\ufeff\u0640"},
+    **{chr(c): None for c in range(0x064B, 0x0653)},  # اعراب (تنوین، فتحه، ...)
+})
+_WS_RE = re.compile(r"\s+")
+
+
+def normalize_text(text: Optional[str]) -> str:
+    """
+    یکدست‌سازی متن: ی/ک عربی → فارسی، ارقام → ASCII، حذف ZWNJ/علائم جهت/اعراب،
+    فاصله‌های پشت‌سرهم → یک فاصله، حروف لاتین کوچک.
+    """
+    if not text:
+        return ""
+    return _WS_RE.sub(" ", str(text).translate(_FA_FOLD)).strip().casefold()
+
+
+def normalized_text(text: Optional[str], context=None) -> str:
+    """
+    normalize_text با memo روی context همان آپدیت: هر متن در هر آپدیت فقط یک بار نرمال می‌شود
+    و همهٔ مصرف‌کننده‌ها (هیوریستیک‌های تبلیغ، کلید کش‌ها، fingerprint، شمارش کلمه) همان را می‌گیرند.
+    context در PTB برای همهٔ هندلرهای یک آپدیت مشترک است؛ بدون context همان normalize_text است.
+    """
+    if not text:
+        return ""
+    try:
+        memo = context.__dict__.setdefault("_normalized_text", {}) if context is not None else None
+    except AttributeError:
+        memo = None
+    if memo is None:
+        return normalize_text(text)
+    v = memo.get(text)
+    if v is None:
+        v = memo[text] = normalize_text(text)
+    return v
+
+
+ADS_VERDICT_KEY = "_ads_verdict"
+
+
+async def ads_verdict_blocks(context, timeout_sec: float = 20.0) -> bool:
+    """
+    اگر AdsGuard این آپدیت را در صف نظارت گذاشته (future روی context)، تا رسیدن رأی صبر می‌کند.
+    True یعنی پیام به‌عنوان تبلیغ اقدام شد (هشدار/حذف) و چت‌بات نباید جواب بدهد؛
+    نبودِ صف، timeout یا خطا یعنی False (رفتار عادی).
+    """
+    fut = getattr(context, "__dict__", {}).get(ADS_VERDICT_KEY) if context is not None else None
+    if fut is None:
+        return False
+    try:
+        return bool(await asyncio.wait_for(asyncio.shield(fut), timeout_sec))
+    except Exception:
+        return False
+
+
+# --- کش پاسخ Chat AI (اختیاری، به ازای هر گروه) ---
+# کلید: (chatflow, namespace grp:<chat_id>, سؤال نرمال‌شده). فقط پاسخ‌های «معلوم» ذخیره می‌شوند.
+CHAT_AI_CACHE_DEFAULT = os.getenv("CHAT_AI_CACHE_DEFAULT", "off")
+CHAT_AI_CACHE_TTL_SEC = _int_env("CHAT_AI_CACHE_TTL_SEC", 3600)
+CHAT_AI_CACHE_MAX = _int_env("CHAT_AI_CACHE_MAX", 2000)
+
+
+class LruTtlCache(TtlMap):
+    """کش LRU + TTL روی TtlMap؛ put/get/clear با یک گیج اندازهٔ اختیاری (سازگار با مصرف‌کننده‌های قبلی)."""
+
+    def __init__(self, max_entries: int, ttl_sec: float, size_gauge=None, name: str = "cache"):
+        super().__init__(name, ttl_sec, max_entries)
+        self._gauge = size_gauge
+
+    def _publish(self) -> None:
+        super()._publish()
+        if self._gauge is not None:
+            self._gauge.set(len(self._data))
+
+    def put(self, key, value) -> None:
+        self.set(key, value)
+
+
+_answer_cache = LruTtlCache(CHAT_AI_CACHE_MAX, CHAT_AI_CACHE_TTL_SEC, MET_CHAT_CACHE_SIZE, name="chat_answers")
+
+
+# --- Single-flight: یک فراخوانی برای درخواست‌های هم‌زمانِ یکسان ---
+_inflight_calls: dict = {}
+
+
+async def single_flight(key, call, kind: str = "chat"):
+    """
+    اگر فراخوانی‌ای با همین key در جریان است، منتظر همان می‌ماند؛ وگرنه call() را اجرا می‌کند.
+    call: تابع بدون آرگومان که coroutine برمی‌گرداند. نتیجه/استثنا بین همه به اشتراک گذاشته می‌شود.
+    """
+    fut = _inflight_calls.get(key)
+    if fut is not None:
+        MET_FLOWISE_COALESCED.labels(kind=kind).inc()
+        try:
+            return await asyncio.shield(fut)
+        except asyncio.CancelledError:
+            # لغو «رهبر» نباید منتظرها را هم لغو کند؛ خودمان فراخوانی می‌کنیم
+            task = asyncio.current_task()
+            if fut.cancelled() and not (task and task.cancelling()):
+                return await call()
+            raise
+
+    fut = asyncio.get_running_loop().create_future()
+    _inflight_calls[key] = fut
+    try:
+        result = await call()
+    except asyncio.CancelledError:
+        fut.cancel()
+        raise
+    except BaseException as e:
+        fut.set_exception(e)
+        fut.exception()  # جلوگیری از هشدار «never retrieved» وقتی منتظری نیست
+        raise
+    else:
+        fut.set_result(result)
+        return result
+    finally:
+        if _inflight_calls.get(key) is fut:
+            del _inflight_calls[key]
+
+
+def chat_ai_cache_enabled(chat_id: int) -> bool:
+    """کش پاسخ برای این گروه روشن است؟ (chat_config.chat_ai_cache → ENV CHAT_AI_CACHE_DEFAULT)"""
+    if chat_id is None or chat_id >= 0:
+        return False
+    v = chat_cfg_get(chat_id, "chat_ai_cache")
+    return as_bool(v if v is not None else CHAT_AI_CACHE_DEFAULT)
+
+
+def chat_ai_cache_clear(chat_id: Optional[int] = None) -> int:
+    """پاک‌کردن کش پاسخ یک گروه (یا کل کش)."""
+    if chat_id is None:
+        return _answer_cache.clear()
+    ns = f"grp:{chat_id}"
+    return _answer_cache.clear(lambda k: k[1] == ns)
+
+
+def _answer_cache_key(cfid: str, ns: str, question: str, norm_question: Optional[str] = None) -> tuple:
+    norm = norm_question if norm_question is not None else normalize_text(question)
+    return (cfid, ns, norm.rstrip(" ?؟!.…"))
+
+
+def _flowise_retry_policy(chat_id: Optional[int]) -> dict:
+    """
+    retries / deadline_sec / hedge برای یک چت:
+    chat_config (chat_ai_retries, chat_ai_deadline_sec, chat_ai_hedge) → bot_config → ENV.
+    """
+    try:
+        cs = load_chat_settings(chat_id) if chat_id else None
+    except Exception:
+        cs = None
+
+    def _pick(key: str, typ: type, env_default):
+        if cs is not None and cs.get(key) is not None:
+            return cs._typed(key, typ, env_default)
+        try:
+            v = get_config(key)
+            if v is not None:
+                return as_bool(v) if typ is bool else typ(v)
+        except Exception:
+            pass
+        return as_bool(env_default) if typ is bool else typ(env_default)
+
+    return {
+        "retries": max(1, _pick("chat_ai_retries", int, FLOWISE_RETRIES)),
+        "deadline_sec": max(5.0, _pick("chat_ai_deadline_sec", float, FLOWISE_DEADLINE_SEC)),
+        "hedge": _pick("chat_ai_hedge", bool, FLOWISE_HEDGE),
+    }
+
+
+def _answer_cache_lookup(chat_id, cfid, ns, question, norm_question=None) -> tuple[Optional[tuple], Optional[tuple]]:
+    """(کلید کش یا None اگر کش برای این چت خاموش است, پاسخ کش‌شده یا None)"""
+    try:
+        if not (ns and chat_ai_cache_enabled(chat_id)):
+            return None, None
+        ckey = _answer_cache_key(cfid, ns, question, norm_question)
+    except Exception:
+        return None, None
+    hit = _answer_cache.get(ckey)
+    MET_CHAT_CACHE.labels(result="hit" if hit is not None else "miss").inc()
+    return ckey, hit
+
+
+def _answer_cache_store(ckey: Optional[tuple], text: str, src_count: int | None) -> None:
+    # فقط پاسخ‌های دارای منبع و غیر fallback (خطا/«نمی‌دانم» هرگز کش نمی‌شود)
+    if ckey is not None and src_count and not is_unknown_reply(text):
+        _answer_cache.put(ckey, (text, src_count))
+        MET_CHAT_CACHE.labels(result="store").inc()
+
+
+async def call_flowise_async(
+    question: str, session_id: str, chat_id: Optional[int] = None, norm_question: Optional[str] = None,
+) -> tuple[str, int | None]:
+    """
+    پرسش از chatflow این چت روی کلاینت async مشترک:
+      - PV: bot_config.pv_chatflow_id → ENV PV_CHATFLOW_ID
+      - Group: chat_config.chat_ai_chatflow_id → chat_config.chatflow_id (قدیمی)، با namespace RAG به فرم grp:<chat_id>
+      - فالبک: bot_config.chat_ai_default_chatflow_id → ENV CHATFLOW_ID
+    resolve کردن chatflow از کش تنظیمات است و بلاک نمی‌کند.
+    در گروه‌هایی که chat_ai_cache روشن است، پاسخ‌های معلوم از کش LRU+TTL برمی‌گردند.
+    سؤال‌های یکسانِ هم‌زمان با single_flight به یک فراخوانی Flowise ملحق می‌شوند
+    (بین sessionها فقط وقتی کش پاسخ گروه روشن است؛ وگرنه فقط درون همان session).
+    norm_question: متن نرمال‌شدهٔ آماده (normalized_text) تا دوباره حساب نشود.
+    """
+    off, cfid, ns = _flowise_target(chat_id)
+    if off is not None:
+        return (off, None)
+
+    ckey, hit = _answer_cache_lookup(chat_id, cfid, ns, question, norm_question)
+    if hit is not None:
+        return hit
+
+    dst = "group" if (chat_id is not None and chat_id < 0) else ("private" if chat_id else "unknown")
+    policy = _flowise_retry_policy(chat_id)
+
+    async def _call():
+        t0 = time.perf_counter()
+        try:
+            return await _flowise_call_async(
+                question=question,
+                session_id=session_id,
+                chatflow_id=cfid,
+                namespace=ns,
+                timeout_sec=FLOWISE_TIMEOUT,
+                backoff_base_ms=FLOWISE_BACKOFF_BASE_MS,
+                **policy,
+            )
+        finally:
+            MET_FLOWISE_LATENCY.labels(dst=dst).observe(time.perf_counter() - t0)
+
+    # سؤال یکسان (chatflow + namespace + متن نرمال‌شده) که هم‌زمان در جریان است → یک فراخوانی.
+    # بدون کش پاسخ، پاسخ به حافظهٔ همان session وابسته است؛ پس فقط درون همان session ادغام می‌شود.
+    if ckey is not None:
+        sf_key = ("chat",) + ckey
+    else:
+        sf_key = ("chat", session_id) + _answer_cache_key(cfid, ns or "", question, norm_question)
+    text, src_count = await single_flight(sf_key, _call, kind="chat")
+
+    _answer_cache_store(ckey, text, src_count)
+    return (text, src_count)
+
+
+# --- حالت استریم پاسخ Chat AI (به ازای هر چت) ---
+CHAT_AI_STREAM_DEFAULT = os.getenv("CHAT_AI_STREAM_DEFAULT", "off")
+CHAT_AI_STREAM_EDIT_SEC = float(os.getenv("CHAT_AI_STREAM_EDIT_SEC", "1.5") or 1.5)     # فاصلهٔ حداقل بین دو ادیت
+CHAT_AI_STREAM_FIRST_CHARS = _int_env("CHAT_AI_STREAM_FIRST_CHARS", 120)                # حداقل متن قبل از اولین ارسال
+
+
+def chat_ai_stream_enabled(chat_id: Optional[int]) -> bool:
+    """استریم پاسخ برای این چت روشن است؟ (chat_config.chat_ai_stream → bot_config → ENV)"""
+    if not chat_id:
+        return False
+    v = chat_cfg_get(chat_id, "chat_ai_stream")
+    if v is None:
+        v = get_config("chat_ai_stream_default") or CHAT_AI_STREAM_DEFAULT
+    return as_bool(v)
+
+
+async def call_flowise_stream(
+    question: str, session_id: str, chat_id: Optional[int] = None, on_text=None, norm_question: Optional[str] = None,
+) -> tuple[str, int | None]:
+    """
+    نسخهٔ استریم call_flowise_async: on_text(متن تجمعی) با رسیدن هر تکه await می‌شود.
+    کش پاسخ همچنان اعمال می‌شود (hit → بدون استریم)؛ single-flight ندارد چون هر استریم مال یک پیام است.
+    """
+    off, cfid, ns = _flowise_target(chat_id)
+    if off is not None:
+        return (off, None)
+
+    ckey, hit = _answer_cache_lookup(chat_id, cfid, ns, question, norm_question)
+    if hit is not None:
+        return hit
+
+    dst = "group" if (chat_id is not None and chat_id < 0) else ("private" if chat_id else "unknown")
+    t0 = time.perf_counter()
+    try:
+        text, src_count = await _flowise_stream_async(
+            question=question,
+            session_id=session_id,
+            chatflow_id=cfid,
+            namespace=ns,
+            timeout_sec=FLOWISE_TIMEOUT,
+            on_text=on_text,
+            on_first_byte=lambda sec: MET_FLOWISE_TTFB.labels(dst=dst).observe(sec),
+        )
+    finally:
+        MET_FLOWISE_LATENCY.labels(dst=dst).observe(time.perf_counter() - t0)
+    _answer_cache_store(ckey, text, src_count)
+    return (text, src_count)
 
 
 
@@ -417,18 +1041,20 @@ FALLBACK_HINTS = (
     "متوجه منظور نشدم",
 )
 
+_FALLBACK_HINTS_NORM = tuple(normalize_text(h) for h in FALLBACK_HINTS)
+
 # تابع تشخیص پاسخ نامعلوم (بر اساس الگوهای ثابت)
 def is_unknown_reply(txt: str) -> bool:
     if not txt or not str(txt).strip():
         # پاسخ خالی یا None به منزله پاسخ نامعلوم است
         return True
-    t = str(txt).replace("\u200c", "")  # حذف نیم‌فاصله (ZWNJ)
-    t = re.sub(r"\s+", " ", t).strip("«»\"'").strip()
+    # همان نرمال‌سازی مشترک (ی/ک عربی، ZWNJ، علائم جهت، فاصله‌ها) روی پاسخ و عبارات fallback
+    t = normalize_text(txt).strip("«»\"'").strip()
     # اگر پاسخ با هر یک از عبارات پیش‌فرض fallback شروع شود
-    if any(t.startswith(h) for h in FALLBACK_HINTS):
+    if any(t.startswith(h) for h in _FALLBACK_HINTS_NORM):
         return True
     # اگر پاسخ خیلی کوتاه باشد و یکی از عبارات را شامل شود (احتمالاً fallback)
-    if len(t) <= 80 and any(h in t for h in FALLBACK_HINTS):
+    if len(t) <= 80 and any(h in t for h in _FALLBACK_HINTS_NORM):
         return True
     return False
 
@@ -639,16 +1265,288 @@ def upsert_user_from_update(update: Update):
     except Exception as e:
         log.warning(f"upsert_user_from_update failed: {e}")
 
+# --- Config cache (read-through) + LISTEN/NOTIFY invalidation ---
+# هر پیام گروه ده‌ها بار get_config/chat_cfg_get را صدا می‌زند؛ این کش باعث می‌شود
+# گروه‌های پرترافیک عملاً هیچ رفت‌وبرگشتی به DB برای تنظیمات نداشته باشند.
+# نوشتن‌ها (set_config/chat_cfg_set) یک NOTIFY می‌فرستند و همهٔ پروسه‌ها/رپلیکاها
+# ورودی مربوطه را از کش خود حذف می‌کنند. TTL فقط تور ایمنی برای NOTIFYهای گم‌شده است.
+CONFIG_NOTIFY_CHANNEL = "bot_config_changed"
+CONFIG_CACHE_TTL_SEC = float(os.getenv("CONFIG_CACHE_TTL_SEC", "300"))
+
+_cfg_cache: dict[str, tuple[Optional[str], float]] = {}
+_chat_cfg_cache: dict[int, "ChatSettings"] = {}
+_cfg_cache_lock = threading.Lock()
+# با هر invalidation یک واحد جلو می‌رود؛ خواننده‌ای که قبل از SELECT نسخه را برداشته و در این فاصله
+# invalidation رخ داده، مقدار (احتمالاً کهنهٔ) خودش را در کش نمی‌گذارد
+_cfg_gen = 0
+_cfg_listener_thread: Optional[threading.Thread] = None
+_cfg_listener_stop = threading.Event()
+
+
+def _cfg_cache_lookup(cache: dict, k):
+    """(hit, value) برمی‌گرداند؛ ورودی منقضی‌شده miss حساب می‌شود."""
+    ent = cache.get(k)
+    if ent is None:
+        return False, None
+    value, ts = ent
+    if CONFIG_CACHE_TTL_SEC > 0 and (time.monotonic() - ts) > CONFIG_CACHE_TTL_SEC:
+        return False, None
+    return True, value
+
+
+def _cfg_cache_store(cache: dict, k, value: Optional[str], gen: int) -> None:
+    """ذخیره فقط اگر از زمان برداشتن gen (قبل از خواندن DB) invalidation‌ای نرسیده باشد."""
+    with _cfg_cache_lock:
+        if gen == _cfg_gen:
+            cache[k] = (value, time.monotonic())
+
+
+def invalidate_config_cache(payload: Optional[str] = None) -> None:
+    """
+    حذف ورودی‌های کش بر اساس payload همان NOTIFY:
+      - "bot:<key>"              → فقط bot_config[key]
+      - "chat:<chat_id>:<key>"   → اسنپ‌شات آن گروه
+      - None/نامعتبر             → کل کش
+    """
+    with _cfg_cache_lock:
+        _invalidate_locked(payload)
+
+
+def _invalidate_locked(payload: Optional[str]) -> Optional[str]:
+    """زیر قفل اجرا می‌شود؛ payload نرمال‌شده را برمی‌گرداند (None یعنی کل کش پاک شد)."""
+    global _cfg_gen
+    _cfg_gen += 1
+    if not payload:
+        _cfg_cache.clear()
+        _chat_cfg_cache.clear()
+        return None
+    try:
+        kind, rest = payload.split(":", 1)
+        if kind == "bot":
+            _cfg_cache.pop(rest, None)
+            return payload
+        if kind == "chat":
+            # اسنپ‌شات کل گروه دور ریخته می‌شود (بار بعد با یک SELECT دوباره ساخته می‌شود)
+            cid_s, _key = rest.split(":", 1)
+            _chat_cfg_cache.pop(int(cid_s), None)
+            return payload
+    except Exception:
+        pass
+    _cfg_cache.clear()
+    _chat_cfg_cache.clear()
+    return None
+
+
+def as_bool(v) -> bool:
+    return str(v).strip().lower() in ("on", "1", "true", "yes")
+
+
+# نوع کلیدهای شناخته‌شدهٔ chat_config؛ هنگام ساخت اسنپ‌شات یک‌بار parse می‌شوند
+_CHAT_SETTING_TYPES: dict[str, type] = {
+    # ChatAI
+    "chat_ai_enabled": bool,
+    "chat_ai_admins_only": bool,
+    "chat_ai_min_gap_sec": int,
+    "chat_ai_autoclean_sec": int,
+    "chat_ai_cache": bool,
+    "chat_ai_stream": bool,
+    "chat_ai_retries": int,
+    "chat_ai_deadline_sec": float,
+    "chat_ai_hedge": bool,
+    # AdsGuard
+    "ads_feature": bool,
+    "ads_batch": bool,
+    "ads_local_model": bool,
+    "ads_local_low": float,
+    "ads_local_high": float,
+    "ads_neardup": bool,
+    "ads_neardup_global": bool,
+    "ads_neardup_max_dist": int,
+    "ads_threshold": float,
+    "ads_max_fewshots": int,
+    "ads_min_gap_sec": int,
+    "ads_autoclean_sec": int,
+    "ads_mute_hours": int,
+    "ads_examples_hardcap": int,
+    "ads_reply_exempt": bool,
+    "ads_reply_exempt_maxlen": int,
+    "ads_reply_exempt_allow_contact": bool,
+    "ads_reply_exempt_contact_maxlen": int,
+    "ads_caption_min_len": int,
+    "ads_nocap_grace_sec": int,
+    "ads_allow_forward_entities": bool,
+    "ads_forward_caption_min_len": int,
+    "ads_forward_grace_sec": int,
+    "ads_allow_reply_as_caption": bool,
+    "ads_short_warn_cooldown_sec": int,
+    "ads_reoffend_grace_sec": int,
+    "ads_reoffend_cooldown_sec": int,
+    "ads_warn_edit_cooldown_sec": int,
+    "ads_warn_success_autodel_sec": int,
+}
+
+
+class ChatSettings:
+    """
+    اسنپ‌شات فقط‌خواندنی از chat_config یک گروه.
+    - با یک SELECT (همهٔ کلیدها) ساخته می‌شود و کلیدهای شناخته‌شده از پیش parse می‌شوند.
+    - در هر آپدیت یک‌بار گرفته و به getterها پاس داده می‌شود (watchdog/on_message).
+    - get_* اگر کلید نبود یا parse نشد، default را برمی‌گرداند (همان رفتار getterهای قبلی).
+    """
+    __slots__ = ("chat_id", "raw", "parsed", "loaded_at")
+
+    def __init__(self, chat_id: int, raw: Optional[dict] = None):
+        self.chat_id = int(chat_id)
+        self.raw: dict[str, str] = dict(raw or {})
+        self.loaded_at = time.monotonic()
+        parsed = {}
+        for k, v in self.raw.items():
+            typ = _CHAT_SETTING_TYPES.get(k)
+            if typ is None:
+                continue
+            try:
+                parsed[k] = as_bool(v) if typ is bool else typ(v)
+            except Exception:
+                pass
+        self.parsed: dict[str, object] = parsed
+
+    def get(self, key: str, default: Optional[str] = None) -> Optional[str]:
+        v = self.raw.get(key)
+        return default if v is None else v
+
+    def _typed(self, key: str, typ: type, default):
+        v = self.parsed.get(key, _MISSING)
+        if v is _MISSING or type(v) is not typ:
+            raw = self.raw.get(key)
+            if raw is None:
+                return default
+            try:
+                return as_bool(raw) if typ is bool else typ(raw)
+            except Exception:
+                return default
+        return v
+
+    def get_int(self, key: str, default: int) -> int:
+        return self._typed(key, int, default)
+
+    def get_float(self, key: str, default: float) -> float:
+        return self._typed(key, float, default)
+
+    def get_bool(self, key: str, default: bool) -> bool:
+        return self._typed(key, bool, default)
+
+    def __repr__(self) -> str:
+        return f"ChatSettings(chat_id={self.chat_id}, keys={len(self.raw)})"
+
+
+def load_chat_settings(chat_id) -> ChatSettings:
+    """
+    اسنپ‌شات تنظیمات گروه از کش (یا یک SELECT روی chat_config).
+    اگر خودِ ChatSettings داده شود، همان برگردانده می‌شود تا getterها هر دو را بپذیرند.
+    """
+    if isinstance(chat_id, ChatSettings):
+        return chat_id
+    cid = int(chat_id)
+    cs = _chat_cfg_cache.get(cid)
+    if cs is not None and (CONFIG_CACHE_TTL_SEC <= 0 or (time.monotonic() - cs.loaded_at) <= CONFIG_CACHE_TTL_SEC):
+        return cs
+    gen = _cfg_gen
+    try:
+        with db_conn() as conn, conn.cursor() as cur:
+            cur.execute("SELECT key, value FROM chat_config WHERE chat_id=%s", (cid,))
+            rows = cur.fetchall()
+    except Exception as e:
+        log.warning(f"load_chat_settings failed: {e}")
+        # در خطا کش نمی‌کنیم تا در درخواست بعدی دوباره تلاش شود
+        return ChatSettings(cid)
+    cs = ChatSettings(cid, {k: v for k, v in rows})
+    with _cfg_cache_lock:
+        # اگر بین SELECT و این‌جا invalidation رسیده، اسنپ‌شات ممکن است کهنه باشد: فقط برگردان، کش نکن
+        if gen == _cfg_gen:
+            _chat_cfg_cache[cid] = cs
+    return cs
+
+
+def _notify_config_changed(cur, payload: str) -> None:
+    """NOTIFY داخل همان تراکنشِ نوشتن؛ پس از commit به همهٔ شنونده‌ها می‌رسد."""
+    cur.execute("SELECT pg_notify(%s, %s)", (CONFIG_NOTIFY_CHANNEL, payload))
+
+
+def _config_listener_loop() -> None:
+    """
+    یک کانکشن اختصاصی (خارج از استخر) که روی کانال تنظیمات LISTEN می‌کند.
+    با هر قطع/خطا کل کش پاک و دوباره وصل می‌شود تا هیچ تغییری از دست نرود.
+    """
+    import select
+    while not _cfg_listener_stop.is_set():
+        conn = None
+        try:
+            conn = psycopg2.connect(_DSN)
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            with conn.cursor() as cur:
+                cur.execute(f"LISTEN {CONFIG_NOTIFY_CHANNEL};")
+            # ممکن است بین آخرین خواندن و LISTEN تغییری رخ داده باشد
+            invalidate_config_cache()
+            log.info("Config cache listener started (channel=%s)", CONFIG_NOTIFY_CHANNEL)
+            while not _cfg_listener_stop.is_set():
+                if select.select([conn], [], [], 1.0) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    n = conn.notifies.pop(0)
+                    invalidate_config_cache(n.payload)
+        except Exception as e:
+            log.warning(f"Config cache listener error: {e}")
+            invalidate_config_cache()
+            _cfg_listener_stop.wait(3.0)
+        finally:
+            try:
+                if conn is not None:
+                    conn.close()
+            except Exception:
+                pass
+
+
+def start_config_listener() -> None:
+    """شروع thread شنوندهٔ NOTIFY (idempotent)."""
+    global _cfg_listener_thread
+    if _cfg_listener_thread is not None and _cfg_listener_thread.is_alive():
+        return
+    _cfg_listener_stop.clear()
+    _cfg_listener_thread = threading.Thread(
+        target=_config_listener_loop, name="config-cache-listener", daemon=True
+    )
+    _cfg_listener_thread.start()
+
+
+def stop_config_listener(timeout_sec: float = 10.0) -> None:
+    """توقف thread شنونده و انتظار برای بسته شدن کانکشن LISTEN (حداکثر timeout_sec)."""
+    global _cfg_listener_thread
+    _cfg_listener_stop.set()
+    t = _cfg_listener_thread
+    if t is not None and t.is_alive() and t is not threading.current_thread():
+        t.join(timeout_sec)
+        if t.is_alive():
+            log.warning("Config cache listener did not stop within %.1fs", timeout_sec)
+    _cfg_listener_thread = None
+
+
 # توابع تنظیمات بات در DB
 def get_config(key: str) -> Optional[str]:
+    hit, value = _cfg_cache_lookup(_cfg_cache, key)
+    if hit:
+        return value
+    gen = _cfg_gen
     try:
         with db_conn() as conn, conn.cursor() as cur:
             cur.execute("SELECT value FROM bot_config WHERE key=%s", (key,))
             row = cur.fetchone()
-            return row[0] if row else None
+            value = row[0] if row else None
     except Exception as e:
         log.warning(f"get_config failed: {e}")
         return None
+    _cfg_cache_store(_cfg_cache, key, value, gen)
+    return value
 
 def set_config(key: str, value: str):
     try:
@@ -657,9 +1555,12 @@ def set_config(key: str, value: str):
                 INSERT INTO bot_config (key, value) VALUES (%s, %s)
                 ON CONFLICT (key) DO UPDATE SET value=EXCLUDED.value, updated_at=NOW()
             """, (key, value))
+            _notify_config_changed(cur, f"bot:{key}")
             conn.commit()
     except Exception as e:
         log.warning(f"set_config failed: {e}")
+    finally:
+        invalidate_config_cache(f"bot:{key}")
 
 
 # --- NEW: Admin audit helper ---
@@ -817,14 +1718,9 @@ def ads_autoclean_sec(chat_id: int) -> int:
 
 
 def chat_cfg_get(chat_id: int, key: str) -> Optional[str]:
-    try:
-        with db_conn() as conn, conn.cursor() as cur:
-            cur.execute("SELECT value FROM chat_config WHERE chat_id=%s AND key=%s", (chat_id, key))
-            r = cur.fetchone()
-            return r[0] if r else None
-    except Exception as e:
-        log.warning(f"chat_cfg_get failed: {e}")
-        return None
+    # از اسنپ‌شات کل گروه خوانده می‌شود (یک SELECT برای همهٔ کلیدها).
+    # chat_id می‌تواند خودِ ChatSettings هم باشد؛ پس chat_ai_*/ads_* هم اسنپ‌شات را می‌پذیرند.
+    return load_chat_settings(chat_id).get(key)
 
 def chat_cfg_set(chat_id: int, key: str, value: str):
     try:
@@ -835,16 +1731,31 @@ def chat_cfg_set(chat_id: int, key: str, value: str):
                 ON CONFLICT (chat_id, key)
                 DO UPDATE SET value=EXCLUDED.value, updated_at=NOW()
             """, (chat_id, key, value))
+            _notify_config_changed(cur, f"chat:{int(chat_id)}:{key}")
             conn.commit()
     except Exception as e:
         log.warning(f"chat_cfg_set failed: {e}")
+    finally:
+        invalidate_config_cache(f"chat:{int(chat_id)}:{key}")
+
+# گروه‌هایی که اخیراً ensure_chat_defaults برایشان اجرا شده است (محدود با TTL/LRU؛
+# گروهی که بیرون برود در پیام بعدی فقط یک INSERT بی‌اثر دیگر می‌خورد)
+CHAT_DEFAULTS_DONE_TTL_SEC = _int_env("CHAT_DEFAULTS_DONE_TTL_SEC", 86400)
+CHAT_DEFAULTS_DONE_MAX = _int_env("CHAT_DEFAULTS_DONE_MAX", 50000)
+_chat_defaults_done = TtlMap("chat_defaults_done", CHAT_DEFAULTS_DONE_TTL_SEC, CHAT_DEFAULTS_DONE_MAX)
 
-def ensure_chat_defaults(chat_id: int) -> None:
+def ensure_chat_defaults(chat_id: int) -> bool:
     """
     ایجاد/تکمیل رکورد تنظیمات این گروه در chat_config به‌صورت DB-first.
     فقط کلیدهایی که در chat_config موجود نیستند را با مقادیر پیش‌فرض (از bot_config یا در نهایت ENV) ثبت می‌کند.
     این کار تغییرات قبلی ادمین‌ها را overwrite نمی‌کند (idempotent).
+    - یک INSERT چندردیفی با ON CONFLICT DO NOTHING (به‌جای خواندن/نوشتن کلید به کلید)
+    - هر گروه فقط یک‌بار در هر دورهٔ TTL؛ پیام‌های بعدی هیچ رفت‌وبرگشتی به DB ندارند.
+    خروجی: True اگر کلیدی واقعاً درج شد.
     """
+    cid = int(chat_id)
+    if cid in _chat_defaults_done:
+        return False
     try:
         # کاندیدهای اصلی که دوست داریم در هر گروه «ثابت و قابل ردیابی» باشند
         candidates = {
@@ -865,13 +1776,32 @@ def ensure_chat_defaults(chat_id: int) -> None:
             # ⭐️ حداقل طول کپشن (بر حسب «کلمه») برای گروه‌های جدید: DB → درغیراینصورت مقدار ثابت 5
             "ads_caption_min_len": (get_config("ads_caption_min_len") or "5"),
         }
-        # فقط کلیدهای غایب را درج کن (UPSERT روی (chat_id,key))
-        for k, v in candidates.items():
-            if chat_cfg_get(chat_id, k) is None and v is not None:
-                chat_cfg_set(chat_id, k, str(v))
+        rows = [(cid, k, str(v)) for k, v in candidates.items() if v is not None]
+        inserted = []
+        if rows:
+            # فقط کلیدهای غایب درج می‌شوند (ON CONFLICT روی (chat_id,key))
+            with db_conn() as conn, conn.cursor() as cur:
+                inserted = psycopg2.extras.execute_values(
+                    cur,
+                    """
+                    INSERT INTO chat_config (chat_id, key, value) VALUES %s
+                    ON CONFLICT (chat_id, key) DO NOTHING
+                    RETURNING key
+                    """,
+                    rows,
+                    fetch=True,
+                )
+                if inserted:
+                    _notify_config_changed(cur, f"chat:{cid}:*")
+                conn.commit()
+            if inserted:
+                invalidate_config_cache(f"chat:{cid}:*")
+        _chat_defaults_done.set(cid, True)
+        return bool(inserted)
     except Exception as e:
-        # نباید منطق اصلی را مختل کند
+        # نباید منطق اصلی را مختل کند (در خطا علامت نمی‌زنیم تا دفعهٔ بعد دوباره تلاش شود)
         log.warning(f"ensure_chat_defaults failed for chat {chat_id}: {e}")
+        return False
 
 
 def pv_group_list_limit() -> int:
@@ -1461,6 +2391,111 @@ def chunk_text(text: str, limit: int = TG_MAX_MESSAGE) -> List[str]:
             text = text[limit:]
     return parts
 
+class StreamingReply:
+    """
+    پاسخ تدریجی برای حالت استریم Chat AI:
+      - تا رسیدن first_chars کاراکتر چیزی ارسال نمی‌شود (تا پاسخ «نمی‌دانم» هرگز نیمه‌کاره دیده نشود)،
+      - بعد با فاصلهٔ حداقل edit_sec همان پیام ادیت می‌شود،
+      - با عبور از TG_MAX_MESSAGE پیام فعلی بسته و پیام تازه شروع می‌شود.
+    push() هرگز استثنا بالا نمی‌دهد؛ finish() متن نهایی و reply_markup را روی آخرین پیام می‌گذارد.
+    """
+
+    def __init__(self, update: Update, *, edit_sec: Optional[float] = None, first_chars: Optional[int] = None,
+                 stop_event: Optional[asyncio.Event] = None):
+        self.update = update
+        self.messages: list = []
+        self._edit_sec = CHAT_AI_STREAM_EDIT_SEC if edit_sec is None else float(edit_sec)
+        self._first_chars = CHAT_AI_STREAM_FIRST_CHARS if first_chars is None else int(first_chars)
+        self._stop_event = stop_event
+        self._offset = 0          # ابتدای پیام جاری در متن کامل
+        self._current = None      # پیام جاری (در حال ادیت)
+        self._shown = ""          # متنی که الان در پیام جاری دیده می‌شود
+        self._full = ""           # آخرین متن کاملی که render شد
+        self._next_edit = 0.0
+
+    async def push(self, full_text: str) -> None:
+        if not self.messages and len(full_text) < self._first_chars:
+            return
+        if time.monotonic() < self._next_edit:
+            return
+        try:
+            await self._render(full_text)
+        except Exception as e:
+            log.debug("stream render failed: %s", e)
+
+    async def finish(self, final_text: str, **kwargs):
+        final_text = final_text or ""
+        if self._offset and not final_text.startswith(self._full[:self._offset]):
+            # متن نهایی ادامهٔ پیام‌های بسته‌شده نیست (مثلاً خطا وسط استریم):
+            # تکه‌های قبلی پاک و متن نهایی از نو ارسال می‌شود
+            await self.discard()
+        await self._render(final_text, reply_markup=kwargs.get("reply_markup"))
+        try:
+            chat = getattr(self.update, "effective_chat", None)
+            ctype = getattr(chat, "type", None) if chat else None
+            dst = "private" if ctype == "private" else ("group" if ctype in ("group", "supergroup") else "unknown")
+            MET_BOT_REPLIES.labels(dst=dst).inc()
+        except Exception:
+            pass
+        return self._current
+
+    async def discard(self) -> None:
+        """حذف پیام‌های استریم‌شده (مثلاً وقتی پاسخ نهایی «نامعلوم» بود)."""
+        for m in self.messages:
+            try:
+                await m.delete()
+            except Exception:
+                pass
+        self.messages.clear()
+        self._current = None
+        self._offset, self._shown, self._full = 0, "", ""
+
+    async def _render(self, full_text: str, reply_markup=None) -> None:
+        self._full = full_text
+        seg = full_text[self._offset:]
+        while len(seg) > TG_MAX_MESSAGE:
+            head = chunk_text(seg, TG_MAX_MESSAGE)[0]
+            await self._show(head)
+            rest = seg[len(head):]
+            self._offset += len(head) + (len(rest) - len(rest.lstrip()))
+            self._current, self._shown = None, ""
+            seg = full_text[self._offset:]
+        await self._show(seg, reply_markup)
+
+    async def _show(self, text: str, reply_markup=None) -> None:
+        if not text.strip():
+            return
+        try:
+            if self._current is None:
+                message = self.update.effective_message or self.update.message
+                try:
+                    self._current = await message.reply_text(text, reply_markup=reply_markup)
+                except BadRequest as e:
+                    if "message to be replied not found" not in str(e).lower():
+                        raise
+                    self._current = await message.chat.send_message(text, reply_markup=reply_markup)
+                self.messages.append(self._current)
+                if self._stop_event is not None:
+                    self._stop_event.set()  # دیگر «در حال تایپ» لازم نیست
+            elif text != self._shown or reply_markup is not None:
+                try:
+                    await self._current.edit_text(text, reply_markup=reply_markup)
+                except BadRequest as e:
+                    if "not modified" not in str(e).lower():
+                        raise
+            self._shown = text
+            self._next_edit = time.monotonic() + self._edit_sec
+        except RetryAfter as e:
+            # flood control تلگرام: ادیت‌های بعدی را تا پایان مهلت عقب بینداز
+            ra = getattr(e, "retry_after", 5) or 5
+            ra = ra.total_seconds() if hasattr(ra, "total_seconds") else float(ra)
+            self._next_edit = time.monotonic() + ra
+            if reply_markup is not None:
+                # ادیت نهایی (با دکمه‌ها) نباید گم شود
+                await asyncio.sleep(ra)
+                await self._show(text, reply_markup)
+
+
 # ارسال امن متن (تکه‌تکه و با مدیریت خطاها)
 # --- REPLACE safe_reply_text WITH THIS VERSION ---
 async def safe_reply_text(update: Update, text: str, **kwargs):
@@ -0,0 +1,201 @@
+# timer_wheel.py
+# -----------------------------------------------------------------------------
+# زمان‌بند مهلت‌ها با چرخ زمانی سلسله‌مراتبی (hierarchical timing wheel)
+# - به‌جای یک task خوابیده برای هر مهلت، یک coroutine جاروبگر (sweeper) برای کل چرخ
+# - schedule/cancel با کلید در O(1)؛ مهلت‌های خیلی دور در overflow می‌مانند تا نوبتشان برسد
+# - همهٔ مهلت‌های سررسیدهٔ یک tick با هم به on_due داده می‌شوند (برای حذف دسته‌ای)
+# - متریک‌ها (اختیاری): تعداد مهلت‌های در صف و تأخیر اجرا نسبت به مهلت
+# -----------------------------------------------------------------------------
+from __future__ import annotations
+
+import asyncio
+import logging
+import math
+import time
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Sequence, Tuple
+
+log = logging.getLogger("timer_wheel")
+
+DueBatch = List[Tuple[Hashable, Any]]
+
+
+class _Timer:
+    __slots__ = ("key", "payload", "deadline", "tick", "level", "slot")
+
+    def __init__(self, key, payload, deadline: float, tick: int):
+        self.key = key
+        self.payload = payload
+        self.deadline = deadline
+        self.tick = tick
+        self.level = -1     # -1 یعنی overflow
+        self.slot = -1
+
+
+class TimerWheel:
+    """
+    on_due(batch) برای هر tick که مهلتی در آن سررسیده با لیست [(key, payload), ...] صدا زده می‌شود
+    (به‌صورت task جدا تا کندی Bot API جاروبگر را عقب نیندازد).
+    sizes: تعداد خانه‌های هر سطح؛ پیش‌فرض با tick=1s تا حدود ۱۲ ساعت بدون overflow.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        on_due: Callable[[DueBatch], Awaitable[None]],
+        *,
+        tick_sec: float = 1.0,
+        sizes: Sequence[int] = (64, 64, 16),
+        pending_gauge=None,
+        lag_histogram=None,
+    ):
+        self.name = name
+        self._on_due = on_due
+        self._tick_sec = float(tick_sec)
+        self._sizes = tuple(int(n) for n in sizes)
+        self._wheels: List[List[Dict[Hashable, _Timer]]] = [[{} for _ in range(n)] for n in self._sizes]
+        self._overflow: Dict[Hashable, _Timer] = {}
+        self._timers: Dict[Hashable, _Timer] = {}
+        self._origin = time.monotonic()
+        self._tick = 0
+        self._gauge = pending_gauge
+        self._lag = lag_histogram
+        self._wakeup: Optional[asyncio.Event] = None
+        self._sweeper: Optional[asyncio.Task] = None
+        self._callbacks: set = set()
+
+    # ---------- API ----------
+    def __len__(self) -> int:
+        return len(self._timers)
+
+    def __contains__(self, key) -> bool:
+        return key in self._timers
+
+    def schedule(self, key: Hashable, delay_sec: float, payload: Any = None) -> None:
+        """مهلت key را (دوباره) تنظیم می‌کند؛ باید داخل event loop صدا زده شود."""
+        self._ensure_sweeper()
+        self._unlink(self._timers.pop(key, None))
+        if not self._timers:
+            self._tick = self._current_tick()   # چرخ خالی بود: بدون پردازش tickهای خالی جلو برو
+        deadline = time.monotonic() + max(0.0, float(delay_sec))
+        timer = _Timer(key, payload, deadline, math.ceil((deadline - self._origin) / self._tick_sec))
+        self._timers[key] = timer
+        due: DueBatch = []
+        self._place(timer, due)
+        self._publish()
+        if due:
+            self._dispatch(due)
+        self._wakeup.set()
+
+    def cancel(self, key: Hashable) -> bool:
+        timer = self._timers.pop(key, None)
+        if timer is None:
+            return False
+        self._unlink(timer)
+        self._publish()
+        return True
+
+    def stop(self) -> None:
+        """توقف جاروبگر (مهلت‌های باقی‌مانده اجرا نمی‌شوند)."""
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            self._sweeper = None
+        for t in list(self._callbacks):
+            t.cancel()
+
+    # ---------- داخلی ----------
+    def _current_tick(self) -> int:
+        return int((time.monotonic() - self._origin) / self._tick_sec)
+
+    def _publish(self) -> None:
+        if self._gauge is not None:
+            self._gauge.labels(name=self.name).set(len(self._timers))
+
+    def _place(self, timer: _Timer, due: DueBatch) -> None:
+        diff = timer.tick - self._tick
+        if diff <= 0:
+            self._timers.pop(timer.key, None)
+            due.append((timer.key, timer.payload))
+            self._observe_lag(timer)
+            return
+        span = 1
+        for level, n in enumerate(self._sizes):
+            if timer.tick // span - self._tick // span < n:
+                slot = (timer.tick // span) % n
+                self._wheels[level][slot][timer.key] = timer
+                timer.level, timer.slot = level, slot
+                return
+            span *= n
+        self._overflow[timer.key] = timer
+        timer.level, timer.slot = -1, -1
+
+    def _unlink(self, timer: Optional[_Timer]) -> None:
+        if timer is None:
+            return
+        if timer.level < 0:
+            self._overflow.pop(timer.key, None)
+        else:
+            self._wheels[timer.level][timer.slot].pop(timer.key, None)
+
+    def _observe_lag(self, timer: _Timer) -> None:
+        if self._lag is not None:
+            self._lag.labels(name=self.name).observe(max(0.0, time.monotonic() - timer.deadline))
+
+    def _advance(self, due: DueBatch) -> None:
+        """یک tick جلو: سطوح بالاتر را در مرز دورشان به پایین می‌ریزد، سپس خانهٔ فعلی را اجرا می‌کند."""
+        self._tick += 1
+        spans = [1]
+        for n in self._sizes:
+            spans.append(spans[-1] * n)
+        if self._tick % spans[-1] == 0 and self._overflow:
+            moved, self._overflow = self._overflow, {}
+            for timer in moved.values():
+                self._place(timer, due)
+        for level in range(len(self._sizes) - 1, 0, -1):
+            if self._tick % spans[level] == 0:
+                slot = (self._tick // spans[level]) % self._sizes[level]
+                moved, self._wheels[level][slot] = self._wheels[level][slot], {}
+                for timer in moved.values():
+                    self._place(timer, due)
+        bucket = self._wheels[0][self._tick % self._sizes[0]]
+        if bucket:
+            fired, self._wheels[0][self._tick % self._sizes[0]] = bucket, {}
+            for timer in fired.values():
+                self._timers.pop(timer.key, None)
+                due.append((timer.key, timer.payload))
+                self._observe_lag(timer)
+
+    def _dispatch(self, due: DueBatch) -> None:
+        task = asyncio.get_running_loop().create_task(self._run_due(due))
+        self._callbacks.add(task)
+        task.add_done_callback(self._callbacks.discard)
+
+    async def _run_due(self, due: DueBatch) -> None:
+        try:
+            await self._on_due(due)
+        except Exception as e:
+            log.warning("[timer:%s] on_due failed for %s item(s): %s", self.name, len(due), e)
+
+    def _ensure_sweeper(self) -> None:
+        if self._sweeper is None or self._sweeper.done():
+            self._wakeup = asyncio.Event()
+            self._sweeper = asyncio.get_running_loop().create_task(self._sweep())
+
+    async def _sweep(self) -> None:
+        while True:
+            if not self._timers:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            next_at = self._origin + (self._tick + 1) * self._tick_sec
+            delay = next_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            due: DueBatch = []
+            target = self._current_tick()
+            while self._tick < target and self._timers:
+                self._advance(due)
+            if not self._timers:
+                self._tick = max(self._tick, target)
+            if due:
+                self._publish()
+                self._dispatch(due)
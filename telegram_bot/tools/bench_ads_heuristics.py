@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# tools/bench_ads_heuristics.py
+# -----------------------------------------------------------------------------
+# میکروبنچمارک هیوریستیک‌های متنی AdsGuard: پیاده‌سازی قدیمی (الگو به الگو) در برابر ads_heuristics
+# - پیکره: چند پیام گروهی نمونه + ترکیب تصادفی آن‌ها (seed ثابت تا اجراها قابل مقایسه باشند)
+# - هر سه سیگنال را مثل watchdog حساب می‌کند (نیت درخواست، شبه‌تماس، دامنه‌ها)
+# - خروجی دو مسیر برای همهٔ پیام‌ها مقایسه می‌شود؛ هر اختلاف گزارش و با کد 1 خارج می‌شود
+# اجرا (از پوشهٔ telegram_bot):  python tools/bench_ads_heuristics.py --count 3000 --repeat 5
+# -----------------------------------------------------------------------------
+from __future__ import annotations
+
+import argparse
+import os
+import random
+import re
+import sys
+import time
+from urllib.parse import urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ads_heuristics  # noqa: E402
+
+SAMPLES = [
+    "سلام دوستان کسی می‌دونه از کجا میشه لوله پلی‌اتیلن خوب تهیه کنم؟",
+    "کسی ورق گالوانیزه موجود داره؟ قیمت بدید لطفا",
+    "فروش ویژه کاشی و سرامیک با تخفیف ۳۰٪ تماس 09121234567",
+    "برای سفارش به آیدی @best_shop_admin پیام بدید",
+    "کانال ما را دنبال کنید t.me/some_channel",
+    "سایت ما: https://www.example-store.ir/products?id=12 ارسال رایگان",
+    "ممنون از راهنمایی همه، مشکلم حل شد",
+    "این مدل پمپ برای ساختمان ۴ طبقه مناسبه؟",
+    "پی وی قیمت بدید دونه‌ای چند؟",
+    "ایمیل بزنید sales@example.com یا زنگ بزنید 021-88776655",
+    "امروز جلسه ساعت ۵ برگزار می‌شه",
+    "کسی تعمیرکار پکیج سراغ داره در غرب تهران؟",
+    "بهترین قیمت میلگرد در بازار آهن، موجودی داریم www.ahanprice.com",
+    "دوستان کسی این کار رو انجام میده؟",
+    "نظرتون درباره عایق‌های جدید چیه",
+]
+
+
+# ---------- پیاده‌سازی قدیمی (مرجع؛ همان منطق AdsGuard پیش از ads_heuristics) ----------
+def legacy_is_request_intent(text: str) -> bool:
+    if not text:
+        return False
+    norm = re.sub(r"[\u200c\u200f\u200e]", " ", (text or "").strip())
+    s = re.sub(r"\s+", " ", norm)
+    patterns = list(ads_heuristics._REQUEST_BASE) + list(ads_heuristics._REQUEST_SOMEONE)
+    if any(re.search(p, s, flags=re.IGNORECASE) for p in patterns):
+        return True
+    if ("?" in s or "؟" in s) and re.search(r"(بخر|خرید|تهیه)", s, flags=re.IGNORECASE):
+        return True
+    return False
+
+
+def legacy_has_contact_like(text: str) -> bool:
+    if not text:
+        return False
+    s = (text or "").lower()
+    if re.search(r"(\+?98|0)?9\d{9}", s):
+        return True
+    if re.search(r"\b\+?\d[\d\s\-]{8,}\d\b", s):
+        return True
+    if re.search(r"(https?://|www\.)\S+", s):
+        return True
+    if re.search(r"@\w{3,}", s) or "t.me/" in s:
+        return True
+    if re.search(r"[\w\.-]+@[\w\.-]+\.[a-z]{2,}", s):
+        return True
+    return False
+
+
+def legacy_extract_domains(text: str) -> list:
+    if not text:
+        return []
+    cand = set()
+    for m in re.findall(r"https?://[^\s\)\]\>\<]+", text, flags=re.IGNORECASE):
+        try:
+            host = urlparse(m).hostname
+        except Exception:
+            host = None
+        if host:
+            cand.add(host.lower())
+    for m in re.findall(
+        r"\b([A-Za-z0-9\u0600-\u06FF][A-Za-z0-9\.\-\u0600-\u06FF]*\.[A-Za-z\u0600-\u06FF]{2,})(?:/\S*)?\b",
+        text,
+        flags=re.IGNORECASE,
+    ):
+        cand.add(m.split('/')[0].lower())
+    return sorted(cand)
+
+
+def legacy_signals(text: str) -> tuple:
+    return (legacy_is_request_intent(text), legacy_has_contact_like(text), tuple(legacy_extract_domains(text)))
+
+
+def new_signals(text: str) -> tuple:
+    sig = ads_heuristics.analyze(text)
+    return (sig.request_intent, sig.has_contact, sig.domains)
+
+
+def new_signals_uncached(text: str) -> tuple:
+    links = ads_heuristics.extract_links(text)
+    return (
+        ads_heuristics.is_request_intent(text),
+        ads_heuristics.has_contact_like(text),
+        tuple(sorted({host for host, _ in links})),
+    )
+
+
+# ---------- اجرا ----------
+def build_corpus(count: int, seed: int) -> list:
+    rnd = random.Random(seed)
+    corpus = list(SAMPLES)
+    while len(corpus) < count:
+        a, b = rnd.sample(SAMPLES, 2)
+        wa, wb = a.split(), b.split()
+        corpus.append(" ".join(wa[: rnd.randint(1, len(wa))] + wb[rnd.randint(0, len(wb) - 1):]))
+    return corpus
+
+
+def bench(fn, corpus: list, repeat: int) -> float:
+    """بهترین زمان (میکروثانیه به ازای هر پیام) از repeat دور."""
+    best = float("inf")
+    for _ in range(repeat):
+        ads_heuristics.analyze.cache_clear()
+        t0 = time.perf_counter()
+        for text in corpus:
+            fn(text)
+        best = min(best, time.perf_counter() - t0)
+    return best / len(corpus) * 1e6
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description="AdsGuard text heuristics: legacy vs ads_heuristics")
+    ap.add_argument("--count", type=int, default=3000)
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("--seed", type=int, default=17)
+    args = ap.parse_args()
+
+    corpus = build_corpus(args.count, args.seed)
+    diffs = [t for t in corpus if legacy_signals(t) != new_signals_uncached(t)]
+    for t in diffs[:10]:
+        print(f"MISMATCH: {t!r}\n  legacy={legacy_signals(t)}\n  new   ={new_signals_uncached(t)}")
+
+    print(f"messages: {len(corpus)}  mismatches: {len(diffs)}")
+    print(f"legacy                    : {bench(legacy_signals, corpus, args.repeat):7.1f} us/msg")
+    print(f"ads_heuristics (no memo)  : {bench(new_signals_uncached, corpus, args.repeat):7.1f} us/msg")
+    print(f"ads_heuristics.analyze    : {bench(new_signals, corpus, args.repeat):7.1f} us/msg")
+    return 1 if diffs else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# tools/bench_chat_defaults.py
+# -----------------------------------------------------------------------------
+# شمارش رفت‌وبرگشت‌های DB به ازای هر پیام گروهی در ensure_chat_defaults (قبل/بعد)
+# - بدون Postgres: ThreadedConnectionPool پیش از import کردن shared_utils با یک استخر
+#   جعلی جایگزین می‌شود که هر cur.execute را می‌شمارد و chat_config را در حافظه نگه می‌دارد
+# - «قبل»: مسیر قدیمی (به ازای هر کلید: get_config + chat_cfg_get + در صورت نبود، UPSERT)
+#   با همان SQLها بازسازی شده است؛ «بعد»: خودِ shared_utils.ensure_chat_defaults
+# اجرا (از پوشهٔ telegram_bot):  python tools/bench_chat_defaults.py --chats 50 --messages 20
+# -----------------------------------------------------------------------------
+from __future__ import annotations
+
+import argparse
+import os
+import sys
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import psycopg2.pool
+
+# کلیدهای پیش‌فرضی که ensure_chat_defaults برای هر گروه ثبت می‌کند (کلید bot_config, کلید chat_config)
+DEFAULT_KEYS = [
+    ("default_lang", "lang"),
+    ("chat_ai_default_enabled", "chat_ai_enabled"),
+    ("chat_ai_default_mode", "chat_ai_mode"),
+    ("chat_ai_default_min_gap_sec", "chat_ai_min_gap_sec"),
+    ("chat_ai_default_autoclean_sec", "chat_ai_autoclean_sec"),
+    ("ads_feature", "ads_feature"),
+    ("ads_action", "ads_action"),
+    ("ads_threshold", "ads_threshold"),
+    ("ads_max_fewshots", "ads_max_fewshots"),
+    ("ads_min_gap_sec", "ads_min_gap_sec"),
+    ("ads_autoclean_sec", "ads_autoclean_sec"),
+    ("ads_caption_min_len", "ads_caption_min_len"),
+]
+
+
+class _Db:
+    """state مشترک استخر جعلی: جدول chat_config و شمارندهٔ عبارت‌ها."""
+
+    def __init__(self):
+        self.chat_config: dict = {}
+        self.calls: Counter = Counter()
+
+    def reset(self):
+        self.chat_config.clear()
+        self.calls.clear()
+
+
+DB = _Db()
+
+
+class _Cursor:
+    def __init__(self):
+        self._result: list = []
+        self._mogrified: list = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def mogrify(self, template, args):
+        # execute_values هر ردیف را جدا mogrify می‌کند؛ ردیف‌ها برای INSERT بعدی نگه داشته می‌شوند
+        self._mogrified.append(tuple(args))
+        return b"(%s,%s,%s)"
+
+    def execute(self, sql, params=None):
+        if isinstance(sql, bytes):
+            sql = sql.decode("utf-8", "replace")
+        words = sql.split()
+        kind = words[0].upper() if words else "?"
+        self._result = []
+        if "pg_notify" in sql:
+            DB.calls["NOTIFY"] += 1
+            return
+        if kind == "SELECT" and "FROM chat_config" in sql:
+            if "key=%s" in sql.replace(" ", ""):
+                value = DB.chat_config.get((params[0], params[1]))
+                self._result = [(value,)] if value is not None else []
+            else:
+                cid = params[0]
+                self._result = [(k, v) for (c, k), v in DB.chat_config.items() if c == cid]
+        elif kind == "INSERT" and "chat_config" in sql:
+            rows = [params] if params else self._mogrified
+            self._mogrified = []
+            inserted = []
+            for cid, key, value in rows:
+                if (cid, key) not in DB.chat_config or "DO UPDATE" in sql:
+                    inserted.append((key,))
+                DB.chat_config.setdefault((cid, key), value)
+            self._result = inserted
+        DB.calls[kind] += 1
+
+    def fetchone(self):
+        return self._result[0] if self._result else None
+
+    def fetchall(self):
+        rows, self._result = self._result, []
+        return rows
+
+
+class _Conn:
+    closed = False
+
+    def cursor(self, *a, **kw):
+        return _Cursor()
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+class _Pool:
+    def __init__(self, *a, **kw):
+        pass
+
+    def getconn(self):
+        return _Conn()
+
+    def putconn(self, conn):
+        pass
+
+
+psycopg2.pool.ThreadedConnectionPool = _Pool
+# shared_utils در import این‌ها را الزامی می‌داند؛ در این شمارش به هیچ‌کدام وصل نمی‌شویم
+os.environ.setdefault("BOT_TOKEN", "0:bench")
+os.environ.setdefault("FLOWISE_BASE_URL", "http://127.0.0.1:9")
+
+import shared_utils as su  # noqa: E402  (بعد از جایگزینی استخر)
+
+
+def baseline_ensure_chat_defaults(chat_id: int) -> None:
+    """مسیر قدیمی: هر کلید یک SELECT در bot_config، یک SELECT در chat_config و UPSERT کلیدهای غایب."""
+    for bot_key, chat_key in DEFAULT_KEYS:
+        with su.db_conn() as conn, conn.cursor() as cur:
+            cur.execute("SELECT value FROM bot_config WHERE key=%s", (bot_key,))
+            row = cur.fetchone()
+        default = (row[0] if row else None) or "x"
+        with su.db_conn() as conn, conn.cursor() as cur:
+            cur.execute("SELECT value FROM chat_config WHERE chat_id=%s AND key=%s", (chat_id, chat_key))
+            exists = cur.fetchone() is not None
+        if not exists:
+            with su.db_conn() as conn, conn.cursor() as cur:
+                cur.execute(
+                    "INSERT INTO chat_config (chat_id, key, value) VALUES (%s, %s, %s) "
+                    "ON CONFLICT (chat_id, key) DO UPDATE SET value=EXCLUDED.value, updated_at=NOW()",
+                    (chat_id, chat_key, default),
+                )
+                cur.execute("SELECT pg_notify(%s, %s)", ("cfg", f"chat:{chat_id}:{chat_key}"))
+                conn.commit()
+
+
+def _run(label: str, fn, chats: int, messages: int) -> None:
+    DB.reset()
+    su.invalidate_config_cache(None)
+    su._chat_defaults_done.clear()
+    first, steady = Counter(), Counter()
+    for m in range(messages):
+        for c in range(chats):
+            before = Counter(DB.calls)
+            fn(-1000 - c)
+            (first if m == 0 else steady).update(DB.calls - before)
+    n_first, n_steady = chats, chats * max(0, messages - 1)
+    print(f"{label}")
+    print(f"  first message per chat : {sum(first.values()) / n_first:6.2f} round-trips  totals={dict(first)}")
+    if n_steady:
+        print(f"  later messages         : {sum(steady.values()) / n_steady:6.2f} round-trips  totals={dict(steady)}")
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="DB round-trips per group message in ensure_chat_defaults")
+    ap.add_argument("--chats", type=int, default=50)
+    ap.add_argument("--messages", type=int, default=20, help="پیام به ازای هر گروه")
+    args = ap.parse_args()
+    _run("before (per-key get/upsert)", baseline_ensure_chat_defaults, args.chats, args.messages)
+    _run("after  (shared_utils.ensure_chat_defaults)", su.ensure_chat_defaults, args.chats, args.messages)
+
+
+if __name__ == "__main__":
+    main()
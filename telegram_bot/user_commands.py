@@ -5,11 +5,12 @@ import time  # برای محدود کردن تعداد پیام‌های «خا
 import os
 
 from shared_utils import db_conn, log_exceptions, log
-from flowise_client import ping_flowise
+from flowise_client import ping_flowise_async
 
 
 from time import perf_counter
 from shared_utils import chat_cfg_get, chat_cfg_set  # برای خواندن/ثبت تنظیمات زبان (DB-first)
+from shared_utils import ChatSettings, load_chat_settings
 from telegram import constants as C
 from os import getenv
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton, ForceReply, ReplyKeyboardRemove
@@ -24,7 +25,8 @@ from telegram.constants import ChatAction, ParseMode
 from telegram.ext import ContextTypes, ApplicationHandlerStop
 from shared_utils import (
     safe_reply_text, upsert_user_from_update, maybe_refresh_ui, force_clear_session,
-    is_superadmin, is_dm_allowed, call_flowise, is_unknown_reply, save_unknown_question,
+    is_superadmin, is_dm_allowed, call_flowise_async, is_unknown_reply, save_unknown_question,
+    call_flowise_stream, chat_ai_stream_enabled, StreamingReply, normalized_text, TtlMap, ads_verdict_blocks,
     save_local_history, get_session, get_local_history, get_or_rotate_session,
     set_chat_ui_ver, UI_SCHEMA_VERSION, has_any_feedback_for_message, save_feedback,
     count_feedback, mark_unknown_reported, log, PRIVATE_DENY_MESSAGE, is_addressed_to_bot, get_config, cfg_get_str,
@@ -75,9 +77,12 @@ def _should_notify_mode_hint(chat_id: int) -> bool:
 
 
 # --- کنترل پایهٔ Chat AI per-group (نسخهٔ ساده‌شده: فقط دو مود mention|all) ---
-_last_chat_ai_ts = {}  # (chat_id, thread_id) -> unix time
+_last_chat_ai_ts = TtlMap("chat_ai_last_ts", 3600, 50000)  # (chat_id, thread_id) -> unix time
 
-async def _chat_ai_should_answer(update: Update, context: ContextTypes.DEFAULT_TYPE, bot_username: str, bot_id: int) -> bool:
+# حداکثر انتظار چت‌بات برای رأی صف نظارت AdsGuard روی همان پیام (ثانیه)
+ADS_CHAT_GATE_TIMEOUT_SEC = float(os.getenv("ADS_CHAT_GATE_TIMEOUT_SEC", "20"))
+
+async def _chat_ai_should_answer(update: Update, context: ContextTypes.DEFAULT_TYPE, bot_username: str, bot_id: int, cs: ChatSettings | None = None) -> bool:
     """
     سیاست نهایی پاسخ‌گویی Chat-AI با دو مود:
       - mention: فقط وقتی خطاب صریح باشد (منشن @Bot یا ریپلای به پیام خودِ بات).
@@ -101,13 +106,17 @@ async def _chat_ai_should_answer(update: Update, context: ContextTypes.DEFAULT_T
     if chat.type not in ("group", "supergroup"):
         return False
 
+    # اگر caller اسنپ‌شات را نداده، همین‌جا یک‌بار بگیر
+    if cs is None:
+        cs = load_chat_settings(chat.id)
+
     # خاموش بودن Chat-AI
-    en = (chat_cfg_get(chat.id, "chat_ai_enabled") or CHAT_AI_DEFAULT_ENABLED).strip().lower()
+    en = (cs.get("chat_ai_enabled") or CHAT_AI_DEFAULT_ENABLED).strip().lower()
     if en not in ("on", "1", "true", "yes"):
         return False
 
     # نرمال‌سازی مود به {mention|all}
-    mode = (chat_cfg_get(chat.id, "chat_ai_mode") or CHAT_AI_DEFAULT_MODE).strip().lower()
+    mode = (cs.get("chat_ai_mode") or CHAT_AI_DEFAULT_MODE).strip().lower()
     if mode not in ("mention", "all"):
         # نگاشت مودهای قدیمی (reply/command) به mention
         mode = "mention"
@@ -118,7 +127,7 @@ async def _chat_ai_should_answer(update: Update, context: ContextTypes.DEFAULT_T
 
     # محدودکنندهٔ فاصلهٔ زمانی (بر اساس thread)
     try:
-        gap = int(chat_cfg_get(chat.id, "chat_ai_min_gap_sec") or CHAT_AI_DEFAULT_MIN_GAP_SEC)
+        gap = int(cs.get("chat_ai_min_gap_sec") or CHAT_AI_DEFAULT_MIN_GAP_SEC)
     except Exception:
         gap = int(CHAT_AI_DEFAULT_MIN_GAP_SEC)
     now = time.time()
@@ -132,7 +141,7 @@ async def _chat_ai_should_answer(update: Update, context: ContextTypes.DEFAULT_T
     addressed = is_addressed_to_bot(update, bot_username, bot_id)  # از shared_utils
 
     # admins-only: فقط ادمینِ همین گروه «و» الزاماً خطاب صریح
-    admins_only = (chat_cfg_get(chat.id, "chat_ai_admins_only") or "off").strip().lower() in ("on", "1", "true", "yes")
+    admins_only = (cs.get("chat_ai_admins_only") or "off").strip().lower() in ("on", "1", "true", "yes")
     if admins_only:
         u = update.effective_user
         # Anonymous Admin = sender_chat خود گروه یا @GroupAnonymousBot
@@ -162,7 +171,7 @@ async def _chat_ai_should_answer(update: Update, context: ContextTypes.DEFAULT_T
                 return False
 
     # در این نقطه پاسخ می‌دهیم: مُهر زمان را ثبت کن
-    _last_chat_ai_ts[key] = now
+    _last_chat_ai_ts.set(key, now, ttl_sec=max(60, gap))
     return True
 
 
@@ -978,6 +987,10 @@ async def ask_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
     u = update.effective_user
     text = txt
 
+    # رأی صف نظارت AdsGuard برای همین پیام (مثل on_message)؛ تبلیغِ اقدام‌شده جواب نمی‌گیرد
+    if chat.type in ("group", "supergroup") and await ads_verdict_blocks(context, ADS_CHAT_GATE_TIMEOUT_SEC):
+        return
+
     # (ادامهٔ کد «قبلی» همین تابع؛ از اینجا به بعد را عیناً نگه دار)
     # سیاست گفتگوی خصوصی: اگر PV مجاز نباشد، عدم دسترسی و خروج
     if chat.type == 'private' and not is_dm_allowed(u.id):
@@ -1063,8 +1076,10 @@ async def ask_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     try:
         flow_sid = sid if chat.type == 'private' else f"{sid}_u{u.id}"
-        reply_text, src_count = await asyncio.to_thread(call_flowise, text, flow_sid, chat.id)
+        reply_text, src_count, stream = await _ask_flowise(update, context, text, flow_sid, chat.id, stop_event)
         if (src_count == 0) or is_unknown_reply(reply_text):
+            if stream:
+                await stream.discard()
             uq_id = save_unknown_question(chat.id, u.id, sid, text)
             await send_unknown_reply(update, context, sid, uq_id)
             return
@@ -1076,7 +1091,10 @@ async def ask_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
             pass
     save_local_history(sid, chat.id, {"type": "human", "message": text})
     save_local_history(sid, chat.id, {"type": "ai", "message": reply_text})
-    await safe_reply_text(update, reply_text, reply_markup=feedback_keyboard(sid))
+    if stream:
+        await stream.finish(reply_text, reply_markup=feedback_keyboard(sid))
+    else:
+        await safe_reply_text(update, reply_text, reply_markup=feedback_keyboard(sid))
     
     # حذف پیام ForceReply فقط در گروه‌ها و فقط اگر autoclean>0 تنظیم شده باشد
     try:
@@ -1096,6 +1114,20 @@ async def ask_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
     _last_chat_ai_ts[(chat.id, thread_id or 0)] = time.time()
 
 
+async def _ask_flowise(update: Update, context, text: str, flow_sid: str, chat_id: int, stop_event: asyncio.Event):
+    """
+    پرسش از Flowise؛ در حالت استریم (chat_ai_stream) پاسخ تدریجی ارسال/ادیت می‌شود.
+    خروجی: (reply_text, src_count, stream) — stream فقط وقتی چیزی واقعاً ارسال شده باشد.
+    """
+    norm = normalized_text(text, context)   # همان نرمال‌سازی‌ای که AdsGuard روی این آپدیت انجام داده
+    if not chat_ai_stream_enabled(chat_id):
+        reply_text, src_count = await call_flowise_async(text, flow_sid, chat_id, norm_question=norm)
+        return reply_text, src_count, None
+    stream = StreamingReply(update, stop_event=stop_event)
+    reply_text, src_count = await call_flowise_stream(text, flow_sid, chat_id, on_text=stream.push, norm_question=norm)
+    return reply_text, src_count, (stream if stream.messages else None)
+
+
 # هندلر دستور /ask (پرسیدن سؤال با دستور، مخصوصاً در گروه‌ها با حالت '/command')
 async def ask_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     upsert_user_from_update(update)
@@ -1117,6 +1149,9 @@ async def ask_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
             except ApplicationHandlerStop:
                 # تبلیغ تشخیص داده شد؛ AdsGuard خودش اخطار/حذف را انجام داده و باید همین‌جا متوقف شویم
                 return
+            # با صف نظارت، watchdog فقط پیام را صف می‌کند؛ تا رأی صبر کن
+            if await ads_verdict_blocks(context, ADS_CHAT_GATE_TIMEOUT_SEC):
+                return
 
     
     # سیاست گفتگوی خصوصی: اگر PV مجاز نباشد، پیام عدم دسترسی و خروج
@@ -1206,7 +1241,7 @@ async def ask_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await safe_reply_text(update, f"{t('errors.rate_limited', chat_id=chat.id)}\nخطاب به: {m} | ID: {mid}", parse_mode=ParseMode.HTML)
 
             return
-        _last_chat_ai_ts[key] = now
+        _last_chat_ai_ts.set(key, now, ttl_sec=max(60, gap))
         
         
     # اگر هنوز سؤال مشخص نشده → ارسال پیام درخواست سؤال با ForceReply
@@ -1268,9 +1303,11 @@ async def ask_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     try:
         flow_sid = sid if chat.type == 'private' else f"{sid}_u{u.id}"
-        reply_text, src_count = await asyncio.to_thread(call_flowise, text, flow_sid, chat.id)
+        reply_text, src_count, stream = await _ask_flowise(update, context, text, flow_sid, chat.id, stop_event)
         # اگر پاسخ نامشخص بود یا منابعی پیدا نشد → ذخیره سؤال برای آموزش و ارسال پاسخ راهنما
         if (src_count == 0) or is_unknown_reply(reply_text):
+            if stream:
+                await stream.discard()
             uq_id = save_unknown_question(chat.id, u.id, sid, text)
             await send_unknown_reply(update, context, sid, uq_id)
             return
@@ -1285,7 +1322,10 @@ async def ask_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     save_local_history(sid, chat.id, {"type": "human", "message": text})
     save_local_history(sid, chat.id, {"type": "ai", "message": reply_text})
     # ارسال پاسخ در همان چت/موضوع به همراه دکمه‌های بازخورد
-    await safe_reply_text(update, reply_text, reply_markup=feedback_keyboard(sid))
+    if stream:
+        await stream.finish(reply_text, reply_markup=feedback_keyboard(sid))
+    else:
+        await safe_reply_text(update, reply_text, reply_markup=feedback_keyboard(sid))
     
     # فقط در گروه‌ها پیام ForceReply را پاک کن و آن هم در صورت تنظیم autoclean>0
     try:
@@ -1317,6 +1357,9 @@ async def on_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except Exception:
             # در صورت اختلال موقت DB، منطق اصلی پیام قطع نشود
             pass
+
+    # اسنپ‌شات تنظیمات این چت: یک‌بار برای کل آپدیت
+    cs = load_chat_settings(chat.id) if chat else None
         
     u = update.effective_user
     msg = update.effective_message
@@ -1370,7 +1413,7 @@ async def on_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         try:
             # پردازش LLM در ترد جدا تا event loop قفل نشود
-            reply_text, _src = await asyncio.to_thread(call_flowise, q, sid, chat.id)
+            reply_text, _src = await call_flowise_async(q, sid, chat.id)
             if not reply_text:
                 reply_text = "متوجه نشدم، یه‌بار دیگه بپرس لطفاً 🙂"
             await safe_reply_text(update, reply_text)
@@ -1392,8 +1435,8 @@ async def on_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # تنظیمات چت
     feature_on = _chat_feature_on()
-    mode = (chat_cfg_get(chat.id, "chat_ai_mode") or CHAT_AI_DEFAULT_MODE).strip().lower()
-    is_enabled = chat_ai_is_enabled(chat.id)
+    mode = (cs.get("chat_ai_mode") or CHAT_AI_DEFAULT_MODE).strip().lower()
+    is_enabled = chat_ai_is_enabled(cs)
 
 
     # هویت بات
@@ -1427,7 +1470,7 @@ async def on_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             m, mid = build_sender_html_from_update(update)
             wm = await safe_reply_text(update, f"{t('chat.off.notice', chat_id=chat.id)}\nخطاب به: {m} | ID: {mid}", parse_mode=ParseMode.HTML)
             try:
-                sec = chat_ai_autoclean_sec(chat.id)
+                sec = chat_ai_autoclean_sec(cs)
                 if sec and sec > 0 and wm:
                     # حذف پیام راهنمای بات
                     context.application.create_task(delete_after(context.bot, chat.id, wm.message_id, sec))
@@ -1448,11 +1491,16 @@ async def on_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if bot_user.username:
         text = text.replace(f"@{bot_user.username}", "").strip()
 
+    # اگر AdsGuard این پیام را در صف نظارت گذاشته، تا رأی صبر کن؛ پیام تبلیغاتیِ اقدام‌شده جواب نمی‌گیرد.
+    # پیش از _chat_ai_should_answer، چون آن تابع زمان cooldown (min_gap) را ثبت می‌کند.
+    if is_group and await ads_verdict_blocks(context, ADS_CHAT_GATE_TIMEOUT_SEC):
+        return
+
     # محدودیت‌ها (min_gap و …)
-    if not (await _chat_ai_should_answer(update, context, bot_user.username or "", bot_user.id)):
+    if not (await _chat_ai_should_answer(update, context, bot_user.username or "", bot_user.id, cs=cs)):
         # اگر admins_only روشن است و کاربرِ غیرادمین ما را خطاب کرده، پیام «فقط ادمین‌ها…» بده
         if is_group:
-            admins_only = (chat_cfg_get(chat.id, "chat_ai_admins_only") or "off").strip().lower() in ("on","1","true","yes")
+            admins_only = (cs.get("chat_ai_admins_only") or "off").strip().lower() in ("on","1","true","yes")
             if admins_only and addressed:
                 # ادمین ناشناس یا ادمین واقعی؟
                 is_anon_admin = (
@@ -1475,7 +1523,7 @@ async def on_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                             parse_mode=ParseMode.HTML,
                         )
                         try:
-                            sec = chat_ai_autoclean_sec(chat.id)
+                            sec = chat_ai_autoclean_sec(cs)
                             if sec and sec > 0 and wm:
                                 context.application.create_task(delete_after(context.bot, chat.id, wm.message_id, sec))
                                 if chat.type in ("group", "supergroup"):
@@ -1496,8 +1544,10 @@ async def on_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     try:
         flow_sid = sid if chat.type == 'private' else f"{sid}_u{u.id}"
-        reply_text, src_count = await asyncio.to_thread(call_flowise, text, flow_sid, chat.id)
+        reply_text, src_count, stream = await _ask_flowise(update, context, text, flow_sid, chat.id, stop_event)
         if (src_count == 0) or is_unknown_reply(reply_text):
+            if stream:
+                await stream.discard()
             uq_id = save_unknown_question(chat.id, u.id, sid, text)
             await send_unknown_reply(update, context, sid, uq_id)
             return
@@ -1510,7 +1560,10 @@ async def on_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     save_local_history(sid, chat.id, {"type": "human", "message": text})
     save_local_history(sid, chat.id, {"type": "ai", "message": reply_text})
-    await safe_reply_text(update, reply_text, reply_markup=feedback_keyboard(sid))
+    if stream:
+        await stream.finish(reply_text, reply_markup=feedback_keyboard(sid))
+    else:
+        await safe_reply_text(update, reply_text, reply_markup=feedback_keyboard(sid))
 
     # پاک‌سازی ForceReply قدیمی — فقط در گروه‌ها و فقط اگر autoclean>0
     try:
@@ -1518,7 +1571,7 @@ async def on_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             fr = update.message.reply_to_message if update.message else None
             if fr and fr.from_user and fr.from_user.id == bot_user.id:
                 if (fr.text or "").startswith("سوالت رو همینجا بنویس"):
-                    sec = chat_ai_autoclean_sec(chat.id)
+                    sec = chat_ai_autoclean_sec(cs)
                     if sec and sec > 0:
                         context.application.create_task(
                             delete_after(context.bot, chat.id, fr.message_id, sec)
@@ -1658,9 +1711,7 @@ async def health(update: Update, context: ContextTypes.DEFAULT_TYPE):
             else (f"pv:{chat.id}" if (chat and getattr(chat, "id", None)) else "pv")
         )
     
-        ok, fl_ms, fl_err = await asyncio.to_thread(
-            ping_flowise, base, cfid, api_key, 8, {"namespace": ns}
-        )
+        ok, fl_ms, fl_err = await ping_flowise_async(base, cfid, api_key, 8, {"namespace": ns})
         flow_line = f"Flowise: {'✅' if ok else '❌'} {fl_ms}ms — cfid={cfid}" + ("" if ok else f" — {fl_err}")
     except Exception as e:
         flow_line = f"Flowise: ❌ {type(e).__name__}: {e}"
@@ -0,0 +1,124 @@
+# write_behind.py
+# -----------------------------------------------------------------------------
+# بافر write-behind برای درج‌های پرتعداد و غیرحیاتی (مثل ads_decisions)
+# - put() ردیف را در حافظه می‌گذارد و برمی‌گردد؛ یک coroutine هر flush_ms یا با رسیدن به batch ردیف
+#   کل دسته را با یک فراخوانی sync (در thread) می‌نویسد: یک اتصال، یک commit
+# - سقف max_pending: اگر نوشتن عقب بیفتد، put منتظر جا می‌ماند (backpressure) و حافظه رشد نمی‌کند
+# - aclose(): هنگام خاموشی منتظر flush در جریان می‌ماند و باقی‌مانده را (در thread) می‌نویسد؛
+#   put() بعد از بسته شدن ردیف را نمی‌پذیرد (لاگ + متریک ازدست‌رفته)
+# - متریک‌ها (اختیاری): اندازهٔ هر flush و ردیف‌های ازدست‌رفته در خطای نوشتن
+# -----------------------------------------------------------------------------
+from __future__ import annotations
+
+import asyncio
+import logging
+from typing import Any, Callable, List, Optional
+
+log = logging.getLogger("write_behind")
+
+
+class WriteBehindBuffer:
+    def __init__(
+        self,
+        name: str,
+        write_rows: Callable[[List[Any]], None],
+        *,
+        flush_ms: int = 500,
+        batch: int = 200,
+        max_pending: int = 5000,
+        batch_histogram=None,
+        failed_counter=None,
+    ):
+        self.name = name
+        self._write_rows = write_rows
+        self._interval = max(0.01, flush_ms / 1000.0)
+        self._batch = max(1, int(batch))
+        self._max_pending = max(self._batch, int(max_pending))
+        self._rows: List[Any] = []
+        self._hist = batch_histogram
+        self._failed = failed_counter
+        self._kick: Optional[asyncio.Event] = None
+        self._space: Optional[asyncio.Event] = None
+        self._flusher: Optional[asyncio.Task] = None
+        self._closed = False
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    async def put(self, row: Any) -> None:
+        if self._closed:
+            self._reject(1)
+            return
+        self._ensure_flusher()
+        while len(self._rows) >= self._max_pending:
+            self._kick.set()
+            self._space.clear()
+            await self._space.wait()
+            if self._closed:
+                self._reject(1)
+                return
+        self._rows.append(row)
+        if len(self._rows) >= self._batch:
+            self._kick.set()
+
+    async def aclose(self) -> None:
+        """
+        بستن بافر برای shutdown: flusher بیدار می‌شود، flush در جریان تمام و بافر تخلیه می‌شود
+        (هیچ flush وسط کار cancel نمی‌شود)؛ اگر flusher زنده نبود، باقی‌مانده در thread نوشته می‌شود.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        flusher = self._flusher
+        if flusher is not None and not flusher.done():
+            self._kick.set()
+            try:
+                await flusher
+            except Exception as e:
+                log.warning("[write-behind:%s] flusher failed during close: %s", self.name, e)
+        self._flusher = None
+        while self._rows:
+            rows = self._rows[:self._batch]
+            del self._rows[:self._batch]
+            await asyncio.to_thread(self._write_now, rows)
+
+    # ---------- داخلی ----------
+    def _ensure_flusher(self) -> None:
+        if self._flusher is None or self._flusher.done():
+            self._kick = asyncio.Event()
+            self._space = asyncio.Event()
+            self._flusher = asyncio.get_running_loop().create_task(self._run())
+
+    def _reject(self, n: int) -> None:
+        log.warning("[write-behind:%s] closed; dropped %s row(s)", self.name, n)
+        if self._failed is not None:
+            self._failed.labels(name=self.name).inc(n)
+
+    def _write_now(self, rows: List[Any]) -> None:
+        if not rows:
+            return
+        try:
+            self._write_rows(rows)
+            if self._hist is not None:
+                self._hist.labels(name=self.name).observe(len(rows))
+        except Exception as e:
+            log.warning("[write-behind:%s] dropped %s row(s): %s", self.name, len(rows), e)
+            if self._failed is not None:
+                self._failed.labels(name=self.name).inc(len(rows))
+
+    async def _run(self) -> None:
+        while True:
+            if not self._closed:
+                try:
+                    await asyncio.wait_for(self._kick.wait(), self._interval)
+                except asyncio.TimeoutError:
+                    pass
+            self._kick.clear()
+            while self._rows:
+                rows = self._rows[:self._batch]
+                del self._rows[:self._batch]
+                self._space.set()
+                await asyncio.to_thread(self._write_now, rows)
+            if self._closed:
+                self._space.set()   # put()های منتظر جا بیدار شوند و رد شوند
+                return